@@ -1,6 +1,5 @@
 import pandas as pd
 import matplotlib.pyplot as plt
-import psycopg2
 from pathlib import Path
 import json
 import yaml
@@ -9,7 +8,7 @@ import numpy as np
 import matplotlib as mpl
 import textwrap
 
-from analysis.scripts.utils import execute_query, query_to_df
+from analysis.scripts.utils import execute_query, query_to_df, connect
 
 SQL_SCRIPT_DIR = 'analysis/sql'
 RESULTS_DIR = 'analysis/results'
@@ -48,11 +47,11 @@ def save_fig(fig, path):
 
 
 # Descriptive analysis of dataset
-def property_stats(db_config, reload_data):
+def property_stats(db_config, reload_data, backend_config=None):
 
     query_name = 'stats_properties'
     if reload_data:
-        conn = psycopg2.connect(**db_config)
+        conn = connect(db_config, backend_config)
         with open(f'{SQL_SCRIPT_DIR}/{query_name}.sql', 'r') as f:
             sql_query = f.read()
         execute_query(conn, sql_query)
@@ -62,7 +61,7 @@ def property_stats(db_config, reload_data):
         if os.path.exists(f'{RESULTS_DIR}/stats_properties.csv'):
             df = pd.read_csv(f'{RESULTS_DIR}/stats_properties.csv')
         else:
-            conn = psycopg2.connect(**db_config)
+            conn = connect(db_config, backend_config)
             df = query_to_df(conn, 'SELECT * FROM stats_properties;')
             if len(df) == 0:
                 print(f'No results found for stats_properties. Please run with reload_data=True (see setup.yml) to execute the query and save results.')
@@ -121,11 +120,11 @@ def property_stats(db_config, reload_data):
     save_fig(fig, f'{RESULTS_DIR}/figures/property_top_{top_filter}_change_type.png')
 
 
-def entity_type_stats(db_config, reload_data):
+def entity_type_stats(db_config, reload_data, backend_config=None):
 
     query_name = 'stats_entity_type'
     if reload_data:
-        conn = psycopg2.connect(**db_config)
+        conn = connect(db_config, backend_config)
         with open(f'{SQL_SCRIPT_DIR}/{query_name}.sql', 'r') as f:
             sql_query = f.read()
         execute_query(conn, sql_query)
@@ -135,7 +134,7 @@ def entity_type_stats(db_config, reload_data):
         if os.path.exists(f'{RESULTS_DIR}/entity_type_stats.csv'):
             df = pd.read_csv(f'{RESULTS_DIR}/entity_type_stats.csv')
         else:
-            conn = psycopg2.connect(**db_config)
+            conn = connect(db_config, backend_config)
             df = query_to_df(conn, 'SELECT * FROM entity_type_stats;')
             if len(df) == 0:
                 print(f'No results found for entity_type_stats. Please run with reload_data=True (see setup.yml) to execute the query and save results.')
@@ -265,17 +264,17 @@ def entity_type_stats(db_config, reload_data):
     save_fig(fig, f'{RESULTS_DIR}/figures/entity_type_top_{top_filter}_user_type.png')
 
 
-def distribution_of_revisions_value_changes(db_config, reload_data):
+def distribution_of_revisions_value_changes(db_config, reload_data, backend_config=None):
 
     if reload_data:
-        conn = psycopg2.connect(**db_config)
+        conn = connect(db_config, backend_config)
         df = query_to_df(conn, 'SELECT entity_id, num_revisions, num_value_changes FROM entity_stats;')
         df.to_csv(f'{RESULTS_DIR}/entity_stats.csv', index=False)
     else:
         if os.path.exists(f'{RESULTS_DIR}/entity_stats.csv'):
             df = pd.read_csv(f'{RESULTS_DIR}/entity_stats.csv')
         else:
-            conn = psycopg2.connect(**db_config)
+            conn = connect(db_config, backend_config)
             df = query_to_df(conn, 'SELECT entity_id, num_revisions, num_value_changes FROM entity_stats;')
             if len(df) == 0:
                 print(f'No results found for entity_stats. Please run with reload_data=True (see setup.yml) to execute the query and save results.')
@@ -334,13 +333,13 @@ def distribution_of_revisions_value_changes(db_config, reload_data):
     print(f'Average number of value changes per entity: {avg_value_changes:.2f}')
     print(f'Average number of revisions per entity: {avg_num_revisions:.2f}')
 
-def entity_stats(db_config, reload_data, filter_big_entities):
+def entity_stats(db_config, reload_data, filter_big_entities, backend_config=None):
     """
         Entity stats analysis: distributions of number of revisions, creates, deletes, updates per entity.
     """
 
     if reload_data:
-        conn = psycopg2.connect(**db_config)
+        conn = connect(db_config, backend_config)
         df_final = pd.DataFrame()
         batch_size = 100000
         offset = 0
@@ -414,12 +413,12 @@ def entity_stats(db_config, reload_data, filter_big_entities):
     plt.savefig(img_file_name, dpi=300)
     plt.show()
 
-def stats_sa_ao(db_config, reload_data):
+def stats_sa_ao(db_config, reload_data, backend_config=None):
 
     query_name = 'stats_sa_ao'
     suffixes = ['_ao', '_sa']
     if reload_data:
-        conn = psycopg2.connect(**db_config)
+        conn = connect(db_config, backend_config)
         for suffix in suffixes:
             
             with open(f'{SQL_SCRIPT_DIR}/{query_name}.sql', 'r') as f:
@@ -446,37 +445,40 @@ if __name__ == "__main__":
     with open(set_up['database_config_path'], 'r') as f:
         db_config = json.load(f)
 
+    # postgres (default) or duckdb, see README
+    backend_config = set_up['analysis'].get('backend', {})
+
     # -----------------------------------------------------------------
     # Most edited entity types
     # -----------------------------------------------------------------
     entity_types_setup = set_up['analysis']['entity_types_analysis']
     if entity_types_setup['execute']:
-        entity_type_stats(db_config, entity_types_setup['reload_data'])
+        entity_type_stats(db_config, entity_types_setup['reload_data'], backend_config)
 
     # -----------------------------------------------------------------
     # Distribution of revisions and value changes across all entities
     # -----------------------------------------------------------------
     distribution_of_revisions_value_changes_setup = set_up['analysis']['distribution_of_revisions_value_changes']
     if distribution_of_revisions_value_changes_setup['execute']:
-        distribution_of_revisions_value_changes(db_config, distribution_of_revisions_value_changes_setup['reload_data'])
+        distribution_of_revisions_value_changes(db_config, distribution_of_revisions_value_changes_setup['reload_data'], backend_config)
 
     # -----------------------------------------------------------------
     # Most used properties + distribution of user types
     # -----------------------------------------------------------------
     property_stats_setup = set_up['analysis']['property_stats']
     if property_stats_setup['execute']:
-        property_stats(db_config, property_stats_setup['reload_data'])
+        property_stats(db_config, property_stats_setup['reload_data'], backend_config)
 
     # -----------------------------------------------------------------
     # Different stats about entities: distribution of revisions, creates, deletes, updates per entity.
     # -----------------------------------------------------------------
     entity_stats_setup = set_up['analysis']['entity_stats']
     if entity_stats_setup['execute']:
-        entity_stats(db_config, entity_stats_setup['reload_data'], entity_stats_setup['filter_big_entities'])
+        entity_stats(db_config, entity_stats_setup['reload_data'], entity_stats_setup['filter_big_entities'], backend_config)
 
     # -----------------------------------------------------------------
     # Different stats about scholarly articles and astronomical objects.
     # -----------------------------------------------------------------
     stats_sa_ao_setup = set_up['analysis']['stats_sa_ao']
     if stats_sa_ao_setup['execute']:
-        stats_sa_ao(db_config, stats_sa_ao_setup['reload_data'])
\ No newline at end of file
+        stats_sa_ao(db_config, stats_sa_ao_setup['reload_data'], backend_config)
\ No newline at end of file
@@ -1,6 +1,103 @@
 import pandas as pd
+import psycopg2
+from pathlib import Path
+
+POSTGRES_CONFIG_KEYS = {
+    'DB_NAME': 'dbname',
+    'DB_USER': 'user',
+    'DB_PASS': 'password',
+    'DB_HOST': 'host',
+    'DB_PORT': 'port'
+}
+
+# tables created by the analysis queries (analysis/sql), stored in the DuckDB database and not read from the source
+ANALYSIS_RESULT_TABLES = {'stats_properties', 'entity_type_stats'}
+
+def to_libpq_params(db_config):
+    """Maps the keys of config/db_config.json (DB_NAME, DB_USER, ...) to libpq parameter names"""
+    return {POSTGRES_CONFIG_KEYS.get(key, key): value for key, value in db_config.items()}
+
+def is_duckdb(conn):
+    return type(conn).__module__.lstrip('_').startswith('duckdb')
+
+def connect_duckdb(db_config, backend_config):
+    """
+        Opens a DuckDB connection where the change tables can be queried with the same names as in PostgreSQL.
+        Tables are views over either:
+            - the Parquet files written by the parquet sink (source: parquet), one directory per table
+            - the PostgreSQL DB through DuckDB's postgres scanner (source: postgres)
+        Tables created by the analysis queries (e.g. stats_properties) are stored in database_path.
+    """
+    import duckdb
+
+    database_path = backend_config.get('database_path', 'analysis/results/analysis.duckdb')
+    Path(database_path).parent.mkdir(parents=True, exist_ok=True)
+    conn = duckdb.connect(database_path)
+
+    if backend_config.get('threads'):
+        conn.execute(f"SET threads = {int(backend_config['threads'])}")
+    if backend_config.get('memory_limit'):
+        conn.execute(f"SET memory_limit = '{backend_config['memory_limit']}'")
+
+    source = backend_config.get('source', 'parquet')
+    if source == 'parquet':
+        parquet_directory = Path(backend_config.get('parquet_directory', 'data/parquet'))
+        for table_dir in sorted(parquet_directory.iterdir()):
+            if table_dir.is_dir() and any(table_dir.glob('*.parquet')):
+                conn.execute(f"""
+                    CREATE OR REPLACE VIEW {table_dir.name} AS 
+                    SELECT * FROM read_parquet('{table_dir.as_posix()}/*.parquet')
+                """)
+
+    elif source == 'postgres':
+        conn.execute("INSTALL postgres")
+        conn.execute("LOAD postgres")
+        dsn = ' '.join(f'{key}={value}' for key, value in to_libpq_params(db_config).items() if value != '')
+        conn.execute(f"ATTACH IF NOT EXISTS '{dsn}' AS pg (TYPE POSTGRES, READ_ONLY)")
+        pg_tables = conn.execute("""
+            SELECT table_name FROM duckdb_tables() 
+            WHERE database_name = 'pg' AND schema_name = 'public'
+        """).fetchall()
+        for (table_name,) in pg_tables:
+            if table_name in ANALYSIS_RESULT_TABLES:
+                continue
+            conn.execute(f"CREATE OR REPLACE VIEW {table_name} AS SELECT * FROM pg.public.{table_name}")
+
+        # views of the result tables created by earlier versions (drop table if exists fails on a view)
+        result_views = conn.execute(
+            "SELECT view_name FROM duckdb_views() WHERE database_name = current_database() AND schema_name = 'main' AND view_name IN ?",
+            [list(ANALYSIS_RESULT_TABLES)]
+        ).fetchall()
+        for (view_name,) in result_views:
+            conn.execute(f"DROP VIEW {view_name}")
+    else:
+        raise ValueError(f"Unknown duckdb source '{source}'. Options are: parquet, postgres")
+
+    # other tables needed by the queries (e.g. entity_labels_alias_description) that are stored as csv/parquet files
+    for table_name, file_path in backend_config.get('extra_tables', {}).items():
+        reader = 'read_parquet' if str(file_path).endswith('.parquet') else 'read_csv_auto'
+        conn.execute(f"CREATE OR REPLACE VIEW {table_name} AS SELECT * FROM {reader}('{file_path}')")
+
+    return conn
+
+def connect(db_config, backend_config=None):
+    """
+        Returns a connection for the analysis queries.
+        backend_config is analysis.backend in setup.yml, engine can be postgres (default) or duckdb
+    """
+    backend_config = backend_config or {}
+    engine = backend_config.get('engine', 'postgres')
+    if engine == 'duckdb':
+        return connect_duckdb(db_config, backend_config)
+    return psycopg2.connect(**to_libpq_params(db_config))
 
 def execute_query(conn, query, params=None):
+    if is_duckdb(conn):
+        cur = conn.execute(query, params)
+        if cur.description:
+            return cur.fetchall()
+        return None
+
     try:
         with conn.cursor() as cur:
             cur.execute(query, params)
@@ -17,6 +114,14 @@ def execute_query(conn, query, params=None):
         raise e
 
 def query_to_df(conn, query):
+    if is_duckdb(conn):
+        # vectorised fetch straight into pandas
+        cur = conn.execute(query)
+        if cur.description is None:
+            print('Query did not return any rows')
+            return pd.DataFrame()
+        return cur.df()
+
     try:
         with conn.cursor() as cur:
             cur.execute(query)
@@ -32,4 +137,37 @@ def query_to_df(conn, query):
                 print('Query did not return any rows')
                 return pd.DataFrame()
     except Exception as e:
-        raise e
\ No newline at end of file
+        raise e
+
+
+def fan_out_query(db_configs, query, group_by=None, agg='sum'):
+    """
+        Runs query on every shard (see sharded_sink in setup.yml) in parallel and merges the results.
+        db_configs is a list of db configs (one per shard).
+        Without group_by the results are concatenated. With group_by, the rows of the shards are aggregated
+        by the group_by columns with agg (e.g. 'sum', or {'num_revisions': 'sum', 'max_timestamp': 'max'}),
+        so the query should only compute aggregates that can be combined (count, sum, min, max, not avg).
+    """
+    import concurrent.futures
+
+    if not db_configs:
+        raise ValueError('fan_out_query needs at least one db config (see sharded_sink.shards in setup.yml)')
+
+    def run_query(db_config):
+        conn = psycopg2.connect(**to_libpq_params(db_config))
+        try:
+            return query_to_df(conn, query)
+        finally:
+            conn.close()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(db_configs)) as executor:
+        dfs = list(executor.map(run_query, db_configs))
+
+    dfs = [shard_df for shard_df in dfs if not shard_df.empty]
+    if not dfs:
+        return pd.DataFrame()
+
+    df = pd.concat(dfs, ignore_index=True)
+    if group_by is None:
+        return df
+    return df.groupby(group_by, as_index=False).agg(agg)
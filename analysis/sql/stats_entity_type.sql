@@ -1,3 +1,5 @@
+DROP TABLE IF EXISTS entity_type_stats;
+
 CREATE TABLE entity_type_stats AS
 WITH type_split AS (
     SELECT 
@@ -17,7 +19,7 @@ WITH type_split AS (
 )
 SELECT 
 	individual_type,
-	count(distinct entity_id),
+	count(distinct entity_id) as count,
 	sum(num_revisions) as num_revisions, 
 	sum(num_value_changes) as num_value_changes, 
 	sum(num_qualifier_changes) as num_qualifier_changes, 
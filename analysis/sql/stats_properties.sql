@@ -1,3 +1,5 @@
+drop table if exists stats_properties;
+
 create table stats_properties as
 select 
 	property_id, property_label, 
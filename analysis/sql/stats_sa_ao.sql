@@ -1,5 +1,5 @@
 
-select 'number of entities' as metric, count(*)
+select 'number of entities' as metric, count(*) as count
 from entity_stats<suffix>
 union all
 select  'number value changes' as metric, SUM(num_value_changes)
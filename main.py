@@ -14,6 +14,8 @@ import yaml
 from scripts.db_writer import db_writer
 from scripts.utils import create_db_schema
 from scripts.file_parser import FileParser
+from scripts.transport import create_results_channel
+from scripts.sinks import get_shard_set_ups
 from scripts.const import PROCESSED_FILES_PATH, CLAIMED_FILES_PATH, LOCK_FILE_PATH, SETUP_PATH
 
 with open(SETUP_PATH, 'r') as f:
@@ -137,8 +139,13 @@ if __name__ == "__main__":
     if not Path(LOCK_FILE_PATH).exists():
         open(LOCK_FILE_PATH, 'w').close()
 
-    # Creating DB schema
-    create_db_schema(set_up)
+    # Creating DB schema (not needed when the output is written to parquet or spool files)
+    output_sink = set_up.get('change_extraction_processing', {}).get('output_sink', 'postgres')
+    if output_sink == 'postgres':
+        create_db_schema(set_up)
+    elif output_sink == 'sharded_postgres':
+        for shard_set_up in get_shard_set_ups(set_up):
+            create_db_schema(shard_set_up)
 
     if args.file:
         # Single file processing
@@ -205,8 +212,8 @@ if __name__ == "__main__":
         
         print(f"Starting shared db_writer expecting {total_workers} workers")
         
-        # Create shared queue
-        shared_queue = mp.Manager().Queue(maxsize=set_up.get('change_extraction_processing', {}).get('db_max_queue_size', 10000))
+        # Create shared queue (Manager queue or direct pipes to the db_writer, see results_transport in setup.yml)
+        shared_queue = create_results_channel(set_up)
         
         # Start shared db_writer
         db_writer_process = mp.Process(
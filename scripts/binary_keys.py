@@ -0,0 +1,93 @@
+import re
+import uuid
+
+"""
+    Binary keys (change_extraction_processing.binary_keys, see sql/binary_keys_functions.sql)
+
+    value_id (statement GUID, e.g. 'Q42$5083e43c-228b-...') and the sha1 hashes are part of the primary keys
+    of the change and feature tables. With binary_keys they are stored as BYTEA instead of TEXT:
+        - value_id: 1 byte tag + 16 bytes of the uuid + entity id of the GUID (19 bytes instead of ~40),
+          values that aren't GUIDs (e.g. 'label') are stored as tag 0 + utf-8 text
+        - hashes: 20 bytes instead of 40 hex characters
+    The encoding is reversible (decode_value_id / decode_hash, or value_id_to_text / hash_to_text in SQL).
+"""
+
+BINARY_KEY_COLUMNS = ['value_id', 'old_hash', 'new_hash', 'value_hash', 'ref_hash']
+
+TAG_TEXT = 0
+TAG_GUID = 1 # lowercase hex
+TAG_GUID_UPPER = 2
+
+GUID_PATTERN = re.compile(r'^([A-Za-z][0-9]+)\$([0-9A-Fa-f]{8}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{12})$')
+HASH_PATTERN = re.compile(r'^[0-9a-f]{40}$')
+BINARY_COLUMN_PATTERN = re.compile(rf"^(\s*)({'|'.join(BINARY_KEY_COLUMNS)}) TEXT\b", re.MULTILINE)
+
+
+def encode_value_id(value_id):
+    if value_id is None:
+        return None
+    match = GUID_PATTERN.match(value_id)
+    if match:
+        entity_id, guid = match.groups()
+        # the same order as value_id_from_text (a GUID without letters is lowercase)
+        if guid == guid.lower():
+            return bytes([TAG_GUID]) + uuid.UUID(guid).bytes + entity_id.encode('utf-8')
+        if guid == guid.upper():
+            return bytes([TAG_GUID_UPPER]) + uuid.UUID(guid).bytes + entity_id.encode('utf-8')
+    return bytes([TAG_TEXT]) + value_id.encode('utf-8')
+
+
+def decode_value_id(data):
+    if data is None:
+        return None
+    data = bytes(data)
+    if data[0] in (TAG_GUID, TAG_GUID_UPPER):
+        guid = str(uuid.UUID(bytes=data[1:17]))
+        return f"{data[17:].decode('utf-8')}${guid.upper() if data[0] == TAG_GUID_UPPER else guid}"
+    return data[1:].decode('utf-8')
+
+
+def encode_hash(value_hash):
+    if value_hash is None:
+        return None
+    if value_hash == '':
+        return b''
+    if not HASH_PATTERN.match(value_hash):
+        raise ValueError(f"'{value_hash}' is not a sha1 hash (40 lowercase hex characters), it can't be stored with binary_keys")
+    return bytes.fromhex(value_hash)
+
+
+def decode_hash(data):
+    if data is None:
+        return None
+    return bytes(data).hex()
+
+
+def encode_binary_keys(rows, columns):
+    """Returns the rows with value_id and the hashes as bytes (rows are returned as they are if the table doesn't have them)"""
+    encoders = [(i, encode_value_id if column == 'value_id' else encode_hash) for i, column in enumerate(columns) if column in BINARY_KEY_COLUMNS]
+    if not encoders:
+        return rows
+
+    encoded_rows = []
+    for row in rows:
+        row = list(row)
+        for i, encode in encoders:
+            row[i] = encode(row[i])
+        encoded_rows.append(tuple(row))
+    return encoded_rows
+
+
+def binary_key_schema(query):
+    """Changes the type of value_id and the hashes from TEXT to BYTEA in the CREATE TABLE statements of query"""
+    return BINARY_COLUMN_PATTERN.sub(r'\1\2 BYTEA', query)
+
+
+def binary_key_select(column):
+    """
+        Select expression of a key column that keeps value_id/hashes in the BYTEA text input format (\\x...),
+        so they can be written to CSV and copied back into a BYTEA column
+    """
+    if column in BINARY_KEY_COLUMNS:
+        return f"'\\x' || encode({column}, 'hex') AS {column}"
+    return column
@@ -0,0 +1,155 @@
+import time
+import json
+import yaml
+import argparse
+import threading
+import traceback
+from pathlib import Path
+
+from scripts.const import SETUP_PATH
+from scripts.sinks import get_db_connection, open_segment
+from scripts.spool_loader import table_load_level
+from scripts.utils import create_db_schema
+
+"""
+    Loads a directory of COPY files into PostgreSQL with parallel connections, e.g. to reload the extracted
+    data into a new DB (after a schema change) without parsing the dumps again.
+
+    The directory has one subdirectory per table with COPY text files (optionally .zst or .gz),
+    like the spool directory of SpoolSink (spool_sink.directory):
+        <directory>/<table_name>/*.copy[.zst|.gz]
+        <directory>/<table_name>/_table.json  (optional, {"columns": [...]}, otherwise the columns of the table are used)
+
+    Files are copied straight into the tables (COPY ... FROM STDIN, no conflict handling), so the tables
+    should be empty. Files are distributed by size across the connections and synchronous_commit is off.
+
+    Usage:
+        python -m scripts.bulk_loader --directory data/spool --connections 8 [--create_schema]
+"""
+
+COPY_FILE_SUFFIXES = ('.copy', '.copy.zst', '.copy.gz')
+
+
+def find_copy_files(directory):
+    """Returns [(table_name, columns, path, size)] of the COPY files in directory"""
+    files = []
+    for table_dir in sorted(Path(directory).iterdir()):
+        if not table_dir.is_dir():
+            continue
+
+        columns = None
+        if (table_dir / '_table.json').exists():
+            with open(table_dir / '_table.json') as f:
+                columns = json.load(f).get('columns')
+
+        for path in sorted(table_dir.iterdir()):
+            if path.name.startswith('.') or not path.name.endswith(COPY_FILE_SUFFIXES):
+                continue
+            files.append((table_dir.name, columns, path, path.stat().st_size))
+    return files
+
+
+def balance_by_size(files, num_connections):
+    """Assigns each file to the connection with less bytes (largest files first)"""
+    assignments = [[] for _ in range(num_connections)]
+    assigned_bytes = [0] * num_connections
+    for file in sorted(files, key=lambda file: file[3], reverse=True):
+        i = assigned_bytes.index(min(assigned_bytes))
+        assignments[i].append(file)
+        assigned_bytes[i] += file[3]
+    return assignments
+
+
+class BulkLoader():
+
+    def __init__(self, set_up, directory, num_connections=4):
+        self.set_up = set_up
+        self.directory = Path(directory)
+        self.num_connections = num_connections
+
+        # {table_name: {'files', 'bytes', 'rows', 'start', 'end'}}
+        self.table_stats = {}
+        self.stats_lock = threading.Lock()
+        self.errors = []
+
+    def _record(self, table_name, size, rows, start, end):
+        with self.stats_lock:
+            stats = self.table_stats.setdefault(table_name, {'files': 0, 'bytes': 0, 'rows': 0, 'start': start, 'end': end})
+            stats['files'] += 1
+            stats['bytes'] += size
+            stats['rows'] += rows
+            stats['start'] = min(stats['start'], start)
+            stats['end'] = max(stats['end'], end)
+
+    def _load_files(self, files):
+        conn = get_db_connection(self.set_up)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SET synchronous_commit TO off")
+            conn.commit()
+
+            for table_name, columns, path, size in files:
+                start = time.time()
+                copy_query = f"COPY {table_name} ({', '.join(columns)}) FROM STDIN" if columns else f"COPY {table_name} FROM STDIN"
+                try:
+                    with conn.cursor() as cursor, open_segment(path) as stream:
+                        cursor.copy_expert(copy_query, stream, size=1024 * 1024)
+                        rows = cursor.rowcount
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    print(f"[BULK_LOADER] COPY failed for {path}: {e}", flush=True)
+                    raise e
+                self._record(table_name, size, rows, start, time.time())
+        except Exception as e:
+            self.errors.append(e)
+            print(traceback.format_exc(), flush=True)
+        finally:
+            conn.close()
+
+    def load(self):
+        files = find_copy_files(self.directory)
+        print(f"[BULK_LOADER] Found {len(files)} files ({sum(file[3] for file in files) / 1024 / 1024:.1f} MB) in {self.directory}, loading with {self.num_connections} connections", flush=True)
+
+        start = time.time()
+        # tables are loaded by level because of the foreign keys (see spool_loader.py)
+        for level in sorted(set(table_load_level(file[0]) for file in files)):
+            level_files = [file for file in files if table_load_level(file[0]) == level]
+            threads = [threading.Thread(target=self._load_files, args=(assigned,))
+                       for assigned in balance_by_size(level_files, self.num_connections) if assigned]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            if self.errors:
+                raise self.errors[0]
+
+        total_time = time.time() - start
+        total_mb = 0
+        for table_name, stats in sorted(self.table_stats.items()):
+            table_mb = stats['bytes'] / 1024 / 1024
+            table_time = stats['end'] - stats['start']
+            total_mb += table_mb
+            print(f"[BULK_LOADER] {table_name}: {stats['files']} files, {stats['rows']} rows, {table_mb:.1f} MB in {table_time:.2f}s "
+                  f"({table_mb / table_time if table_time > 0 else 0:.1f} MB/s)", flush=True)
+        print(f"[BULK_LOADER] Loaded {total_mb:.1f} MB in {total_time:.2f}s ({total_mb / total_time if total_time > 0 else 0:.1f} MB/s)", flush=True)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--directory', type=str, default=None, help='Directory with one subdirectory of COPY files per table (default spool_sink.directory)')
+    parser.add_argument('--connections', type=int, default=4, help='Number of parallel connections')
+    parser.add_argument('--create_schema', action='store_true', help='Create the tables before loading')
+    args = parser.parse_args()
+
+    script_dir = Path(__file__).parent
+    with open(script_dir.parent / Path(SETUP_PATH), 'r') as f:
+        set_up = yaml.safe_load(f)
+
+    if args.create_schema:
+        create_db_schema(set_up)
+
+    directory = args.directory or set_up.get('spool_sink', {}).get('directory', 'data/spool')
+    BulkLoader(set_up, directory, num_connections=args.connections).load()
@@ -0,0 +1,132 @@
+import sys
+import json
+import random
+import argparse
+from pathlib import Path
+
+from scripts.feature_creation import FeatureCreation
+
+"""
+    Regression check of the batch feature functions (create_*_features_batch): on a fixed corpus of (old_value, new_value) pairs,
+    the features of each pair have to be the same (values and types) as the ones of the scalar functions, and pairs
+    where the scalar functions raise an error have to raise an error in the batch functions too.
+
+        python -m scripts.check_batch_features
+
+    The corpus (data/batch_features_corpus.json) has random values (seed 0) and edge cases (signs, exponents,
+    non-finite numbers, some_value/no_value, years out of range, ...). It can be created again with --create_corpus.
+"""
+
+CORPUS_PATH = 'data/batch_features_corpus.json'
+CORPUS_SIZE = 5000 # pairs per datatype
+
+
+def parse_text_value(value):
+    return value
+
+
+def random_quantity(rng):
+    if rng.random() < 0.05:
+        return rng.choice(['+1e5', '+1E-3', '+١٢', '+1_0', ' +3 ', '+0', '-0', '+00012.5000', '+.5', '+5.', '+1e400', '-1e400', '+nan', '+inf', 'abc'])
+    number = rng.choice(['0', '1', '12', '123', '5', '10', '100', str(rng.randint(0, 10 ** rng.randint(1, 20)))])
+    decimals = rng.choice(['', '0', '00', '5', '50', '123', '001', '05', str(rng.randint(0, 10 ** 6))])
+    return rng.choice(['+', '-']) + number + ('.' + decimals if decimals else '')
+
+
+def random_coordinate(rng):
+    if rng.random() < 0.05:
+        return rng.choice([1e-7, -1e-7, 1e22, 5e-324, float('inf'), float('nan'), -0.0, 0, 100, -90, '12.5', ' 3\n'])
+    if rng.random() < 0.15:
+        return rng.randint(-180, 180)
+    return round(rng.uniform(-180, 180), rng.randint(0, 15))
+
+
+def random_time(rng):
+    if rng.random() < 0.03:
+        return rng.choice(['some_value', 'no_value', '+13798000000-00-00T00:00:00Z', '+99999999999999999999-01-01T00:00:00Z', '-99999999999999999-01-01T00:00:00Z'])
+    year = rng.choice(['+2017', '-0050', '+0000', '+1990', '+12017', '-2017', '+2018', '+2016', '+0001', '-0000'])
+    return f"{year}-{rng.choice(['00', '01', '02', '05', '12'])}-{rng.choice(['00', '01', '02', '10', '31'])}T{rng.choice(['00:00:00', '12:30:00'])}Z"
+
+
+def random_text(rng):
+    words = ['human', 'Human', 'female', 'city', 'New York', 'new-york', 'São Paulo', '東京', '', ' ', 'a', 'ab', 'ba', '"quoted"', 'x' * 40]
+    text = ' '.join(rng.choice(words) for _ in range(rng.randint(1, 4)))
+    # text values are serialized (see PageParser.serialize_value)
+    return json.dumps(text, ensure_ascii=False)
+
+
+def create_corpus(seed=0, size=CORPUS_SIZE):
+    rng = random.Random(seed)
+    generators = {
+        'quantity': lambda: random_quantity(rng),
+        'globecoordinate': lambda: {'latitude': random_coordinate(rng), 'longitude': random_coordinate(rng)},
+        'time': lambda: random_time(rng),
+        'text': lambda: random_text(rng),
+    }
+    corpus = {}
+    for datatype, generate in generators.items():
+        old_values = [generate() for _ in range(size)]
+        # some pairs have the same value
+        new_values = [generate() if rng.random() < 0.7 else old_value for old_value in old_values]
+        corpus[datatype] = [[old_value, new_value] for old_value, new_value in zip(old_values, new_values)]
+    return corpus
+
+
+def check_datatype(datatype, pairs):
+    """Returns the number of pairs whose batch features differ from the scalar features"""
+    scalar, batch, parse = {
+        'quantity': (FeatureCreation.create_quantity_features, FeatureCreation.create_quantity_features_batch, FeatureCreation.parse_quantity_value),
+        'globecoordinate': (FeatureCreation.create_globe_coordinate_features, FeatureCreation.create_globe_coordinate_features_batch, FeatureCreation.parse_globe_coordinate_value),
+        'time': (FeatureCreation.create_time_features, FeatureCreation.create_time_features_batch, FeatureCreation.parse_time_value),
+        'text': (lambda old, new: FeatureCreation.create_text_features('text', old, new),
+                 lambda olds, news: FeatureCreation.create_text_features_batch('text', olds, news), parse_text_value),
+    }[datatype]
+
+    valid_pairs = []
+    expected = []
+    failing_pairs = []
+    for old_value, new_value in pairs:
+        try:
+            expected.append(scalar(parse(old_value), parse(new_value)))
+            valid_pairs.append((old_value, new_value))
+        except Exception:
+            failing_pairs.append((old_value, new_value))
+
+    results = batch([old for old, _ in valid_pairs], [new for _, new in valid_pairs])
+
+    mismatches = 0
+    for pair, expected_features, features in zip(valid_pairs, expected, results):
+        # same values and types (e.g. 1 and 1.0 are different features)
+        if tuple(expected_features) != tuple(features) or any(type(e) is not type(f) for e, f in zip(expected_features, features)):
+            if mismatches < 5:
+                print(f'  {datatype} {pair}: expected {expected_features}, got {features}', flush=True)
+            mismatches += 1
+
+    for pair in failing_pairs:
+        try:
+            batch([pair[0]], [pair[1]])
+            print(f'  {datatype} {pair}: the scalar functions raise an error, the batch function does not', flush=True)
+            mismatches += 1
+        except Exception:
+            pass
+
+    print(f'{datatype}: {len(valid_pairs)} pairs, {len(failing_pairs)} pairs that raise an error, {mismatches} mismatches', flush=True)
+    return mismatches
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--create_corpus', action='store_true', help=f'Create {CORPUS_PATH} again (seed 0)')
+    args = parser.parse_args()
+
+    corpus_path = Path(__file__).parent.parent / Path(CORPUS_PATH)
+    if args.create_corpus:
+        with open(corpus_path, 'w') as f:
+            json.dump(create_corpus(), f, ensure_ascii=False)
+
+    with open(corpus_path) as f:
+        corpus = json.load(f)
+
+    mismatches = sum(check_datatype(datatype, pairs) for datatype, pairs in corpus.items())
+    sys.exit(1 if mismatches > 0 else 0)
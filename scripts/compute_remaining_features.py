@@ -1,17 +1,20 @@
 import json
-import psycopg2
 import time
 import yaml
 from pathlib import Path
 import argparse
 
 from scripts.feature_creation import FeatureCreation
+from scripts.parallel_backfill import ParallelBackfill, restart_ranges
+from scripts.sinks import connect_db
 from scripts.const import SETUP_PATH
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--table_suffix', type=str, default='', help='Suffix for table names, can be less, sa, ao or rest')
+    parser.add_argument('--merge_side_tables', action='store_true', help='Replace the feature tables by their views with the side tables (feature_backfill.side_tables) instead of computing the features')
+    parser.add_argument('--restart', action='store_true', help='Process all the rows again instead of continuing after the last key of each backfill (backfill_progress)')
     args = parser.parse_args()
 
     if args.table_suffix not in ['less', 'sa', 'ao', 'rest']:
@@ -29,24 +32,23 @@ if __name__ == "__main__":
     with open(db_config_path) as f:
         db_config = json.load(f)
     
-    conn = psycopg2.connect(
-        dbname=db_config["DB_NAME"],
-        user=db_config["DB_USER"],
-        password=db_config["DB_PASS"],
-        host=db_config["DB_HOST"],
-        port=db_config["DB_PORT"],
-        connect_timeout=30,
-        gssencmode='disable'
-    )
-
-    feature_creator = FeatureCreation(conn)
+    conn = connect_db(db_config)
+
+    feature_creator = FeatureCreation(set_up=set_up, conn=conn)
 
     max_batches = None
-    datatypes = ['entity', 'text']
-    
-    for datatype in datatypes:
+    datatypes = ['entity', 'text', 'quantity', 'time', 'globecoordinate']
 
-        if datatype == 'entity' and set_up.get('update_entity_labels_descriptions', False):
+    if args.merge_side_tables:
+        for datatype in datatypes:
+            feature_creator.merge_side_tables(f'features_{datatype}{table_suffix}')
+    else:
+        if args.restart:
+            feature_creator.restart_backfills(table_suffix)
+            restart_ranges(conn, table_suffix)
+
+        # labels and descriptions are needed by the entity features
+        if set_up.get('update_entity_labels_descriptions', False):
             feature_creator.update_label_description_entity_features(table_suffix)
 
             # set to False so it doesn't updates hte labels and descriptions again
@@ -54,9 +56,16 @@ if __name__ == "__main__":
             with open(script_dir.parent / Path(SETUP_PATH), 'w') as f:
                 yaml.dump(set_up, f)
 
-        start = time.time()
-        feature_creator.create_remaining_features(datatype, table_suffix, max_batches=max_batches)
-        end_time = time.time()
-        print(f"Total time taken for creating remaining features for {datatype} table: {end_time - start} seconds")
+        if set_up.get('feature_backfill', {}).get('num_processes', 1) > 1:
+            # ranges of the feature tables in a pool of processes (see parallel_backfill.py)
+            ParallelBackfill(set_up, db_config, conn).run(table_suffix)
+        else:
+            for datatype in datatypes:
+                start = time.time()
+                feature_creator.create_remaining_features(datatype, table_suffix, max_batches=max_batches)
+                end_time = time.time()
+                print(f"Total time taken for creating remaining features for {datatype} table: {end_time - start} seconds")
+
+            feature_creator.close_encoder()
     
     conn.close()
\ No newline at end of file
@@ -28,6 +28,9 @@ TRANSITIVE_CLOSURE_STATS_PICKLE_FILE_PATH = 'data/transitive_closures/transitive
 
 DATA_PATH = 'data'
 
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+EMBEDDING_STORE_PATH = 'data/embedding_store'
+
 # --------------------------------------------------------------------------------------------------------------
 # PATH TO SUBCLASSES OF ASTRONOMICAL OBJECTS AND SCHOLARLY ARTICLES
 # It is used to identify entities of these types
@@ -314,6 +317,70 @@ GLOBE_FEATURE_COLS = [
 ]
 GLOBE_FEATURE_PK = ['revision_id', 'property_id', 'value_id', 'change_target']
 
+# feature columns calculated by FeatureCreation for each datatype (same order as the feature tuples)
+TIME_ONLY_FEATURES_COLS_TYPES = {
+    'date_diff_days': 'BIGINT',
+    'sign_change': 'INT',
+    'change_one_to_zero': 'INT',
+    'day_added': 'INT',
+    'day_removed': 'INT',
+    'month_added': 'INT',
+    'month_removed': 'INT',
+    'different_year': 'INT',
+    'different_day': 'INT',
+    'different_month': 'INT',
+}
+
+QUANTITY_ONLY_FEATURES_COLS_TYPES = {
+    'sign_change': 'INT',
+    'precision_change': 'INT',
+    'length_increase': 'INT',
+    'length_decrease': 'INT',
+    'whole_number_change': 'INT',
+    'old_is_prefix_of_new': 'INT',
+    'new_is_prefix_of_old': 'INT',
+    'same_float_value': 'INT',
+}
+
+TEXT_ONLY_FEATURES_COLS_TYPES = {
+    'token_overlap': 'FLOAT',
+    'old_in_new': 'INT',
+    'new_in_old': 'INT',
+    'edit_distance_ratio': 'FLOAT',
+    'complete_replacement': 'INT',
+    'length_diff_abs': 'INT',
+    'token_count_old': 'INT',
+    'token_count_new': 'INT',
+    'levenshtein_distance': 'INT',
+    'same_value_without_special_char': 'INT',
+    'special_char_count_diff': 'INT',
+    'char_insertions': 'INT',
+    'char_deletions': 'INT',
+    'char_substitutions': 'INT',
+    'adjacent_char_swap': 'INT',
+    'has_significant_prefix': 'INT',
+    'has_significant_suffix': 'INT',
+}
+
+GLOBE_ONLY_FEATURES_COLS_TYPES = {
+    'latitude_sign_change': 'INT',
+    'longitude_sign_change': 'INT',
+    'latitude_whole_number_change': 'INT',
+    'longitude_whole_number_change': 'INT',
+    'latitude_precision_change': 'INT',
+    'longitude_precision_change': 'INT',
+    'latitude_length_increase': 'INT',
+    'latitude_length_decrease': 'INT',
+    'longitude_length_increase': 'INT',
+    'longitude_length_decrease': 'INT',
+    'latitude_old_is_prefix_of_new': 'INT',
+    'latitude_new_is_prefix_of_old': 'INT',
+    'latitude_same_float_value': 'INT',
+    'longitude_old_is_prefix_of_new': 'INT',
+    'longitude_new_is_prefix_of_old': 'INT',
+    'longitude_same_float_value': 'INT',
+}
+
 TEXT_FEATURE_COLS = [
     'revision_id',
     'property_id',
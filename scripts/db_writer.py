@@ -4,14 +4,102 @@ import time
 import json
 import psycopg2
 import queue
+import threading
 from pathlib import Path
 import gc
 
 from scripts.const import *
-from scripts.utils import insert_rows_copy
+from scripts.sinks import create_sink
+from scripts.utils import extend_rows, estimate_rows_bytes
+from scripts.typed_values import typed_value_columns
+from scripts.transport import PipeResultsChannel, unpack_results_message, get_loaded_pages
 
-def batch_insert(conn, batch, set_up, table_suffix=''):
-    """Function to insert into DB in parallel."""
+
+class AdaptiveBatchPolicy():
+    """
+        Decides when the batch of a table suffix is written, based on the rows (all tables)
+        and the approximate bytes it holds, instead of the number of revisions.
+
+        The target number of rows adapts to the time it takes to write a batch (AIMD):
+            - if a batch took longer than db_batch_target_seconds, the target is halved
+            - if a full batch was written faster, the target grows by db_batch_min_rows
+        The target stays between db_batch_min_rows and db_batch_max_rows, db_batch_max_mb is a hard limit.
+    """
+
+    def __init__(self, set_up):
+        processing = set_up.get('change_extraction_processing', {})
+        self.adaptive = processing.get('db_batch_adaptive', True)
+        self.min_rows = processing.get('db_batch_min_rows', 20000)
+        self.max_rows = processing.get('db_batch_max_rows', 1000000)
+        self.max_bytes = processing.get('db_batch_max_mb', 256) * 1024 * 1024
+        self.target_seconds = processing.get('db_batch_target_seconds', 10)
+        self.max_seconds = processing.get('db_batch_max_seconds', 15)
+
+        if 'db_batch_rows' not in processing and 'db_batch_size' in processing:
+            # setup.yml of an older version: db_batch_size rows per batch, without adaptive sizing (unless it's set)
+            print('db_batch_size is deprecated, use db_batch_rows (see README). Using db_batch_size as the number of rows per batch', flush=True)
+            batch_rows = processing['db_batch_size']
+            self.min_rows = min(self.min_rows, batch_rows)
+            self.adaptive = processing.get('db_batch_adaptive', False)
+        else:
+            batch_rows = processing.get('db_batch_rows', 200000)
+
+        self.target_rows = min(max(batch_rows, self.min_rows), self.max_rows)
+
+        # stats
+        self.num_flushes = 0
+        self.rows_written = 0
+        self.write_time = 0.0
+
+    @staticmethod
+    def tables_size(tables, table_names):
+        """Rows and approximate bytes of the results of one message"""
+        num_rows = 0
+        num_bytes = 0
+        for table_name in table_names:
+            rows = tables.get(table_name)
+            if rows:
+                num_rows += len(rows)
+                num_bytes += estimate_rows_bytes(rows)
+        return num_rows, num_bytes
+
+    def should_flush(self, num_rows, num_bytes, seconds_since_write):
+        if num_rows == 0:
+            return False
+        return (num_rows >= self.target_rows
+                or num_bytes >= self.max_bytes
+                or seconds_since_write > self.max_seconds)
+
+    def record_flush(self, num_rows, num_bytes, seconds):
+        """Updates the target with the time it took to write a batch. Returns the new target"""
+        self.num_flushes += 1
+        self.rows_written += num_rows
+        self.write_time += seconds
+
+        if not self.adaptive:
+            return self.target_rows
+
+        if seconds > self.target_seconds:
+            self.target_rows = max(self.min_rows, int(self.target_rows / 2))
+        elif num_rows >= self.target_rows:
+            # only grow when the batch was limited by the target (not by time or bytes)
+            self.target_rows = min(self.max_rows, self.target_rows + self.min_rows)
+
+        return self.target_rows
+
+    def describe(self, table_suffixes, num_rows, num_bytes, seconds):
+        return (f"Wrote batch ({', '.join(suffix or 'rest' for suffix in table_suffixes)}): {num_rows} rows, {num_bytes / 1024 / 1024:.1f} MB in {seconds:.2f}s "
+                f"({num_rows / seconds if seconds > 0 else 0:.0f} rows/s), next target: {self.target_rows} rows")
+
+    def stats(self):
+        if self.num_flushes == 0:
+            return 'no batches written'
+        return (f'{self.num_flushes} batches, avg {self.rows_written / self.num_flushes:.0f} rows/batch, '
+                f'avg {self.write_time / self.num_flushes:.2f} s/batch, final target: {self.target_rows} rows')
+
+
+def batch_insert(sink, batch, set_up, table_suffix=''):
+    """Function to insert into DB in parallel. sink is one of the sinks in sinks.py (e.g. PostgresSink)"""
 
     change_extraction_filters = set_up.get('change_extraction_filters', {})
     if table_suffix == '_ao':
@@ -30,43 +118,50 @@ def batch_insert(conn, batch, set_up, table_suffix=''):
         extract_features = change_extraction_filters.get('rest', {}).get('feature_extraction', False) # rest is extracted by default
         extract_datatype_metadata_changes = change_extraction_filters.get('rest', {}).get('datatype_metadata_extraction', False)
 
+    value_change_cols, qualifier_change_cols, reference_change_cols = VALUE_CHANGE_COLS, QUALIFIER_CHANGE_COLS, REFERENCE_CHANGE_COLS
+    if set_up.get('change_extraction_processing', {}).get('typed_values', False):
+        # old_value/new_value are stored in typed columns (see typed_values.py)
+        value_change_cols = typed_value_columns(VALUE_CHANGE_COLS)
+        qualifier_change_cols = typed_value_columns(QUALIFIER_CHANGE_COLS)
+        reference_change_cols = typed_value_columns(REFERENCE_CHANGE_COLS)
+
     try:
         if len(batch['revision']) > 0:
-            insert_rows_copy(conn, f'revision{table_suffix}', batch['revision'], REVISION_COLS, REVISION_PK)
+            sink.write(f'revision{table_suffix}', batch['revision'], REVISION_COLS, REVISION_PK)
         
         if len(batch['value_change']) > 0:
-            insert_rows_copy(conn, f'value_change{table_suffix}', batch['value_change'], VALUE_CHANGE_COLS, VALUE_CHANGE_PK)
+            sink.write(f'value_change{table_suffix}', batch['value_change'], value_change_cols, VALUE_CHANGE_PK)
             
         if len(batch['qualifier_change']) > 0:
-            insert_rows_copy(conn, f'qualifier_change{table_suffix}', batch['qualifier_change'], QUALIFIER_CHANGE_COLS, QUALIFIER_CHANGE_PK)
+            sink.write(f'qualifier_change{table_suffix}', batch['qualifier_change'], qualifier_change_cols, QUALIFIER_CHANGE_PK)
         
         if len(batch['reference_change']) > 0:
-            insert_rows_copy(conn, f'reference_change{table_suffix}', batch['reference_change'], REFERENCE_CHANGE_COLS, REFERENCE_CHANGE_PK)
+            sink.write(f'reference_change{table_suffix}', batch['reference_change'], reference_change_cols, REFERENCE_CHANGE_PK)
         
         if extract_datatype_metadata_changes and len(batch['datatype_metadata_change']) > 0:
-            insert_rows_copy(conn, f'datatype_metadata_change{table_suffix}', batch['datatype_metadata_change'], DATATYPE_METADATA_CHANGE_COLS, DATATYPE_METADATA_CHANGE_PK)
+            sink.write(f'datatype_metadata_change{table_suffix}', batch['datatype_metadata_change'], DATATYPE_METADATA_CHANGE_COLS, DATATYPE_METADATA_CHANGE_PK)
         
         if extract_features:
             if len(batch['features_entity']) > 0:
-                insert_rows_copy(conn, f'features_entity{table_suffix}', batch['features_entity'], ENTITY_FEATURE_COLS, ENTITY_FEATURE_PK)
+                sink.write(f'features_entity{table_suffix}', batch['features_entity'], ENTITY_FEATURE_COLS, ENTITY_FEATURE_PK)
         
             if len(batch['features_text']) > 0:
-                insert_rows_copy(conn, f'features_text{table_suffix}', batch['features_text'], TEXT_FEATURE_COLS, TEXT_FEATURE_PK)
+                sink.write(f'features_text{table_suffix}', batch['features_text'], TEXT_FEATURE_COLS, TEXT_FEATURE_PK)
         
             if len(batch['features_time']) > 0:
-                insert_rows_copy(conn, f'features_time{table_suffix}', batch['features_time'], TIME_FEATURE_COLS, TIME_FEATURE_PK)
+                sink.write(f'features_time{table_suffix}', batch['features_time'], TIME_FEATURE_COLS, TIME_FEATURE_PK)
         
             if len(batch['features_globecoordinate']) > 0:
-                insert_rows_copy(conn, f'features_globecoordinate{table_suffix}', batch['features_globecoordinate'], GLOBE_FEATURE_COLS, GLOBE_FEATURE_PK)
+                sink.write(f'features_globecoordinate{table_suffix}', batch['features_globecoordinate'], GLOBE_FEATURE_COLS, GLOBE_FEATURE_PK)
         
             if len(batch['features_quantity']) > 0:
-                insert_rows_copy(conn, f'features_quantity{table_suffix}', batch['features_quantity'], QUANTITY_FEATURE_COLS, QUANTITY_FEATURE_PK)
+                sink.write(f'features_quantity{table_suffix}', batch['features_quantity'], QUANTITY_FEATURE_COLS, QUANTITY_FEATURE_PK)
         
         # if extract_features and len(batch['features_property_replacement']) > 0:
-        #     insert_rows_copy(conn, f'features_property_replacement{table_suffix}', batch['features_property_replacement'], PROPERTY_REPLACEMENT_FEATURE_COLS, PROPERTY_REPLACEMENT_PK)
+        #     sink.write(f'features_property_replacement{table_suffix}', batch['features_property_replacement'], PROPERTY_REPLACEMENT_FEATURE_COLS, PROPERTY_REPLACEMENT_PK)
         
         if len(batch['entity_stats']) > 0:
-            insert_rows_copy(conn, f'entity_stats{table_suffix}', batch['entity_stats'], ENTITY_STATS_COLS, ENTITY_STATS_PK)
+            sink.write(f'entity_stats{table_suffix}', batch['entity_stats'], ENTITY_STATS_COLS, ENTITY_STATS_PK)
 
     except Exception as e:
         print(f'There was an error when batch inserting revisions and changes: {e}', flush=True)
@@ -74,6 +169,106 @@ def batch_insert(conn, batch, set_up, table_suffix=''):
         raise e
 
 
+class BatchFlusher():
+    """
+        Writes the batches of the db_writer with batch_insert.
+
+        With db_async_flush the batches are written by a background thread, so the db_writer
+        keeps receiving results (and filling the next batch) while the previous one is written.
+        At most db_max_in_flight_batches batches wait to be written, flush() blocks when
+        there are more (this bounds the memory of the db_writer).
+        Errors of the background thread are raised in the db_writer on the next flush() or on close().
+
+        With load_manifest, the batches of all the table suffixes are written together (flush_group) and committed
+        in one transaction with the pages they come from (sink.commit_load, see load_manifest.py).
+    """
+
+    def __init__(self, sink, set_up, batch_policy, log):
+        processing = set_up.get('change_extraction_processing', {})
+        self.sink = sink
+        self.set_up = set_up
+        self.batch_policy = batch_policy
+        self.log = log
+        self.async_flush = processing.get('db_async_flush', False)
+        self.max_in_flight = max(1, processing.get('db_max_in_flight_batches', 2))
+        self.load_manifest = processing.get('load_manifest', False)
+        if self.load_manifest and not hasattr(sink, 'commit_load'):
+            raise ValueError(f"load_manifest is only supported by the postgres sink, not by {sink.name}")
+
+        self.error = None
+        self.closed = False
+        self.wait_time = 0.0 # time the db_writer waited for the background thread
+        self._thread = None
+        if self.async_flush:
+            self._pending = queue.Queue(maxsize=self.max_in_flight)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _write(self, batches, loaded_pages=None):
+        """batches is a list of (table_suffix, batch, num_rows, num_bytes)"""
+        write_start = time.time()
+        try:
+            for table_suffix, batch, _, _ in batches:
+                batch_insert(self.sink, batch, self.set_up, table_suffix=table_suffix)
+            if loaded_pages is not None:
+                self.sink.commit_load(loaded_pages)
+        except Exception:
+            if loaded_pages is not None:
+                self.sink.rollback()
+            raise
+        write_time = time.time() - write_start
+
+        num_rows = sum(batch[2] for batch in batches)
+        num_bytes = sum(batch[3] for batch in batches)
+        self.batch_policy.record_flush(num_rows, num_bytes, write_time)
+        self.log(f"[DB_WRITER] {self.batch_policy.describe([batch[0] for batch in batches], num_rows, num_bytes, write_time)}")
+
+    def _run(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # keep draining so flush() and close() don't block, the error is raised by the db_writer
+                continue
+            try:
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def _submit(self, batches, loaded_pages):
+        if not self.async_flush:
+            self._write(batches, loaded_pages)
+            return
+
+        self._raise_error()
+        wait_start = time.time()
+        self._pending.put((batches, loaded_pages))
+        self.wait_time += time.time() - wait_start
+
+    def flush(self, table_suffix, batch, num_rows, num_bytes):
+        """Writes the batch (or queues it with db_async_flush). The batch must not be modified afterwards"""
+        self._submit([(table_suffix, batch, num_rows, num_bytes)], None)
+
+    def flush_group(self, batches, loaded_pages):
+        """Writes the batches and the pages they come from in one transaction (load_manifest)"""
+        self._submit(batches, loaded_pages)
+
+    def close(self):
+        """Waits until all the batches are written"""
+        if self.closed:
+            return
+        self.closed = True
+        if self._thread is not None:
+            self._pending.put(None)
+            self._thread.join()
+        self._raise_error()
+
+
 def db_writer(set_up, num_workers, results_queue):
 
     log_dir = Path('logs')
@@ -88,22 +283,9 @@ def db_writer(set_up, num_workers, results_queue):
 
     log(f"[DB_WRITER] Starting - Num workers: {num_workers}")
 
-    script_dir = Path(__file__).parent
-    with open(script_dir.parent / set_up.get('database_config_path', 'config/db_config.json')) as f:
-        db_config = json.load(f)
-    
-    conn = psycopg2.connect(
-        dbname=db_config["DB_NAME"],
-        user=db_config["DB_USER"],
-        password=db_config["DB_PASS"],
-        host=db_config["DB_HOST"],
-        port=db_config["DB_PORT"],
-        connect_timeout=30,
-        gssencmode='disable',
-        client_encoding='UTF8'
-    )
-
-    log(f"[DB_WRITER] Database connection established")
+    sink = create_sink(set_up)
+
+    log(f"[DB_WRITER] Output sink ({sink.name}) created")
 
     base_table_names = [
         'revision',
@@ -128,14 +310,54 @@ def db_writer(set_up, num_workers, results_queue):
         '_less': {table: [] for table in base_table_names}
     }
 
+    # rows and approximate bytes of each batch, used by the batch policy
+    batch_rows = {suffix: 0 for suffix in batches}
+    batch_bytes = {suffix: 0 for suffix in batches}
+    batch_policy = AdaptiveBatchPolicy(set_up)
+    log(f"[DB_WRITER] Batch target: {batch_policy.target_rows} rows, max {batch_policy.max_bytes / 1024 / 1024:.0f} MB, adaptive: {batch_policy.adaptive}")
+
+    flusher = BatchFlusher(sink, set_up, batch_policy, log)
+    log(f"[DB_WRITER] Async flush: {flusher.async_flush}, max in-flight batches: {flusher.max_in_flight}")
+
+    # pages whose results are in the batches (load_manifest), {file_path: [page_index]}
+    loaded_pages = {}
+
+    def new_batch(table_suffix):
+        # the previous one might still be written by the flusher
+        batches[table_suffix] = {table: [] for table in batches[table_suffix]}
+        batch_rows[table_suffix] = 0
+        batch_bytes[table_suffix] = 0
+
+    def flush_batch(table_suffix):
+        flusher.flush(table_suffix, batches[table_suffix], batch_rows[table_suffix], batch_bytes[table_suffix])
+        new_batch(table_suffix)
+
+    def flush_all():
+        suffixes = [suffix for suffix, batch in batches.items() if any(len(v) > 0 for v in batch.values())]
+        if not flusher.load_manifest:
+            for suffix in suffixes:
+                flush_batch(suffix)
+            return
+
+        if suffixes or loaded_pages:
+            flusher.flush_group([(suffix, batches[suffix], batch_rows[suffix], batch_bytes[suffix]) for suffix in suffixes], dict(loaded_pages))
+            for suffix in suffixes:
+                new_batch(suffix)
+            loaded_pages.clear()
+
     workers_finished = 0
     last_write = time.time()
+    messages_received = 0
+    receive_time = 0.0
 
     try:
         while workers_finished < num_workers:
             try:
 
+                receive_start = time.time()
                 result = results_queue.get(timeout=60)
+                receive_time += time.time() - receive_start
+                messages_received += 1
                 
                 if result is None:
                     # Worker finished
@@ -143,49 +365,38 @@ def db_writer(set_up, num_workers, results_queue):
                     log(f"[DB_WRITER] Worker finished, total finished: {workers_finished}/{num_workers}")
                     continue
 
-                if result['is_scholarly_article']:
-                    table_suffix = '_sa'
-
-                if result['is_astronomical_object']:
-                    table_suffix = '_ao'
-                
-                if not result['is_astronomical_object'] and not result['is_scholarly_article'] and result['has_less_revisions']:
-                    table_suffix = '_less'
-                
-                if not result['is_astronomical_object'] and not result['is_scholarly_article'] and not result['has_less_revisions']:
-                    table_suffix = ''
-                
-                for table_name in base_table_names:
-                    if table_name in batches[table_suffix]:
-                        batches[table_suffix][table_name].extend(result.get(table_name, []))
-                
-                current_batch_size = len(batches[table_suffix]['revision'])
-                time_since_write = time.time() - last_write
-                batch_size = set_up.get('change_extraction_processing', {}).get('db_batch_size', 5000)
-                if len(batches[table_suffix]['revision']) >= batch_size or (time_since_write > 15 and current_batch_size > 0):
+                for file_path, page_indices in get_loaded_pages(result).items():
+                    loaded_pages.setdefault(file_path, []).extend(page_indices)
 
-                    batch_insert(conn, batches[table_suffix], set_up, table_suffix=table_suffix)
+                for table_suffix, tables in unpack_results_message(result):
+                    for table_name in base_table_names:
+                        if table_name in batches[table_suffix]:
+                            batches[table_suffix][table_name] = extend_rows(batches[table_suffix][table_name], tables.get(table_name, []))
 
-                    # Clear this batch
-                    for table in batches[table_suffix]:
-                        batches[table_suffix][table] = []
+                    num_rows, num_bytes = batch_policy.tables_size(tables, batches[table_suffix])
+                    batch_rows[table_suffix] += num_rows
+                    batch_bytes[table_suffix] += num_bytes
 
-                    last_write = time.time()
+                    time_since_write = time.time() - last_write
+                    if batch_policy.should_flush(batch_rows[table_suffix], batch_bytes[table_suffix], time_since_write):
+                        if flusher.load_manifest:
+                            # one transaction with all the pages received
+                            flush_all()
+                        else:
+                            flush_batch(table_suffix)
+                        last_write = time.time()
 
                 gc.collect(generation=0)
                 
             except queue.Empty:
                 log(f"[DB_WRITER] Queue empty timeout - flushing batches")
-                for suffix, batch in batches.items():
-                    if any(len(v) > 0 for v in batch.values()):
-                        batch_insert(conn, batch, set_up, table_suffix=suffix)
-                        for table in batch:
-                            batch[table] = []
+                flush_all()
     
-        for suffix, batch in batches.items():
-            if any(len(v) > 0 for v in batch.values()):
-                batch_insert(conn, batch, set_up, table_suffix=suffix)
+        flush_all()
+        flusher.close()
         
+        log(f"[DB_WRITER] Received {messages_received} messages, avg wait per message: {(receive_time / messages_received * 1000) if messages_received > 0 else 0:.3f} ms")
+        log(f"[DB_WRITER] Batches: {batch_policy.stats()}, waited {flusher.wait_time:.2f}s for the flusher")
         log(f"[DB_WRITER] Completed successfully")
 
     except Exception as e:
@@ -193,10 +404,16 @@ def db_writer(set_up, num_workers, results_queue):
         log(traceback.format_exc())
         raise e
     finally:
-        log(f"[DB_WRITER] Closing connection")
+        log(f"[DB_WRITER] Closing sink")
+        try:
+            flusher.close()
+        except:
+            pass
         try:
-            conn.close()
+            sink.close()
         except:
             pass
+        if isinstance(results_queue, PipeResultsChannel):
+            results_queue.close()
         log(f"[DB_WRITER] Exiting")
         log_file.close()
\ No newline at end of file
@@ -0,0 +1,137 @@
+from psycopg2.extras import execute_values
+
+"""
+    Compact schema (change_extraction_processing.compact_schema, see sql/dimension_schema.sql and sql/compact_change_schema.sql)
+
+    The change tables repeat the same text in every row (property and entity labels, datatypes, action, target,
+    week/year_month/year). With the compact schema, the writer replaces these columns with small integer keys
+    to dimension tables (dictionary encoding) and writes the rows to the <change table>_compact tables.
+    Views with the names and columns of the change tables join the dimensions back, so queries don't change.
+"""
+
+COMPACT_TABLES = ['value_change', 'qualifier_change', 'reference_change', 'datatype_metadata_change']
+TABLE_SUFFIXES = ['', '_sa', '_ao', '_less']
+
+# dimensions with generated keys: (table, key column, value columns)
+DICTIONARY_DIMENSIONS = {
+    'datatype': ('dim_datatype', 'datatype_key', ['datatype']),
+    'action': ('dim_action', 'action_key', ['action', 'target']),
+    'time_bucket': ('dim_time_bucket', 'time_bucket_key', ['week', 'year_month', 'year']),
+}
+
+# columns of the change tables replaced by a key: (key column, dimension, columns with the value)
+ENCODED_COLUMNS = [
+    ('old_datatype_key', 'datatype', ['old_datatype']),
+    ('new_datatype_key', 'datatype', ['new_datatype']),
+    ('action_key', 'action', ['action', 'target']),
+    ('time_bucket_key', 'time_bucket', ['week', 'year_month', 'year']),
+]
+
+# labels stored in dim_property / dim_entity, the rows keep the ids: {label column: id column}
+PROPERTY_LABEL_COLUMNS = {'property_label': 'property_id', 'qual_property_label': 'qual_property_id', 'ref_property_label': 'ref_property_id'}
+ENTITY_LABEL_COLUMNS = {'entity_label': 'entity_id'}
+
+DROPPED_COLUMNS = set(PROPERTY_LABEL_COLUMNS) | set(ENTITY_LABEL_COLUMNS) | set(column for _, _, value_columns in ENCODED_COLUMNS for column in value_columns)
+
+
+def compact_table_name(table_name):
+    """value_change_sa -> value_change_compact_sa. None if the table doesn't have a compact version"""
+    for base_table in COMPACT_TABLES:
+        suffix = table_name[len(base_table):]
+        if table_name.startswith(base_table) and suffix in TABLE_SUFFIXES:
+            return f'{base_table}_compact{suffix}'
+    return None
+
+
+class DimensionEncoder():
+    """
+        Dictionary encoding of the rows of the change tables.
+        Keys are cached and new values are added to the dimension tables with conn,
+        which should be in autocommit mode (dimension rows are shared by all the writers,
+        so they aren't kept locked until the batch is committed).
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.keys = {dimension: {} for dimension in DICTIONARY_DIMENSIONS}
+        self.properties = {} # {property_id: property_label} stored in dim_property
+
+    def _load_keys(self, dimension):
+        table, key_column, value_columns = DICTIONARY_DIMENSIONS[dimension]
+        with self.conn.cursor() as cursor:
+            cursor.execute(f"SELECT {key_column}, {', '.join(value_columns)} FROM {table}")
+            for row in cursor.fetchall():
+                self.keys[dimension][tuple(row[1:])] = row[0]
+
+    def _add_values(self, dimension, values):
+        """Makes sure the values (tuples) have a key"""
+        missing = [value for value in values if value not in self.keys[dimension] and any(v is not None for v in value)]
+        if not missing:
+            return
+
+        # values added by other writers (only the values that are really new are inserted,
+        # since ON CONFLICT still uses a value of the identity sequence)
+        self._load_keys(dimension)
+        missing = [value for value in missing if value not in self.keys[dimension]]
+        if not missing:
+            return
+
+        table, _, value_columns = DICTIONARY_DIMENSIONS[dimension]
+        with self.conn.cursor() as cursor:
+            execute_values(cursor, f"INSERT INTO {table} ({', '.join(value_columns)}) VALUES %s ON CONFLICT DO NOTHING", sorted(missing, key=str))
+        self._load_keys(dimension)
+
+    def _add_properties(self, properties):
+        new_properties = sorted((property_id, label) for property_id, label in properties.items() if self.properties.get(property_id) != label)
+        if not new_properties:
+            return
+        with self.conn.cursor() as cursor:
+            execute_values(cursor, """
+                INSERT INTO dim_property (property_id, property_label) VALUES %s
+                ON CONFLICT (property_id) DO UPDATE SET property_label = EXCLUDED.property_label
+                WHERE dim_property.property_label IS DISTINCT FROM EXCLUDED.property_label
+            """, new_properties)
+        self.properties.update(new_properties)
+
+    def _add_entities(self, entities):
+        # entities aren't cached (there are too many of them and each one is usually in a single batch)
+        if not entities:
+            return
+        with self.conn.cursor() as cursor:
+            execute_values(cursor, """
+                INSERT INTO dim_entity (entity_id, entity_label) VALUES %s
+                ON CONFLICT (entity_id) DO UPDATE SET entity_label = EXCLUDED.entity_label
+                WHERE dim_entity.entity_label IS DISTINCT FROM EXCLUDED.entity_label
+            """, sorted(entities.items()))
+
+    def encode(self, rows, columns):
+        """Returns (rows, columns) of the compact table"""
+        index = {column: i for i, column in enumerate(columns)}
+        kept = [i for i, column in enumerate(columns) if column not in DROPPED_COLUMNS]
+        encoded = [(key_column, dimension, [index[column] for column in value_columns])
+                   for key_column, dimension, value_columns in ENCODED_COLUMNS if all(column in index for column in value_columns)]
+
+        for _, dimension, value_idx in encoded:
+            self._add_values(dimension, set(tuple(row[i] for i in value_idx) for row in rows))
+
+        properties = {}
+        for label_column, id_column in PROPERTY_LABEL_COLUMNS.items():
+            if label_column in index:
+                label_idx, id_idx = index[label_column], index[id_column]
+                properties.update((row[id_idx], row[label_idx]) for row in rows)
+        self._add_properties(properties)
+
+        entities = {}
+        for label_column, id_column in ENTITY_LABEL_COLUMNS.items():
+            if label_column in index:
+                label_idx, id_idx = index[label_column], index[id_column]
+                entities.update((row[id_idx], row[label_idx]) for row in rows)
+        self._add_entities(entities)
+
+        keys = [(self.keys[dimension], value_idx) for _, dimension, value_idx in encoded]
+        compact_rows = [
+            tuple(row[i] for i in kept) + tuple(dimension_keys.get(tuple(row[i] for i in value_idx)) for dimension_keys, value_idx in keys)
+            for row in rows
+        ]
+        compact_columns = [columns[i] for i in kept] + [key_column for key_column, _, _ in encoded]
+        return compact_rows, compact_columns
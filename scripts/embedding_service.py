@@ -0,0 +1,215 @@
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+import yaml
+import numpy as np
+from pathlib import Path
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+from scripts.const import SETUP_PATH, EMBEDDING_STORE_PATH
+from scripts.embedding_store import EmbeddingStore, encode_unique
+
+"""
+    Embedding service (embedding_service in setup.yml)
+
+    Each compute_remaining_features.py run (one per table suffix) loads its own copy of the model.
+    The service is a process that loads the encoder once (see encoders.py) and encodes the texts of all the runs:
+
+        python -m scripts.embedding_service
+
+    Runs with embedding_service.enabled send their texts over a Unix socket (EmbeddingServiceClient, used like the model).
+    The requests received within max_wait_ms are merged into one batch (up to max_batch_texts texts), the repeated
+    texts are encoded once and the embeddings are read from / added to the embedding store of the service,
+    so runs of the different suffixes share the model, the cores and the cache.
+    The socket is only accessible by the user that started the service (the authkey is in <socket_path>.key).
+"""
+
+DEFAULT_SOCKET_PATH = '/tmp/wd_embedding_service.sock'
+
+
+def read_authkey(socket_path):
+    with open(f'{socket_path}.key', 'rb') as f:
+        return f.read()
+
+
+class EmbeddingServiceClient():
+    """Sends the texts to the embedding service, has the same encode arguments as SentenceTransformer"""
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, max_request_texts=4096, connect_timeout=120):
+        self.socket_path = socket_path
+        self.max_request_texts = max_request_texts
+
+        # the service might be starting
+        start = time.time()
+        while True:
+            try:
+                self.conn = Client(socket_path, family='AF_UNIX', authkey=read_authkey(socket_path))
+                break
+            except (FileNotFoundError, ConnectionRefusedError, AuthenticationError):
+                # AuthenticationError: key of a previous service that was read before the service wrote its key
+                if time.time() - start > connect_timeout:
+                    raise
+                time.sleep(0.5)
+
+    def encode(self, texts, device=None, show_progress_bar=False, batch_size=None):
+        """Embeddings of texts (device and batch_size are set by the service)"""
+        texts = list(texts)
+        embeddings = []
+        for start in range(0, len(texts), self.max_request_texts):
+            self.conn.send(texts[start:start + self.max_request_texts])
+            response = self.conn.recv()
+            if isinstance(response, Exception):
+                raise response
+            embeddings.append(response)
+        if len(embeddings) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.concatenate(embeddings)
+
+    def close(self):
+        self.conn.close()
+
+
+class EmbeddingService():
+    """Micro-batches the requests of the clients (see the docstring of the module)"""
+
+    def __init__(self, set_up):
+        # imported here so the clients don't need the encoder libraries
+        from scripts.encoders import create_encoder, encoder_name
+
+        config = set_up.get('embedding_service', {})
+        self.socket_path = config.get('socket_path', DEFAULT_SOCKET_PATH)
+        self.max_batch_texts = config.get('max_batch_texts', 4096)
+        self.max_wait = config.get('max_wait_ms', 20) / 1000
+
+        self.model = create_encoder(set_up, use_service=False)
+        store_config = set_up.get('embedding_store', {})
+        self.store = None
+        if store_config.get('enabled', False):
+            self.store = EmbeddingStore(store_config.get('directory', EMBEDDING_STORE_PATH), encoder_name(set_up))
+        self.device = 'cpu'
+        try:
+            import torch
+            self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        except ImportError:
+            pass
+
+        self.requests = queue.Queue() # (conn, texts)
+        self._closed = False
+
+        # STATS
+        self.num_batches = 0
+        self.num_requests = 0
+        self.num_texts = 0
+
+    def serve(self):
+        authkey = os.urandom(16)
+        if os.path.exists(self.socket_path):
+            # socket of a service that didn't stop cleanly
+            os.remove(self.socket_path)
+        # the key is written before the socket is bound, so clients can't connect with the key of a previous service
+        key_path = f'{self.socket_path}.key'
+        with open(os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+            f.write(authkey)
+        listener = Listener(self.socket_path, family='AF_UNIX', authkey=authkey, backlog=64)
+        os.chmod(self.socket_path, 0o600)
+
+        threading.Thread(target=self._accept_connections, args=(listener,), daemon=True).start()
+        print(f'[EMBEDDING_SERVICE] Listening on {self.socket_path}', flush=True)
+
+        try:
+            while True:
+                self._encode_batch()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._closed = True
+            listener.close()
+            if os.path.exists(key_path):
+                os.remove(key_path)
+            print(f'[EMBEDDING_SERVICE] Stopped. {self.stats()}', flush=True)
+
+    def _accept_connections(self, listener):
+        while not self._closed:
+            try:
+                conn = listener.accept()
+            except Exception:
+                if self._closed:
+                    break
+                continue
+            threading.Thread(target=self._receive_requests, args=(conn,), daemon=True).start()
+
+    def _receive_requests(self, conn):
+        """One thread per client: the client waits for the response of a request before sending the next one"""
+        while True:
+            try:
+                texts = conn.recv()
+            except (EOFError, OSError):
+                conn.close()
+                return
+            self.requests.put((conn, texts))
+
+    def _encode_batch(self):
+        """Encodes the requests received within max_wait (or until max_batch_texts) and sends the responses"""
+        try:
+            batch = [self.requests.get(timeout=1)]
+        except queue.Empty:
+            return
+
+        num_texts = len(batch[0][1])
+        deadline = time.time() + self.max_wait
+        while num_texts < self.max_batch_texts:
+            try:
+                request = self.requests.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            batch.append(request)
+            num_texts += len(request[1])
+
+        texts = [text for _, request_texts in batch for text in request_texts]
+        try:
+            embeddings = encode_unique(texts, lambda unique_texts: self.model.encode(unique_texts, device=self.device, show_progress_bar=False), self.store)
+        except Exception as e:
+            print(f'[EMBEDDING_SERVICE] Error encoding a batch: {e}', flush=True)
+            embeddings = e
+
+        start = 0
+        for conn, request_texts in batch:
+            response = embeddings if isinstance(embeddings, Exception) else embeddings[start:start + len(request_texts)]
+            start += len(request_texts)
+            try:
+                conn.send(response)
+            except OSError:
+                # the client stopped
+                pass
+
+        self.num_batches += 1
+        self.num_requests += len(batch)
+        self.num_texts += len(texts)
+        if self.num_batches % 100 == 0:
+            print(f'[EMBEDDING_SERVICE] {self.stats()}', flush=True)
+
+    def stats(self):
+        return (f'{self.num_batches} batches, {self.num_requests} requests, {self.num_texts} texts '
+                f'(avg {self.num_texts / self.num_batches if self.num_batches > 0 else 0:.0f} texts/batch), '
+                f'store: {self.store.stats() if self.store is not None else "disabled"}')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket_path', type=str, default=None, help='Unix socket of the service (default: embedding_service.socket_path of setup.yml)')
+    args = parser.parse_args()
+
+    script_dir = Path(__file__).parent
+    with open(script_dir.parent / Path(SETUP_PATH), 'r') as f:
+        set_up = yaml.safe_load(f)
+
+    if args.socket_path:
+        set_up.setdefault('embedding_service', {})['socket_path'] = args.socket_path
+
+    EmbeddingService(set_up).serve()
+    sys.exit(0)
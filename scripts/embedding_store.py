@@ -0,0 +1,180 @@
+import os
+import json
+import fcntl
+import hashlib
+import numpy as np
+
+"""
+    Embedding store (embedding_store in setup.yml)
+
+    The same labels, descriptions and texts (e.g. "human", "female") are in millions of feature rows,
+    so their embeddings are stored on disk the first time they are encoded and read back in the next batches and runs.
+    The store of a model is a directory with:
+        - embeddings.f16: float16 matrix (one row per string), read as a memory map
+        - hashes.bin: 16 byte blake2b hash of each string (same order as the rows), loaded into a dict {hash: row}
+        - meta.json: model name and embedding dimension
+    Rows are only appended, under a file lock, so several compute_remaining_features processes can share a store.
+    The rows are written before their hashes, so a row is only used once its hash is in hashes.bin.
+"""
+
+HASH_SIZE = 16
+EMBEDDING_DTYPE = np.float16
+
+
+def text_hash(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=HASH_SIZE).digest()
+
+
+def cosine_similarities(old_embeddings, new_embeddings):
+    """
+        Cosine similarity of each row of old_embeddings with the same row of new_embeddings
+        (same as sklearn's cosine_similarity of each pair, 0 if one of them is a zero vector)
+    """
+    old_embeddings = np.asarray(old_embeddings, dtype=np.float32)
+    new_embeddings = np.asarray(new_embeddings, dtype=np.float32)
+    if len(old_embeddings) == 0:
+        return np.zeros(0, dtype=np.float32)
+
+    old_norms = np.linalg.norm(old_embeddings, axis=1)
+    new_norms = np.linalg.norm(new_embeddings, axis=1)
+    old_norms[old_norms == 0] = 1
+    new_norms[new_norms == 0] = 1
+    return np.einsum('ij,ij->i', old_embeddings / old_norms[:, None], new_embeddings / new_norms[:, None])
+
+
+def encode_unique(texts, encode, store=None):
+    """
+        Embeddings (float32, one row per text) of texts. Each distinct string is encoded once with encode(list of strings),
+        and with a store, only the strings that aren't stored yet are encoded
+    """
+    unique_texts = list(dict.fromkeys(texts))
+    if store is not None:
+        unique_embeddings = store.get_embeddings(unique_texts, encode)
+    elif len(unique_texts) > 0:
+        unique_embeddings = np.asarray(encode(unique_texts), dtype=np.float32)
+    else:
+        unique_embeddings = np.zeros((0, 0), dtype=np.float32)
+
+    rows = {text: i for i, text in enumerate(unique_texts)}
+    return unique_embeddings[[rows[text] for text in texts]] if len(texts) > 0 else unique_embeddings
+
+
+class EmbeddingStore():
+    """Embeddings of strings of one model stored in <directory>/<model_name> (see the docstring of the module)"""
+
+    def __init__(self, directory, model_name):
+        self.directory = os.path.join(directory, model_name.replace('/', '_'))
+        os.makedirs(self.directory, exist_ok=True)
+        self.model_name = model_name
+
+        self.embeddings_path = os.path.join(self.directory, 'embeddings.f16')
+        self.hashes_path = os.path.join(self.directory, 'hashes.bin')
+        self.meta_path = os.path.join(self.directory, 'meta.json')
+        self.lock_path = os.path.join(self.directory, 'lock')
+
+        self.dim = None
+        self.index = {} # {hash: row}
+        self.num_rows = 0
+        self.embeddings = None # memory map of the rows in index
+
+        # STATS
+        self.hits = 0
+        self.misses = 0
+
+        with self._lock():
+            self._load()
+
+    def _lock(self):
+        return _FileLock(self.lock_path)
+
+    def _load(self):
+        """Reads the rows added since the last call (by this or other processes). Has to be called with the lock"""
+        if self.dim is None:
+            if not os.path.exists(self.meta_path):
+                return
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            if meta['model_name'] != self.model_name:
+                raise ValueError(f"Embedding store {self.directory} has embeddings of {meta['model_name']}, not {self.model_name}")
+            self.dim = meta['dim']
+
+        num_rows = os.path.getsize(self.hashes_path) // HASH_SIZE if os.path.exists(self.hashes_path) else 0
+        if num_rows == self.num_rows:
+            return
+
+        with open(self.hashes_path, 'rb') as f:
+            f.seek(self.num_rows * HASH_SIZE)
+            data = f.read((num_rows - self.num_rows) * HASH_SIZE)
+        for row, i in enumerate(range(0, len(data), HASH_SIZE), start=self.num_rows):
+            self.index.setdefault(data[i:i + HASH_SIZE], row)
+        self.num_rows = num_rows
+
+        self.embeddings = np.memmap(self.embeddings_path, dtype=EMBEDDING_DTYPE, mode='r', shape=(num_rows, self.dim))
+
+    def _append(self, hashes, embeddings):
+        """Adds the rows of the hashes that aren't stored yet. Has to be called with the lock"""
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+            with open(self.meta_path, 'w') as f:
+                json.dump({'model_name': self.model_name, 'dim': self.dim}, f)
+
+        new_rows = [i for i, h in enumerate(hashes) if h not in self.index]
+        if not new_rows:
+            return
+
+        with open(self.embeddings_path, 'ab') as f:
+            # rows of a process that stopped before writing their hashes
+            f.truncate(self.num_rows * self.dim * np.dtype(EMBEDDING_DTYPE).itemsize)
+            f.write(np.ascontiguousarray(embeddings[new_rows], dtype=EMBEDDING_DTYPE).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.hashes_path, 'ab') as f:
+            # partial hash of a process that stopped while writing its hashes
+            f.truncate(self.num_rows * HASH_SIZE)
+            f.write(b''.join(hashes[i] for i in new_rows))
+
+        self._load()
+
+    def get_embeddings(self, texts, encode):
+        """
+            Embeddings (float32) of the (distinct) texts, the ones that aren't stored are encoded with encode(list of strings) and added.
+            Embeddings are always read back from the store (float16), so they don't depend on whether a string was already stored
+        """
+        hashes = [text_hash(text) for text in texts]
+        missing = [i for i, h in enumerate(hashes) if h not in self.index]
+
+        if missing:
+            # encoded without the lock (other processes can add the same strings, _append skips them)
+            embeddings = np.asarray(encode([texts[i] for i in missing]), dtype=np.float32)
+            with self._lock():
+                # rows added by other processes
+                self._load()
+                self._append([hashes[i] for i in missing], embeddings)
+
+        self.misses += len(missing)
+        self.hits += len(texts) - len(missing)
+
+        if len(texts) == 0:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return np.asarray(self.embeddings[[self.index[h] for h in hashes]], dtype=np.float32)
+
+    def stats(self):
+        return f"{self.num_rows} stored strings, {self.hits} hits, {self.misses} encoded"
+
+
+class _FileLock():
+    """Exclusive lock of a file (fcntl), used with 'with'"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
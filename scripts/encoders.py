@@ -0,0 +1,169 @@
+import os
+import math
+import multiprocessing as mp
+import numpy as np
+
+from scripts.const import EMBEDDING_MODEL_NAME
+
+"""
+    Encoders of the embedding features (embedding_encoder in setup.yml)
+
+    create_embedding_features only calls model.encode(texts, device=..., show_progress_bar=..., batch_size=...),
+    so the SentenceTransformer can be replaced by a SentenceEncoder, which runs the same model:
+        - backend: torch (SentenceTransformer as it is) or onnx (ONNX Runtime, e.g. an int8 quantized export
+          of the model, onnx/model_quint8_avx2.onnx of the Hugging Face repo of all-MiniLM-L6-v2)
+        - num_processes: processes that encode in parallel (spawned, each one loads the model once)
+        - threads_per_process: threads of torch / ONNX Runtime in each process (so the processes don't compete for the cores)
+        - texts are sorted by length and split in chunks of similar length, so batches don't pad short texts to the longest one
+    Before the first batch, the encoder is compared with the reference (SentenceTransformer with torch) on the first texts:
+    the cosine similarity of each pair of embeddings has to be at least min_cosine_similarity.
+"""
+
+# config and model of the encoder processes
+_process_config = None
+_process_model = None
+
+
+def load_model(config):
+    """SentenceTransformer with the backend of config (same model as the reference)"""
+    from sentence_transformers import SentenceTransformer
+
+    threads = config.get('threads_per_process', 0)
+    if threads > 0:
+        import torch
+        torch.set_num_threads(threads)
+
+    if config.get('backend', 'torch') == 'onnx':
+        model_kwargs = {'file_name': config.get('onnx_file_name', 'onnx/model_quint8_avx2.onnx'), 'provider': 'CPUExecutionProvider'}
+        if threads > 0:
+            import onnxruntime
+            session_options = onnxruntime.SessionOptions()
+            session_options.intra_op_num_threads = threads
+            session_options.inter_op_num_threads = 1
+            model_kwargs['session_options'] = session_options
+        return SentenceTransformer(EMBEDDING_MODEL_NAME, backend='onnx', model_kwargs=model_kwargs)
+
+    return SentenceTransformer(EMBEDDING_MODEL_NAME)
+
+
+def _init_process(config):
+    global _process_config
+    threads = config.get('threads_per_process', 0)
+    if threads > 0:
+        # before the libraries start their thread pools
+        for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+            os.environ[var] = str(threads)
+    _process_config = config
+
+
+def _encode_chunk(args):
+    global _process_model
+    texts, batch_size = args
+    if _process_model is None:
+        # loaded with the first chunk (errors of the initializer would make the pool start new processes forever)
+        _process_model = load_model(_process_config)
+    return _process_model.encode(texts, batch_size=batch_size, device='cpu', show_progress_bar=False, convert_to_numpy=True)
+
+
+def encoder_name(set_up):
+    """Name of the encoder (the embedding store keeps the embeddings of each encoder apart)"""
+    config = set_up.get('embedding_encoder', {})
+    if config.get('backend', 'torch') == 'onnx':
+        file_name = config.get('onnx_file_name', 'onnx/model_quint8_avx2.onnx')
+        return f"{EMBEDDING_MODEL_NAME}_{os.path.splitext(os.path.basename(file_name))[0]}"
+    return EMBEDDING_MODEL_NAME
+
+
+def create_encoder(set_up, use_service=True):
+    """
+        Model used by create_embedding_features: the SentenceTransformer as it was (default),
+        a SentenceEncoder with the options of embedding_encoder
+        or a client of the embedding service (embedding_service.enabled, see embedding_service.py)
+    """
+    service_config = set_up.get('embedding_service', {})
+    if use_service and service_config.get('enabled', False):
+        from scripts.embedding_service import EmbeddingServiceClient, DEFAULT_SOCKET_PATH
+        return EmbeddingServiceClient(service_config.get('socket_path', DEFAULT_SOCKET_PATH), service_config.get('max_request_texts', 4096))
+
+    from sentence_transformers import SentenceTransformer
+
+    config = set_up.get('embedding_encoder', {})
+    if config.get('backend', 'torch') == 'torch' and config.get('num_processes', 1) <= 1 and config.get('threads_per_process', 0) <= 0:
+        return SentenceTransformer(EMBEDDING_MODEL_NAME)
+    return SentenceEncoder(config)
+
+
+def close_encoder(model):
+    """Stops the processes of a SentenceEncoder / closes the connection to the embedding service"""
+    from scripts.embedding_service import EmbeddingServiceClient
+    if isinstance(model, (SentenceEncoder, EmbeddingServiceClient)):
+        model.close()
+
+
+class SentenceEncoder():
+    """Encodes texts with the backend, processes and threads of config (see the docstring of the module)"""
+
+    def __init__(self, config):
+        self.config = config
+        self.num_processes = config.get('num_processes', 1)
+        self.batch_size = config.get('batch_size', 128)
+        self.chunk_size = config.get('chunk_size', 4096)
+        self.min_cosine_similarity = config.get('min_cosine_similarity', 0.99)
+        self.validation_size = config.get('validation_size', 512)
+        # the torch backend is the reference encoder
+        self.validated = self.min_cosine_similarity <= 0 or config.get('backend', 'torch') == 'torch'
+
+        if self.num_processes > 1:
+            # spawn: the processes don't inherit the thread pools of torch
+            self.pool = mp.get_context('spawn').Pool(self.num_processes, initializer=_init_process, initargs=(config,))
+            self.model = None
+        else:
+            self.pool = None
+            self.model = load_model(config)
+
+    def validate(self, texts):
+        """Compares the embeddings of texts with the ones of the reference encoder"""
+        from sentence_transformers import SentenceTransformer
+
+        texts = [text for text in dict.fromkeys(texts)][:self.validation_size]
+        if len(texts) == 0:
+            return
+
+        reference = SentenceTransformer(EMBEDDING_MODEL_NAME).encode(texts, device='cpu', show_progress_bar=False, convert_to_numpy=True)
+        embeddings = self._encode(texts, self.batch_size)
+
+        similarities = np.einsum('ij,ij->i', reference, embeddings) / (np.linalg.norm(reference, axis=1) * np.linalg.norm(embeddings, axis=1)).clip(min=1e-12)
+        print(f'Encoder {self.config.get("backend", "torch")}: cosine similarity with the reference encoder on {len(texts)} texts: '
+              f'min {similarities.min():.4f}, mean {similarities.mean():.4f}', flush=True)
+        if similarities.min() < self.min_cosine_similarity:
+            raise ValueError(f'The embeddings of the encoder differ from the reference encoder (minimum cosine similarity {similarities.min():.4f} < {self.min_cosine_similarity})')
+        self.validated = True
+
+    def _encode(self, texts, batch_size):
+        if self.pool is None:
+            return self.model.encode(texts, batch_size=batch_size, device='cpu', show_progress_bar=False, convert_to_numpy=True)
+
+        # texts of similar length in each chunk
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        chunk_size = max(1, min(self.chunk_size, math.ceil(len(texts) / self.num_processes)))
+        chunks = [[texts[i] for i in order[start:start + chunk_size]] for start in range(0, len(order), chunk_size)]
+
+        embeddings = np.concatenate(self.pool.map(_encode_chunk, [(chunk, batch_size) for chunk in chunks]))
+        result = np.empty_like(embeddings)
+        result[order] = embeddings
+        return result
+
+    def encode(self, texts, device=None, show_progress_bar=False, batch_size=None):
+        """Same arguments as SentenceTransformer.encode (the encoder runs on CPU, device is ignored)"""
+        texts = list(texts)
+        if not self.validated:
+            self.validate(texts)
+        if len(texts) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        return self._encode(texts, batch_size or self.batch_size)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
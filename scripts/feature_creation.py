@@ -1,6 +1,8 @@
 import csv
 import re
-from Levenshtein import distance as levenshtein_distance
+from Levenshtein import distance as levenshtein_distance, editops
+from rapidfuzz.distance import Levenshtein as rapidfuzz_levenshtein
+from rapidfuzz.process import cpdist
 import pandas as pd
 import os
 import json
@@ -9,22 +11,297 @@ import math
 import time
 from collections import defaultdict
 from datetime import datetime, timedelta
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
 import torch
 import re
 import io
 
 from scripts.transitive_closure_cache import TransitiveClosureCache
-from scripts.utils import query_to_df
 from scripts.const import *
 from scripts.utils import get_time_unit
+from scripts.binary_keys import binary_key_select, BINARY_KEY_COLUMNS
+from scripts.embedding_store import EmbeddingStore, encode_unique, cosine_similarities
+from scripts.encoders import create_encoder, encoder_name, close_encoder
+
+# strings that json.dumps only puts between quotes (nothing to escape)
+SIMPLE_STRING_PATTERN = re.compile(r'^[^"\\\x00-\x1f]*$')
+# numbers the batch features calculate with NumPy (the rest use the scalar functions)
+PLAIN_NUMBER_PATTERN = re.compile(r'^-?[0-9]+(\.[0-9]+)?$')
+MAX_BATCH_YEAR = 2 ** 53
+# time values as they're in the dumps (e.g. +2017-09-01T00:00:00Z), parsed without cleaning the string
+CANONICAL_TIME_PATTERN = re.compile(r'^([+-])([0-9]+)-([0-9]{2})-([0-9]{2})T[0-9]{2}:[0-9]{2}:[0-9]{2}Z$')
+SPECIAL_CHAR_PATTERN = re.compile(r'[^a-zA-Z0-9]')
+# size of the edit operations table (without the common prefix and suffix) calculated in pure Python / with NumPy,
+# bigger tables use Levenshtein.editops
+MAX_PYTHON_EDIT_CELLS = 256
+MAX_EDIT_OPERATIONS_CELLS = 5_000_000
+# side tables of the backfills (feature_backfill.side_tables): create_all_features_batch, create_and_update_embedding_features
+# and create_all_features_entity
+SIDE_TABLES = ['batch_features', 'embedding_features', 'entity_features']
 
 class FeatureCreation():
 
     def __init__(self, set_up=None, conn=None):
         self.conn = conn
         self.set_up = set_up
+        # value_id is BYTEA (see binary_keys.py)
+        self.binary_keys = (set_up or {}).get('change_extraction_processing', {}).get('binary_keys', False)
+        # old_value/new_value of value_change are in typed columns (see typed_values.py)
+        self.typed_values = (set_up or {}).get('change_extraction_processing', {}).get('typed_values', False)
+        # embeddings of the strings already encoded (see embedding_store.py), opened by the first create_embedding_features
+        self.embedding_store_config = (set_up or {}).get('embedding_store', {})
+        self.embedding_store = None
+        # encoder of the embedding features, loaded by the first backfill that needs it (see get_encoder)
+        self.encoder = None
+        # backfills write their results to side tables instead of updating the feature tables
+        self.side_tables = (set_up or {}).get('feature_backfill', {}).get('side_tables', False)
+        # the text, quantity, time and globecoordinate features (calculated during change extraction) are calculated again
+        self.recompute_extracted_features = (set_up or {}).get('feature_backfill', {}).get('recompute_extracted_features', False)
+
+    def get_key_cols_str(self, key_cols):
+        if self.binary_keys:
+            return ', '.join(binary_key_select(col) for col in key_cols)
+        return ', '.join(key_cols)
+
+    def get_embedding_store(self):
+        if (self.set_up or {}).get('embedding_service', {}).get('enabled', False):
+            # the embedding service has the store
+            return None
+        if self.embedding_store is None and self.embedding_store_config.get('enabled', False):
+            self.embedding_store = EmbeddingStore(self.embedding_store_config.get('directory', EMBEDDING_STORE_PATH), encoder_name(self.set_up or {}))
+        return self.embedding_store
+
+    def get_encoder(self):
+        # loaded once, parallel_backfill.py runs the backfills of several ranges with the same FeatureCreation
+        if self.encoder is None:
+            self.encoder = create_encoder(self.set_up or {})
+        return self.encoder
+
+    def close_encoder(self):
+        """Stops the processes of the encoder / closes the connection to the embedding service (see encoders.close_encoder)"""
+        if self.encoder is not None:
+            close_encoder(self.encoder)
+            self.encoder = None
+
+    def get_key_cols_temp(self):
+        return ', '.join([f"{col} {'BYTEA' if self.binary_keys and col in BINARY_KEY_COLUMNS else col_type}" for col, col_type in BASE_KEY_TYPES.items()])
+
+    ####################
+    # Backfill progress
+    ####################
+    # The backfills read the rows of a feature table in primary key order, one batch at a time after the last key
+    # of the previous batch (keyset pagination), so each batch is an index range scan instead of a scan from the start
+    # of the table. The last key is saved in backfill_progress in the same transaction as the update of the batch,
+    # so a backfill that stops continues after the last updated batch.
+    # A finished backfill keeps its last key: the next run only processes the rows after it, the rows added later with a
+    # smaller key are processed after restart_backfills (compute_remaining_features.py --restart).
+    def get_backfill_last_key(self, cursor, job):
+        # the workers of parallel_backfill.py can create the table at the same time
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext('backfill_progress'))")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS backfill_progress (
+                job TEXT PRIMARY KEY,
+                last_key JSONB NOT NULL,
+                num_rows BIGINT NOT NULL,
+                updated_at TIMESTAMP NOT NULL,
+                finished_at TIMESTAMP
+            )
+        """)
+        # tables created before finished_at was added
+        cursor.execute("ALTER TABLE backfill_progress ADD COLUMN IF NOT EXISTS finished_at TIMESTAMP")
+        cursor.execute("SELECT last_key, num_rows, finished_at FROM backfill_progress WHERE job = %s", (job,))
+        row = cursor.fetchone()
+        if row is None:
+            return None, 0
+        if row[2] is not None:
+            print(f'Backfill {job} finished at {row[2]}, only the rows after {row[0]} are processed (run with --restart to process all the rows again)', flush=True)
+        return row[0], row[1]
+
+    def save_backfill_last_key(self, cursor, job, last_key, num_rows):
+        cursor.execute("""
+            INSERT INTO backfill_progress (job, last_key, num_rows, updated_at) VALUES (%s, %s, %s, now())
+            ON CONFLICT (job) DO UPDATE SET last_key = EXCLUDED.last_key, num_rows = EXCLUDED.num_rows, updated_at = EXCLUDED.updated_at, finished_at = NULL
+        """, (job, json.dumps(last_key), num_rows))
+
+    def finish_backfill(self, cursor, job):
+        cursor.execute("UPDATE backfill_progress SET finished_at = now() WHERE job = %s", (job,))
+
+    @staticmethod
+    def backfill_jobs(table_suffix):
+        """Names of the backfills of table_suffix in backfill_progress (without the ranges of parallel_backfill.py)"""
+        return [f'features_entity{table_suffix}', f'embedding_text{table_suffix}'] + \
+            [f'features_{datatype}{table_suffix}_batch' for datatype in ['text', 'quantity', 'time', 'globecoordinate']]
+
+    def restart_backfills(self, table_suffix):
+        """Deletes the progress of the backfills of table_suffix (and of their ranges), so the next run starts from the first key"""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT to_regclass('backfill_progress') IS NOT NULL")
+        if cursor.fetchone()[0]:
+            jobs = self.backfill_jobs(table_suffix)
+            cursor.execute(
+                "DELETE FROM backfill_progress WHERE job = ANY(%s) OR substring(job from '^(.*)_[0-9]+$') = ANY(%s)",
+                (jobs, jobs)
+            )
+            print(f'Restarting the backfills of {table_suffix or "rest"} ({cursor.rowcount} rows deleted from backfill_progress)', flush=True)
+        self.conn.commit()
+
+    @staticmethod
+    def key_range_filter(key_range):
+        """Filter of the rows of a range of revision ids [start, end) (parallel_backfill.py), TRUE for all the rows"""
+        if key_range is None:
+            return 'TRUE'
+        return f'revision_id >= {int(key_range[0])} AND revision_id < {int(key_range[1])}'
+
+    @staticmethod
+    def key_range_job(job, key_range):
+        """Name of the backfill of a range in backfill_progress"""
+        return job if key_range is None else f'{job}_{int(key_range[0])}'
+
+    def after_key_filter(self):
+        """Filter of the rows of the table t after a key (the parameters are the values of the key)"""
+        key_types = [f"{'BYTEA' if self.binary_keys and col in BINARY_KEY_COLUMNS else col_type}" for col, col_type in BASE_KEY_TYPES.items()]
+        # the key values are saved as they're selected (value_id in the BYTEA text format with binary_keys)
+        return f"({', '.join([f't.{col}' for col in BASE_KEY_TYPES.keys()])}) > ({', '.join([f'%s::{key_type}' for key_type in key_types])})"
+
+    def read_batch_after_key(self, table, select_cols_str, filter_str, last_key, batch_size):
+        """
+            Next batch_size rows of table (that match filter_str) after last_key in primary key order, read with a server side cursor.
+            The key columns have to be the first columns of select_cols_str.
+            Returns (rows, column names)
+        """
+        # the key columns are qualified: with binary_keys, value_id in select_cols_str is the alias of a text expression,
+        # and ORDER BY value_id would sort by it instead of reading the rows in the order of the primary key index
+        key_cols = [f't.{col}' for col in BASE_KEY_TYPES.keys()]
+
+        query = f"SELECT {select_cols_str} FROM {table} t WHERE ({filter_str})"
+        params = None
+        if last_key is not None:
+            query += f" AND {self.after_key_filter()}"
+            params = last_key
+        query += f" ORDER BY {', '.join(key_cols)} LIMIT {batch_size}"
+
+        with self.conn.cursor(name=f'read_{table}') as read_cursor:
+            read_cursor.itersize = batch_size
+            read_cursor.execute(query, params)
+            rows = read_cursor.fetchall()
+            colnames = [desc[0] for desc in read_cursor.description]
+        return rows, colnames
+
+    ####################
+    # Side tables (feature_backfill.side_tables)
+    ####################
+    # Instead of updating the rows of the feature table (a new row version per row), the backfills COPY their results
+    # into side tables keyed by the primary key of the change ({table}_{side}, see SIDE_TABLES).
+    # {table}_view has the columns of the feature table with the values of the side tables,
+    # and merge_side_tables replaces the feature table by the rows of the view in one step.
+    def create_side_table(self, cursor, table, side, cols_types):
+        side_table = f'{table}_{side}'
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (side_table,))
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {side_table} (
+                {self.get_key_cols_temp()},
+                {', '.join([f'{col} {col_type}' for col, col_type in cols_types.items()])},
+                PRIMARY KEY ({', '.join(BASE_KEY_TYPES.keys())})
+            )
+        """)
+        return side_table
+
+    def clear_side_table(self, cursor, side_table, key_range, last_key):
+        """
+            Deletes the rows of side_table (with revision_id in key_range) after last_key: they are calculated again
+            by the backfill, which starts after last_key (from the start after restart_backfills)
+        """
+        if key_range is None and last_key is None:
+            cursor.execute(f"TRUNCATE TABLE {side_table}")
+        elif last_key is None:
+            cursor.execute(f"DELETE FROM {side_table} WHERE {self.key_range_filter(key_range)}")
+        else:
+            cursor.execute(f"DELETE FROM {side_table} t WHERE {self.key_range_filter(key_range)} AND {self.after_key_filter()}", last_key)
+
+    def get_table_columns(self, cursor, table):
+        """[(column, type)] of table in the order of the table"""
+        cursor.execute("""
+            SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute
+                WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+                ORDER BY attnum
+        """, (table,))
+        return cursor.fetchall()
+
+    def get_side_tables(self, cursor, table):
+        cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = current_schema() AND table_name = ANY(%s)",
+                       ([f'{table}_{side}' for side in SIDE_TABLES],))
+        existing = {row[0] for row in cursor.fetchall()}
+        return [f'{table}_{side}' for side in SIDE_TABLES if f'{table}_{side}' in existing]
+
+    def create_side_table_view(self, cursor, table):
+        """(Re)creates {table}_view: the rows of table, with the value of each column of a side table when the side table has the row"""
+        key_cols = list(BASE_KEY_TYPES.keys())
+        side_tables = self.get_side_tables(cursor, table)
+
+        # side table of each column (the side tables of a table have different columns)
+        side_cols = {}
+        for i, side_table in enumerate(side_tables):
+            for col, _ in self.get_table_columns(cursor, side_table):
+                if col not in key_cols:
+                    side_cols[col] = f's{i}'
+
+        select_cols = []
+        for col, col_type in self.get_table_columns(cursor, table):
+            if col in side_cols:
+                alias = side_cols[col]
+                select_cols.append(f"(CASE WHEN {alias}.revision_id IS NOT NULL THEN {alias}.{col} ELSE f.{col} END)::{col_type} AS {col}")
+            else:
+                select_cols.append(f'f.{col}')
+
+        joins = [
+            f"LEFT JOIN {side_table} s{i} ON {' AND '.join([f's{i}.{col} = f.{col}' for col in key_cols])}"
+            for i, side_table in enumerate(side_tables)
+        ]
+        cursor.execute(f"DROP VIEW IF EXISTS {table}_view")
+        cursor.execute(f"CREATE VIEW {table}_view AS SELECT {', '.join(select_cols)} FROM {table} f {' '.join(joins)}")
+
+    def merge_side_tables(self, table):
+        """
+            Replaces table by the rows of {table}_view (one transaction) and drops the side tables.
+            The new table has the columns, defaults, constraints and indexes of table
+        """
+        cursor = self.conn.cursor()
+        side_tables = self.get_side_tables(cursor, table)
+        if len(side_tables) == 0:
+            print(f'{table} has no side tables', flush=True)
+            return
+
+        print(f'Merging {", ".join(side_tables)} into {table}', flush=True)
+        start_time = time.time()
+
+        self.create_side_table_view(cursor, table)
+
+        cursor.execute("SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'f')", (table,))
+        constraints = cursor.fetchall()
+        cursor.execute("""
+            SELECT pg_get_indexdef(i.indexrelid) FROM pg_index i
+                WHERE i.indrelid = %s::regclass AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid AND c.conrelid = i.indrelid)
+        """, (table,))
+        indexes = [row[0] for row in cursor.fetchall()]
+
+        # indexes and constraints are created after the rows are inserted
+        cursor.execute(f"CREATE TABLE {table}_merged (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE INCLUDING COMPRESSION)")
+        cursor.execute(f"INSERT INTO {table}_merged SELECT * FROM {table}_view")
+
+        cursor.execute(f"DROP VIEW {table}_view")
+        cursor.execute(f"DROP TABLE {table}")
+        for side_table in side_tables:
+            cursor.execute(f"DROP TABLE {side_table}")
+        cursor.execute(f"ALTER TABLE {table}_merged RENAME TO {table}")
+
+        for name, definition in constraints:
+            cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition}")
+        for definition in indexes:
+            cursor.execute(definition)
+
+        self.conn.commit()
+
+        final_time, unit = get_time_unit(time.time() - start_time)
+        print(f'Merged the side tables of {table} in {final_time} {unit}', flush=True)
 
     def create_embedding_features(self, model, df, old_col, new_col):
         """
@@ -60,63 +337,31 @@ class FeatureCreation():
                 new_texts.append(new_val)
 
         device = "cuda" if torch.cuda.is_available() else "cpu"
+        embedding_store = self.get_embedding_store()
+
+        def encode(texts, **kwargs):
+            # each distinct string is encoded once per batch (and only once overall with the embedding store)
+            return encode_unique(texts, lambda unique_texts: model.encode(unique_texts, device=device, show_progress_bar=True, **kwargs), embedding_store)
 
         if 'label' not in old_col: # remove for entity
-            old_text_embeddings = model.encode(
-                old_texts,
-                device=device,
-                show_progress_bar=True
-            )
-            new_text_embeddings = model.encode(
-                new_texts,
-                device=device,
-                show_progress_bar=True
-            )
+            old_text_embeddings = encode(old_texts)
+            new_text_embeddings = encode(new_texts)
             # calculate cosine similarity
-            similarities = np.array([
-                cosine_similarity([old_emb], [new_emb])[0][0]
-                for old_emb, new_emb in zip(old_text_embeddings, new_text_embeddings)
-            ])
-            df['value_cosine_similarity'] = similarities
+            df['value_cosine_similarity'] = cosine_similarities(old_text_embeddings, new_text_embeddings)
 
         if 'label' in old_col:
-            old_label_embeddings = model.encode(
-                old_label,
-                device=device,
-                show_progress_bar=True,
-                batch_size=512
-            )
-            new_label_embeddings = model.encode(
-                new_label,
-                device=device,
-                show_progress_bar=True,
-                batch_size=512
-            )
+            old_label_embeddings = encode(old_label, batch_size=512)
+            new_label_embeddings = encode(new_label, batch_size=512)
             # calculate cosine similarity
-            similarities = np.array([
-                cosine_similarity([old_emb], [new_emb])[0][0]
-                for old_emb, new_emb in zip(old_label_embeddings, new_label_embeddings)
-            ])
-            df['label_cosine_similarity'] = similarities
-
-            old_description_embeddings = model.encode(
-                old_description,
-                device=device,
-                show_progress_bar=True,
-                batch_size=512
-            )
-            new_description_embeddings = model.encode(
-                new_description,
-                device=device,
-                show_progress_bar=True,
-                batch_size=512
-            )
+            df['label_cosine_similarity'] = cosine_similarities(old_label_embeddings, new_label_embeddings)
+
+            old_description_embeddings = encode(old_description, batch_size=512)
+            new_description_embeddings = encode(new_description, batch_size=512)
             # calculate cosine similarity
-            similarities = np.array([
-                cosine_similarity([old_emb], [new_emb])[0][0]
-                for old_emb, new_emb in zip(old_description_embeddings, new_description_embeddings)
-            ])
-            df['description_cosine_similarity'] = similarities 
+            df['description_cosine_similarity'] = cosine_similarities(old_description_embeddings, new_description_embeddings)
+
+        if embedding_store is not None:
+            print(f'Embedding store: {embedding_store.stats()}', flush=True)
 
         return df
 
@@ -130,22 +375,93 @@ class FeatureCreation():
             # different length -> there's a char addition or deletion
             return 0
         
-        diffs = []
-        for i in range(len(old)):
-            # get charactes that differ in order
-            if old[i] != new[i]:
-                diffs.append(i)
-            # old: caro old[2]=r old[3]=o
-            # new: caor new[2]=o new[3]=r
-            # diffs = [2,3]
-
-        if len(diffs) == 2:
-            i, j = diffs
-            # check the difference is adjacent (j = i+1) and swapped
-            if j == i + 1 and old[i] == new[j] and old[j] == new[i]:
-                return 1
+        # first character that differs
+        # old: caro old[2]=r old[3]=o
+        # new: caor new[2]=o new[3]=r
+        # i = 2
+        i = len(os.path.commonprefix([old, new]))
+
+        # the only differences are at i and i+1 (adjacent) and they're swapped
+        if i + 1 < len(old) and old[i] == new[i + 1] and old[i + 1] == new[i] and old[i + 2:] == new[i + 2:]:
+            return 1
         return 0
 
+    @staticmethod
+    def text_edit_operations(old, new, prefix_len=None):
+        """
+            Number of insertions, deletions and substitutions to go from old to new
+            (backtrace of the Levenshtein DP table, preferring match > substitution > insertion > deletion).
+            The common prefix and suffix are matches in the backtrace, so the table is only built for the middle of the strings:
+            in pure Python for small tables, one row at a time with NumPy up to MAX_EDIT_OPERATIONS_CELLS,
+            and with Levenshtein.editops above that (same number of operations, but ties can be split differently).
+        """
+        m, n = len(old), len(new)
+        p = len(os.path.commonprefix([old, new])) if prefix_len is None else prefix_len
+        s = 0
+        while s < m - p and s < n - p and old[m - 1 - s] == new[n - 1 - s]:
+            s += 1
+        old, new = old[p:m - s], new[p:n - s]
+        m, n = len(old), len(new)
+
+        if m == 0 or n == 0:
+            return n, m, 0
+
+        if m * n > MAX_EDIT_OPERATIONS_CELLS:
+            ops = [op for op, _, _ in editops(old, new)]
+            return ops.count('insert'), ops.count('delete'), ops.count('replace')
+
+        if m * n <= MAX_PYTHON_EDIT_CELLS:
+            dp = [[0] * (n + 1) for _ in range(m + 1)]
+            
+            for i in range(m + 1):
+                dp[i][0] = i
+            for j in range(n + 1):
+                dp[0][j] = j
+            
+            for i in range(1, m + 1):
+                for j in range(1, n + 1):
+                    if old[i-1] == new[j-1]:
+                        dp[i][j] = dp[i-1][j-1]
+                    else:
+                        dp[i][j] = 1 + min(
+                            dp[i-1][j],    # deletion
+                            dp[i][j-1],    # insertion
+                            dp[i-1][j-1]   # substitution
+                        )
+        else:
+            # dp[i][j] = min(match/substitution/deletion from row i-1, dp[i][j-1] + 1),
+            # the insertions are a running minimum of (candidate - j) over the row
+            new_codes = np.fromiter((ord(c) for c in new), dtype=np.int64, count=n)
+            idx = np.arange(n + 1, dtype=np.int32)
+            dp = np.empty((m + 1, n + 1), dtype=np.int32)
+            dp[0] = idx
+            candidates = np.empty(n + 1, dtype=np.int32)
+            for i in range(1, m + 1):
+                prev = dp[i - 1]
+                candidates[0] = i
+                candidates[1:] = np.where(new_codes == ord(old[i - 1]), prev[:-1], 1 + np.minimum(prev[1:], prev[:-1]))
+                dp[i] = np.minimum.accumulate(candidates - idx) + idx
+
+        i, j = m, n
+        insertions = deletions = substitutions = 0
+        
+        while i > 0 or j > 0:
+            if i > 0 and j > 0 and old[i-1] == new[j-1]:
+                i -= 1
+                j -= 1
+            elif i > 0 and j > 0 and dp[i][j] == dp[i-1][j-1] + 1:
+                substitutions += 1
+                i -= 1
+                j -= 1
+            elif j > 0 and dp[i][j] == dp[i][j-1] + 1:
+                insertions += 1
+                j -= 1
+            else:
+                deletions += 1
+                i -= 1
+        
+        return insertions, deletions, substitutions
+
     @staticmethod
     def avg_word_levenshtein(old, new):
         """
@@ -169,17 +485,23 @@ class FeatureCreation():
     # Text features
     ################################################################################
     @staticmethod
-    def create_text_features(datatype, old_value, new_value):
-        """Extract features for string datatype changes"""
+    def create_text_features(datatype, old_value, new_value, lev_dist=None):
+        """
+            Extract features for string datatype changes
+            lev_dist can be given when it's already calculated (see create_text_features_batch)
+        """
         
         features = dict()
 
         new_value = str(new_value).strip().replace('"', '')
         old_value = str(old_value).strip().replace('"', '')
+
+        old_tokens = old_value.split()
+        new_tokens = new_value.split()
         
-        def calc_overlap(old_value, new_value):
-            old_tokens = set(old_value.split())
-            new_tokens = set(new_value.split())
+        def calc_overlap(old_tokens, new_tokens):
+            old_tokens = set(old_tokens)
+            new_tokens = set(new_tokens)
             if len(old_tokens | new_tokens) == 0:
                 return 0
             # | is union
@@ -187,7 +509,7 @@ class FeatureCreation():
             return len(old_tokens & new_tokens) / len(old_tokens | new_tokens)
         
         # percentage (ratio) of token overlap
-        features['token_overlap'] = calc_overlap(old_value, new_value)
+        features['token_overlap'] = calc_overlap(old_tokens, new_tokens)
         
         features['old_in_new'] = int(old_value in new_value)
         features['new_in_old'] = int(new_value in old_value)
@@ -196,7 +518,8 @@ class FeatureCreation():
         new_len = len(new_value)
         max_len = max(old_len, new_len) if max(old_len, new_len) > 0 else 1 # replace 0's with 1 to avoid division by zero
 
-        lev_dist = levenshtein_distance(old_value.lower().strip(), new_value.lower().strip())
+        if lev_dist is None:
+            lev_dist = levenshtein_distance(old_value.lower().strip(), new_value.lower().strip())
        
         # percentage of how much changed
         features['edit_distance_ratio'] = lev_dist / max_len
@@ -217,16 +540,16 @@ class FeatureCreation():
         if datatype == 'text': # remove for entity
 
             features['length_diff_abs'] = int(abs(len(new_value) - len(old_value)))
-            features['token_count_old'] = int(len(old_value.split()))
-            features['token_count_new'] = int(len(new_value.split()))
+            features['token_count_old'] = int(len(old_tokens))
+            features['token_count_new'] = int(len(new_tokens))
 
-            special_char_regex = r'[^a-zA-Z0-9]'
-            old_value_no_special_char = re.sub(special_char_regex,"",old_value)
-            new_value_no_special_char = re.sub(special_char_regex,"",new_value)
+            old_value_no_special_char = SPECIAL_CHAR_PATTERN.sub("",old_value)
+            new_value_no_special_char = SPECIAL_CHAR_PATTERN.sub("",new_value)
             features['same_value_without_special_char'] = int(old_value_no_special_char == new_value_no_special_char)
 
-            special_char_count_old = len(re.findall(special_char_regex, old_value))
-            special_char_count_new = len(re.findall(special_char_regex, new_value))
+            # each special char is removed by the substitution
+            special_char_count_old = len(old_value) - len(old_value_no_special_char)
+            special_char_count_new = len(new_value) - len(new_value_no_special_char)
 
             features['special_char_count_diff'] =  special_char_count_old - special_char_count_new
             
@@ -243,56 +566,17 @@ class FeatureCreation():
             #     features['structure_similarity'] = 1 - abs(features['token_count_old'] - features['token_count_new']) / \
             #                                 max(features['token_count_old'], features['token_count_new'])
                 
-            def get_edit_operations(old_value, new_value):
-                
-                m, n = len(old_value), len(new_value)
-                dp = [[0] * (n + 1) for _ in range(m + 1)]
-                
-                for i in range(m + 1):
-                    dp[i][0] = i
-                for j in range(n + 1):
-                    dp[0][j] = j
-                
-                for i in range(1, m + 1):
-                    for j in range(1, n + 1):
-                        if old_value[i-1] == new_value[j-1]:
-                            dp[i][j] = dp[i-1][j-1]
-                        else:
-                            dp[i][j] = 1 + min(
-                                dp[i-1][j],    # deletion
-                                dp[i][j-1],    # insertion
-                                dp[i-1][j-1]   # substitution
-                            )
-
-                i, j = m, n
-                insertions = deletions = substitutions = 0
-                
-                while i > 0 or j > 0:
-                    if i > 0 and j > 0 and old_value[i-1] == new_value[j-1]:
-                        i -= 1
-                        j -= 1
-                    elif i > 0 and j > 0 and dp[i][j] == dp[i-1][j-1] + 1:
-                        substitutions += 1
-                        i -= 1
-                        j -= 1
-                    elif j > 0 and dp[i][j] == dp[i][j-1] + 1:
-                        insertions += 1
-                        j -= 1
-                    else:
-                        deletions += 1
-                        i -= 1
-                
-                return insertions, deletions, substitutions
+            # what os.path.commonprefix returns: paths: ['/home/User/Photos', /home/User/Videos']    commonprefix: /home/User/
+            prefix_len = len(os.path.commonprefix([old_value, new_value]))
 
-            features['char_insertions'], features['char_deletions'], features['char_substitutions'] = get_edit_operations(old_value, new_value)
+            features['char_insertions'], features['char_deletions'], features['char_substitutions'] = FeatureCreation.text_edit_operations(old_value, new_value, prefix_len)
 
             features['adjacent_char_swap'] = FeatureCreation.has_adjacent_swap(old_value, new_value)
 
-            features['avg_word_similarity'] = FeatureCreation.avg_word_levenshtein(old_value, new_value)
+            # features['avg_word_similarity'] = FeatureCreation.avg_word_levenshtein(old_value, new_value)
 
-            # what os.path.commonprefix returns: paths: ['/home/User/Photos', /home/User/Videos']    commonprefix: /home/User/
             # Added that length of suffix/prefix is at least 3 to avoid short suffix/prefix (e.g. just the first letter...)
-            features['has_significant_prefix'] = int(len(os.path.commonprefix([old_value, new_value])) >= 3)
+            features['has_significant_prefix'] = int(prefix_len >= 3)
 
             features['has_significant_suffix'] = int(len(os.path.commonprefix([old_value[::-1], new_value[::-1]])) >= 3)
 
@@ -314,21 +598,89 @@ class FeatureCreation():
                 features['has_significant_prefix'],
                 features['has_significant_suffix'],
             )
-        
+
         return result
 
+    @staticmethod
+    def create_text_features_batch(datatype, old_values, new_values):
+        """
+            create_text_features of lists of old and new values (same results),
+            the Levenshtein distances are calculated in one call with rapidfuzz (in parallel)
+        """
+        if len(old_values) == 0:
+            return []
+
+        # the same cleaning as create_text_features
+        lev_dists = cpdist(
+            [str(value).strip().replace('"', '').lower().strip() for value in old_values],
+            [str(value).strip().replace('"', '').lower().strip() for value in new_values],
+            scorer=rapidfuzz_levenshtein.distance,
+            dtype=np.int64,
+            workers=-1
+        )
+
+        return [
+            FeatureCreation.create_text_features(datatype, old_value, new_value, lev_dist=int(lev_dist))
+            for old_value, new_value, lev_dist in zip(old_values, new_values, lev_dists)
+        ]
+
     ########################################################################################################################
     # Time features
     ########################################################################################################################
+    @staticmethod
+    def parse_time_value(value):
+        """
+        Returns (text, (year, month, day)) of a time value, as it's used by create_time_features.
+        text is the value without the quotes of its serialization and the date is None for some_value/no_value
+        """
+        if isinstance(value, str) and SIMPLE_STRING_PATTERN.match(value):
+            text = value # the serialized value is the string between quotes
+        else:
+            text = json.dumps(value, ensure_ascii=False).strip().replace('"', '')
+
+        if text in ['some_value', 'no_value']:
+            return text, None
+
+        match = CANONICAL_TIME_PATTERN.match(text)
+        if match:
+            sign, year, month, day = match.groups()
+            return text, (-int(year) if sign == '-' else int(year), int(month), int(day))
+
+        try:
+            time_str_cleaned = (re.sub(r'[^0-9TZ:\-]', '', text)).replace('Z', '')
+            date_part = time_str_cleaned.split('T')[0]
+            
+            # Handle negative years (BC dates)
+            is_negative = date_part.startswith('-')
+            if is_negative:
+                date_part = date_part[1:]  # Remove leading '-'
+            
+            parts = date_part.split('-')
+            
+            if len(parts) < 3:
+                raise ValueError(f"Invalid date format: {text}")
+            
+            year = int(parts[0])
+            if is_negative:
+                year = -year  # Make it negative again
+            
+            month = int(parts[1])
+            day = int(parts[2])
+            return text, (year, month, day)
+        except Exception as e:
+            print(f"Error parsing datetime string: {text} with option date: {e}")
+            raise e
+
     @staticmethod
     def create_time_features(old_value, new_value):
         """
         Extract time change features
+        old_value and new_value are parsed with parse_time_value
         """
-        old_value = str(old_value).strip().replace('"', '')
-        new_value = str(new_value).strip().replace('"', '')
+        old_value, old_date = old_value
+        new_value, new_date = new_value
 
-        if old_value in ['some_value', 'no_value'] or new_value in ['some_value', 'no_value']:
+        if old_date is None or new_date is None: # some_value or no_value
             return (
                 1000, # big difference
                 0,
@@ -341,44 +693,6 @@ class FeatureCreation():
                 1,
                 1
             )
-        else:
-
-            def get_date_parts(datatime_str, option='date'):
-                try:
-                    if option == 'date':
-                        time_str_cleaned = (re.sub(r'[^0-9TZ:\-]', '', str(datatime_str))).replace('Z', '')
-                        date_part = time_str_cleaned.split('T')[0]
-                        
-                        # Handle negative years (BC dates)
-                        is_negative = date_part.startswith('-')
-                        if is_negative:
-                            date_part = date_part[1:]  # Remove leading '-'
-                        
-                        parts = date_part.split('-')
-                        
-                        if len(parts) < 3:
-                            raise ValueError(f"Invalid date format: {datatime_str}")
-                        
-                        year = int(parts[0])
-                        if is_negative:
-                            year = -year  # Make it negative again
-                        
-                        month = int(parts[1])
-                        day = int(parts[2])
-                        return year, month, day
-                    elif option == 'time':
-                        time_str_cleaned = (re.sub(r'[^0-9TZ:\-]', '', str(datatime_str))).replace('Z', '')
-                        parts = time_str_cleaned.split('T')[1].split(':')
-                        hour = int(parts[0])
-                        minute = int(parts[1])
-                        second = int(parts[2])
-                        return hour, minute, second
-                except Exception as e:
-                    print(f"Error parsing datetime string: {datatime_str} with option {option}: {e}")
-                    raise e
-
-            old_date = get_date_parts(old_value, 'date') 
-            new_date = get_date_parts(new_value, 'date')
 
         features = dict()
 
@@ -543,45 +857,20 @@ class FeatureCreation():
     # Quantity features
     ########################################################################################################################
     @staticmethod
-    def calc_precision_change(old_value, new_value, datatype='quantity', part=None):
+    def calc_precision_change(old_value, new_value):
         # returns 1 if only precision (decimal places) changed, 0 otherwise
-        if datatype == 'globecoordinate':
-            if '{' in old_value and '{' in new_value:
-                old = json.loads(old_value).get(part, None)
-                new = json.loads(new_value).get(part, None)
-            
-            elif type(old_value) == dict and type(new_value) == dict:
-                old = old_value.get(part, None)
-                new = new_value.get(part, None)
-            
-            else:
-                return 0
-            
-            old_ndp = str(old).split('.')[0] if '.' in str(old) else str(old)
-            try:
-                old_dp = str(old).split('.')[1] if '.' in str(old) and int(str(old).split('.')[1]) > 0 else '0'
-            except ValueError:
-                old_dp = '0'
-
-            new_ndp = str(new).split('.')[0] if '.' in str(new) else str(new)
-            try:
-                new_dp = str(new).split('.')[1] if '.' in str(new) and int(str(new).split('.')[1]) > 0 else '0'
-            except ValueError:
-                new_dp = '0'
-        else:
-
-            # quantity
-            old_ndp = str(old_value).split('.')[0] if '.' in str(old_value) else str(old_value)
-            try:
-                old_dp = str(old_value).split('.')[1] if '.' in str(old_value) and int(str(old_value).split('.')[1]) > 0 else '0'
-            except ValueError:
-                old_dp = '0'
+        # old_value and new_value are the texts of the numbers (quantity amount, latitude or longitude)
+        old_ndp = old_value.split('.')[0] if '.' in old_value else old_value
+        try:
+            old_dp = old_value.split('.')[1] if '.' in old_value and int(old_value.split('.')[1]) > 0 else '0'
+        except ValueError:
+            old_dp = '0'
 
-            new_ndp = str(new_value).split('.')[0] if '.' in str(new_value) else str(new_value)
-            try:
-                new_dp = str(new_value).split('.')[1] if '.' in str(new_value) and int(str(new_value).split('.')[1]) > 0 else '0'
-            except ValueError:
-                new_dp = '0'
+        new_ndp = new_value.split('.')[0] if '.' in new_value else new_value
+        try:
+            new_dp = new_value.split('.')[1] if '.' in new_value and int(new_value.split('.')[1]) > 0 else '0'
+        except ValueError:
+            new_dp = '0'
 
         # if both decimal parts are 0 -> there's no precision change
         # e.g. 12 -> 12.0 is not a precision change, or 12.0 -> 12.00
@@ -591,19 +880,9 @@ class FeatureCreation():
             return 0
 
     @staticmethod
-    def calc_length_increase_decrease(old_value, new_value, datatype='quantity', option='increase', part=None):
-
-        if datatype == 'quantity':
-            new_length = len(str(new_value).replace('-', '').replace('+', '').replace('.', ''))
-            old_length = len(str(old_value).replace('-', '').replace('+', '').replace('.', ''))
-        else: # globecoordinate
-            if '{' in old_value and '{' in new_value: # for somevalue or novalue
-                old = str(json.loads(old_value).get(part, '')) # part is longitude or latitude
-                new = str(json.loads(new_value).get(part, ''))
-                new_length = len(new.replace('-', '').replace('+', '').replace('.', ''))
-                old_length = len(old.replace('-', '').replace('+', '').replace('.', ''))
-            else:
-                return 0
+    def calc_length_increase_decrease(old_value, new_value, option='increase'):
+        new_length = len(new_value.replace('-', '').replace('+', '').replace('.', ''))
+        old_length = len(old_value.replace('-', '').replace('+', '').replace('.', ''))
         
         if option == 'increase':
             return 1 if new_length > old_length else 0
@@ -611,98 +890,74 @@ class FeatureCreation():
             return 1 if new_length < old_length else 0
     
     @staticmethod
-    def calc_sign_change(old_value, new_value, datatype='quantity', part=None):
-
-        if datatype == 'quantity':
-            new_float = float(new_value)
-            old_float = float(old_value)
-        else: # globecoordinate
-            if '{' in old_value and '{' in new_value: # for somevalue or novalue
-                old = str(json.loads(old_value).get(part, '')) # part is longitude or latitude
-                new = str(json.loads(new_value).get(part, ''))
-                new_float = float(new)
-                old_float = float(old)
-            else:
-                return 0
+    def calc_sign_change(old_float, new_float):
         return 1 if (old_float * new_float < 0) and (math.floor(abs(old_float)) == math.floor(abs(new_float))) else 0
 
     @staticmethod
-    def check_containment(old_value, new_value, datatype='quantity', part=None, option='old_in_new'):
-
-        if datatype == 'globecoordinate':
-            if '{' in old_value and '{' in new_value:
-                old_value = json.loads(old_value).get(part, None)
-                new_value = json.loads(new_value).get(part, None)
-            else:
-                return 0
-
+    def check_containment(old_value, new_value, option='old_in_new'):
         if option == 'old_in_new':
-            return 1 if str(new_value).startswith(str(old_value)) else 0
+            return 1 if new_value.startswith(old_value) else 0
         elif option == 'new_in_old':
-            return 1 if str(old_value).startswith(str(new_value)) else 0
+            return 1 if old_value.startswith(new_value) else 0
         else:
             return 0
     
     @staticmethod
-    def same_decimal_length(old_value, new_value, datatype='quantity', part=None):
-        if datatype == 'globecoordinate':
-            if '{' in old_value and '{' in new_value:
-                old_value = json.loads(old_value).get(part, None)
-                new_value = json.loads(new_value).get(part, None)
-            else:
-                return 0
-            
-        old_dec = str(old_value).split('.')[1] if '.' in str(old_value) else ''
-        new_dec = str(new_value).split('.')[1] if '.' in str(new_value) else ''
+    def same_decimal_length(old_value, new_value):
+        old_dec = old_value.split('.')[1] if '.' in old_value else ''
+        new_dec = new_value.split('.')[1] if '.' in new_value else ''
 
         return 1 if len(old_dec) == len(new_dec) else 0
     
     @staticmethod
-    def same_float_value(old_value, new_value, datatype='quantity', part=None):
-        if datatype == 'globecoordinate':
-            if '{' in old_value and '{' in new_value:
-                old_value = json.loads(old_value).get(part, None)
-                new_value = json.loads(new_value).get(part, None)
-            else:
-                return 0
-        try:
-            return 1 if float(old_value) == float(new_value) else 0
-        except:
-            return 0
+    def same_float_value(old_float, new_float):
+        return 1 if old_float == new_float else 0
+
+    @staticmethod
+    def parse_quantity_value(value):
+        """
+        Returns (text, float) of the amount of a quantity, as it's used by create_quantity_features.
+        text is the amount without the quotes of its serialization, whitespace and '+' sign
+        """
+        if isinstance(value, str) and SIMPLE_STRING_PATTERN.match(value):
+            text = value.replace('+', '').strip() # the serialized value is the string between quotes
+        else:
+            text = json.dumps(value, ensure_ascii=False).replace('\\n', '').replace('\r', '').replace('\n', '').replace('\t', '').strip()
+            text = text.replace('"', '').replace('+', '').strip()
+        return text, float(text)
 
     @staticmethod
     def create_quantity_features(old_value, new_value):
+        """
+        old_value and new_value are parsed with parse_quantity_value
+        """
         features = dict()
 
-        new_value = str(new_value).replace('\\n', '').replace('\r', '').replace('\n', '').replace('\t', '').strip()
-        old_value = str(old_value).replace('\\n', '').replace('\r', '').replace('\n', '').replace('\t', '').strip()
-        
-        # remove + sign
-        old_str = str(old_value).replace('"', '').replace('+', '').strip()
-        new_str = str(new_value).replace('"', '').replace('+', '').strip()
+        old_str, old_float = old_value
+        new_str, new_float = new_value
 
         # sign change 
-        features['sign_change'] = FeatureCreation.calc_sign_change(old_str, new_str, datatype='quantity')
+        features['sign_change'] = FeatureCreation.calc_sign_change(old_float, new_float)
         
         # only precision change 
-        features['precision_change'] = FeatureCreation.calc_precision_change(old_str, new_str, datatype='quantity')
+        features['precision_change'] = FeatureCreation.calc_precision_change(old_str, new_str)
         
-        features['whole_number_change'] = int(np.floor(abs(float(old_str))) != np.floor(abs(float(new_str))))
+        features['whole_number_change'] = int(np.floor(abs(old_float)) != np.floor(abs(new_float)))
 
-        features['old_is_prefix_of_new'] = FeatureCreation.check_containment(old_str, new_str, datatype='quantity', option='old_in_new')
-        features['new_is_prefix_of_old'] = FeatureCreation.check_containment(old_str, new_str, datatype='quantity', option='new_in_old')
+        features['old_is_prefix_of_new'] = FeatureCreation.check_containment(old_str, new_str, option='old_in_new')
+        features['new_is_prefix_of_old'] = FeatureCreation.check_containment(old_str, new_str, option='new_in_old')
 
         if features['old_is_prefix_of_new'] == 1:
-            features['length_increase'] = FeatureCreation.calc_length_increase_decrease(old_str, new_str, datatype='quantity', option='increase')
+            features['length_increase'] = FeatureCreation.calc_length_increase_decrease(old_str, new_str, option='increase')
         else: 
             features['length_increase'] = 0
 
         if features['new_is_prefix_of_old'] == 1:
-            features['length_decrease'] = FeatureCreation.calc_length_increase_decrease(old_str, new_str, datatype='quantity', option='decrease')
+            features['length_decrease'] = FeatureCreation.calc_length_increase_decrease(old_str, new_str, option='decrease')
         else:
             features['length_decrease'] = 0
 
-        features['same_float_value'] = FeatureCreation.same_float_value(old_str, new_str, datatype='quantity')
+        features['same_float_value'] = FeatureCreation.same_float_value(old_float, new_float)
 
         result = (
             features['sign_change'],
@@ -722,53 +977,71 @@ class FeatureCreation():
     # Globecoordinate features
     ########################################################################################################################
     @staticmethod
-    def create_globe_coordinate_features(old_value, new_value):
+    def parse_coordinate(number):
+        """Returns (text, float) of a latitude or longitude"""
+        text = str(number)
+        if isinstance(number, (int, float)) and not isinstance(number, bool):
+            return text, float(number) # same as float(text)
+        return text, float(text.replace('\\n', '').replace('\r', '').replace('\n', '').replace('\t', '').strip())
+
+    @staticmethod
+    def parse_globe_coordinate_value(value):
+        """
+        Returns {'latitude': (text, float), 'longitude': (text, float)} of a globecoordinate value 
+        ({'latitude': ..., 'longitude': ...}), as it's used by create_globe_coordinate_features
+        """
+        return {part: FeatureCreation.parse_coordinate(value[part]) for part in ('latitude', 'longitude')}
 
+    @staticmethod
+    def create_globe_coordinate_features(old_value, new_value):
+        """
+        old_value and new_value are parsed with parse_globe_coordinate_value
+        """
         features = dict()
-        old_val = json.loads(old_value)
-        new_val = json.loads(new_value)
 
-        new_val['latitude'] = float(str(new_val['latitude']).replace('\\n', '').replace('\r', '').replace('\n', '').replace('\t', '').strip())
-        new_val['longitude'] = float(str(new_val['longitude']).replace('\\n', '').replace('\r', '').replace('\n', '').replace('\t', '').strip())
+        old_lat, old_lat_float = old_value['latitude']
+        new_lat, new_lat_float = new_value['latitude']
+        old_lon, old_lon_float = old_value['longitude']
+        new_lon, new_lon_float = new_value['longitude']
         
         # add abs because if there's a negative value then they will be different even though the whole number is the same
-        features['latitude_whole_number_change'] = (1 if math.floor(abs(new_val['latitude'])) != math.floor(abs(old_val['latitude'])) else 0)
-        features['longitude_whole_number_change'] = (1 if math.floor(abs(new_val['longitude'])) != math.floor(abs(old_val['longitude'])) else 0)
+        features['latitude_whole_number_change'] = (1 if math.floor(abs(new_lat_float)) != math.floor(abs(old_lat_float)) else 0)
+        features['longitude_whole_number_change'] = (1 if math.floor(abs(new_lon_float)) != math.floor(abs(old_lon_float)) else 0)
 
-        features['latitude_sign_change'] = int((float(new_val['latitude']) * float(old_val['latitude']) < 0) and (features['latitude_whole_number_change'] == 0))
-        features['longitude_sign_change'] = int((float(new_val['longitude']) * float(old_val['longitude']) < 0) and (features['longitude_whole_number_change'] == 0))
+        features['latitude_sign_change'] = int((new_lat_float * old_lat_float < 0) and (features['latitude_whole_number_change'] == 0))
+        features['longitude_sign_change'] = int((new_lon_float * old_lon_float < 0) and (features['longitude_whole_number_change'] == 0))
 
-        features['latitude_precision_change'] = FeatureCreation.calc_precision_change(old_value, new_value, datatype='globecoordinate', part='latitude')
-        features['longitude_precision_change'] = FeatureCreation.calc_precision_change(old_value, new_value, datatype='globecoordinate', part='longitude')
+        features['latitude_precision_change'] = FeatureCreation.calc_precision_change(old_lat, new_lat)
+        features['longitude_precision_change'] = FeatureCreation.calc_precision_change(old_lon, new_lon)
 
-        features['longitude_old_is_prefix_of_new'] = FeatureCreation.check_containment(old_value, new_value, datatype='globecoordinate', part='longitude', option='old_in_new')
-        features['longitude_new_is_prefix_of_old'] = FeatureCreation.check_containment(old_value, new_value, datatype='globecoordinate', part='longitude', option='new_in_old')
+        features['longitude_old_is_prefix_of_new'] = FeatureCreation.check_containment(old_lon, new_lon, option='old_in_new')
+        features['longitude_new_is_prefix_of_old'] = FeatureCreation.check_containment(old_lon, new_lon, option='new_in_old')
 
-        features['latitude_old_is_prefix_of_new'] = FeatureCreation.check_containment(old_value, new_value, datatype='globecoordinate', part='latitude', option='old_in_new')
-        features['latitude_new_is_prefix_of_old'] = FeatureCreation.check_containment(old_value, new_value, datatype='globecoordinate', part='latitude', option='new_in_old')
+        features['latitude_old_is_prefix_of_new'] = FeatureCreation.check_containment(old_lat, new_lat, option='old_in_new')
+        features['latitude_new_is_prefix_of_old'] = FeatureCreation.check_containment(old_lat, new_lat, option='new_in_old')
 
         if features['latitude_old_is_prefix_of_new'] == 1:
-            features['latitude_length_increase'] = FeatureCreation.calc_length_increase_decrease(old_value, new_value, 'globecoordinate', option='increase', part='latitude')
+            features['latitude_length_increase'] = FeatureCreation.calc_length_increase_decrease(old_lat, new_lat, option='increase')
         else:
             features['latitude_length_increase'] = 0
         
         if features['latitude_new_is_prefix_of_old'] == 1:
-            features['latitude_length_decrease'] = FeatureCreation.calc_length_increase_decrease(old_value, new_value, 'globecoordinate', option='decrease', part='latitude')
+            features['latitude_length_decrease'] = FeatureCreation.calc_length_increase_decrease(old_lat, new_lat, option='decrease')
         else:
             features['latitude_length_decrease'] = 0
 
         if features['longitude_old_is_prefix_of_new'] == 1:
-            features['longitude_length_increase'] = FeatureCreation.calc_length_increase_decrease(old_value, new_value, 'globecoordinate', option='increase', part='longitude')
+            features['longitude_length_increase'] = FeatureCreation.calc_length_increase_decrease(old_lon, new_lon, option='increase')
         else:
             features['longitude_length_increase'] = 0
         
         if features['longitude_new_is_prefix_of_old'] == 1:
-            features['longitude_length_decrease'] = FeatureCreation.calc_length_increase_decrease(old_value, new_value, 'globecoordinate', option='decrease', part='longitude')
+            features['longitude_length_decrease'] = FeatureCreation.calc_length_increase_decrease(old_lon, new_lon, option='decrease')
         else:
             features['longitude_length_decrease'] = 0
 
-        features['longitude_same_float_value'] = FeatureCreation.same_float_value(old_value, new_value, datatype='globecoordinate', part='longitude')
-        features['latitude_same_float_value'] = FeatureCreation.same_float_value(old_value, new_value, datatype='globecoordinate', part='latitude')
+        features['longitude_same_float_value'] = FeatureCreation.same_float_value(old_lon_float, new_lon_float)
+        features['latitude_same_float_value'] = FeatureCreation.same_float_value(old_lat_float, new_lat_float)
 
         result = (
             features['latitude_sign_change'], 
@@ -797,6 +1070,177 @@ class FeatureCreation():
 
         return result
 
+    ########################################################################################################################
+    # Batch features
+    # Same features as create_quantity_features, create_globe_coordinate_features and create_time_features
+    # for lists of values (a page or a batch of rows of a feature table), calculated with NumPy.
+    # Values that aren't plain numbers (e.g. 1e-07) or dates that don't fit in int64 use the scalar functions,
+    # so the results are the same.
+    ########################################################################################################################
+    @staticmethod
+    def _plain_numbers(texts, floats):
+        return np.array([PLAIN_NUMBER_PATTERN.match(text) is not None for text in texts], dtype=bool) & np.isfinite(floats)
+
+    @staticmethod
+    def _number_features_batch(old_texts, new_texts, old_floats, new_floats):
+        """
+        Features of numbers (quantity amounts, latitudes or longitudes) from their texts and floats,
+        returns {feature: bool array} (only valid for plain numbers, see _plain_numbers)
+        """
+        old_texts = np.array(old_texts, dtype=np.str_)
+        new_texts = np.array(new_texts, dtype=np.str_)
+
+        features = dict()
+        with np.errstate(invalid='ignore', over='ignore'):
+            features['whole_number_change'] = np.floor(np.abs(old_floats)) != np.floor(np.abs(new_floats))
+            features['sign_change'] = (old_floats * new_floats < 0) & ~features['whole_number_change']
+
+        # precision change: same integer part, different decimal part (decimal parts with only zeros are '0')
+        old_parts = np.char.partition(old_texts, '.')
+        new_parts = np.char.partition(new_texts, '.')
+        old_dp = np.where(np.strings.str_len(old_parts[:, 2]) > np.strings.count(old_parts[:, 2], '0'), old_parts[:, 2], '0')
+        new_dp = np.where(np.strings.str_len(new_parts[:, 2]) > np.strings.count(new_parts[:, 2], '0'), new_parts[:, 2], '0')
+        features['precision_change'] = (old_parts[:, 0] == new_parts[:, 0]) & (old_dp != new_dp) & ((old_dp != '0') | (new_dp != '0'))
+
+        features['old_is_prefix_of_new'] = np.strings.startswith(new_texts, old_texts)
+        features['new_is_prefix_of_old'] = np.strings.startswith(old_texts, new_texts)
+
+        # number of digits
+        old_length = np.strings.str_len(old_texts) - np.strings.count(old_texts, '-') - np.strings.count(old_texts, '.')
+        new_length = np.strings.str_len(new_texts) - np.strings.count(new_texts, '-') - np.strings.count(new_texts, '.')
+        features['length_increase'] = features['old_is_prefix_of_new'] & (new_length > old_length)
+        features['length_decrease'] = features['new_is_prefix_of_old'] & (new_length < old_length)
+
+        features['same_float_value'] = old_floats == new_floats
+        return features
+
+    @staticmethod
+    def _to_feature_tuples(columns):
+        """[array per feature] -> [tuple of python ints per row]"""
+        return list(zip(*(column.astype(np.int64).tolist() for column in columns)))
+
+    @staticmethod
+    def create_quantity_features_batch(old_values, new_values):
+        """
+        create_quantity_features for lists of values (as they're passed to parse_quantity_value),
+        returns the list of feature tuples
+        """
+        if len(old_values) == 0:
+            return []
+
+        old_parsed = [FeatureCreation.parse_quantity_value(value) for value in old_values]
+        new_parsed = [FeatureCreation.parse_quantity_value(value) for value in new_values]
+
+        old_texts = [text for text, _ in old_parsed]
+        new_texts = [text for text, _ in new_parsed]
+        old_floats = np.array([number for _, number in old_parsed], dtype=np.float64)
+        new_floats = np.array([number for _, number in new_parsed], dtype=np.float64)
+
+        features = FeatureCreation._number_features_batch(old_texts, new_texts, old_floats, new_floats)
+        result = FeatureCreation._to_feature_tuples([features[col] for col in QUANTITY_ONLY_FEATURES_COLS_TYPES])
+
+        plain = FeatureCreation._plain_numbers(old_texts, old_floats) & FeatureCreation._plain_numbers(new_texts, new_floats)
+        for i in np.flatnonzero(~plain):
+            result[i] = FeatureCreation.create_quantity_features(old_parsed[i], new_parsed[i])
+
+        return result
+
+    @staticmethod
+    def create_globe_coordinate_features_batch(old_values, new_values):
+        """
+        create_globe_coordinate_features for lists of values (as they're passed to parse_globe_coordinate_value),
+        returns the list of feature tuples
+        """
+        if len(old_values) == 0:
+            return []
+
+        features = dict()
+        plain = np.ones(len(old_values), dtype=bool)
+        for part in ('latitude', 'longitude'):
+            old_parsed = [FeatureCreation.parse_coordinate(value[part]) for value in old_values]
+            new_parsed = [FeatureCreation.parse_coordinate(value[part]) for value in new_values]
+
+            old_texts = [text for text, _ in old_parsed]
+            new_texts = [text for text, _ in new_parsed]
+            old_floats = np.array([number for _, number in old_parsed], dtype=np.float64)
+            new_floats = np.array([number for _, number in new_parsed], dtype=np.float64)
+
+            part_features = FeatureCreation._number_features_batch(old_texts, new_texts, old_floats, new_floats)
+            features.update((f'{part}_{feature}', values) for feature, values in part_features.items())
+            plain &= FeatureCreation._plain_numbers(old_texts, old_floats) & FeatureCreation._plain_numbers(new_texts, new_floats)
+
+        result = FeatureCreation._to_feature_tuples([features[col] for col in GLOBE_ONLY_FEATURES_COLS_TYPES])
+
+        for i in np.flatnonzero(~plain):
+            result[i] = FeatureCreation.create_globe_coordinate_features(
+                FeatureCreation.parse_globe_coordinate_value(old_values[i]), 
+                FeatureCreation.parse_globe_coordinate_value(new_values[i])
+            )
+
+        return result
+
+    @staticmethod
+    def create_time_features_batch(old_values, new_values):
+        """
+        create_time_features for lists of values (as they're passed to parse_time_value),
+        returns the list of feature tuples
+        """
+        if len(old_values) == 0:
+            return []
+
+        old_parsed = [FeatureCreation.parse_time_value(value) for value in old_values]
+        new_parsed = [FeatureCreation.parse_time_value(value) for value in new_values]
+
+        # some_value/no_value and years that don't fit in int64 use create_time_features
+        dated = np.array([
+            old_date is not None and new_date is not None and abs(old_date[0]) < MAX_BATCH_YEAR and abs(new_date[0]) < MAX_BATCH_YEAR
+            for (_, old_date), (_, new_date) in zip(old_parsed, new_parsed)
+        ], dtype=bool)
+
+        old_dates = np.array([date if ok else (0, 0, 0) for (_, date), ok in zip(old_parsed, dated)], dtype=np.int64).reshape(-1, 3)
+        new_dates = np.array([date if ok else (0, 0, 0) for (_, date), ok in zip(new_parsed, dated)], dtype=np.int64).reshape(-1, 3)
+        year1, month1, day1 = old_dates[:, 0], old_dates[:, 1], old_dates[:, 2]
+        year2, month2, day2 = new_dates[:, 0], new_dates[:, 1], new_dates[:, 2]
+        same_year = year1 == year2
+
+        features = dict()
+        features['date_diff_days'] = (np.abs(year2 - year1) * 365.25).astype(np.int64) + (np.abs(month2 - month1) * 30.44).astype(np.int64) + np.abs(day2 - day1)
+        features['sign_change'] = np.array([old_text[1:] == new_text[1:] for (old_text, _), (new_text, _) in zip(old_parsed, new_parsed)], dtype=bool)
+
+        # YYYY-01-01 -> YYYY-00-00, YYYY-MM-01 -> YYYY-MM-00, YYYY-01-00 -> YYYY-00-00
+        placeholder_to_zero = ((month1 == 1) & (day1 == 1) & (month2 == 0) & (day2 == 0)) | \
+                          ((month1 == month2) & (month1 > 1) & (day1 == 1) & (day2 == 0)) | \
+                          ((month1 == 1) & (month2 == 0) & (day1 == 0) & (day2 == 0))
+        features['change_one_to_zero'] = same_year & placeholder_to_zero
+
+        month_day_to_ones = (month1 > 1) & (day1 > 1) & (month2 == 1) & (day2 == 1)
+        features['day_added'] = same_year & (((day1 == 0) & (day2 > 0)) | ((day1 == 1) & (day2 > 1) & (month1 == 1) & (month2 > 1)))
+        features['day_removed'] = same_year & (month_day_to_ones | ((day1 > 0) & (day2 == 0) & ~((day1 == 1) & (day2 == 0))))
+        features['month_added'] = same_year & (((month1 == 0) & (month2 > 0) & (day1 == 0)) | ((month1 == 1) & (month2 > 1) & (day1 == 1) & ((day2 > 1) | (day2 == 0))))
+        features['month_removed'] = same_year & (month_day_to_ones | ((month1 > 0) & (month2 == 0) & ~((day1 == 1) & (day2 == 0)) & ~((day1 == 0) & (day2 == 0))))
+
+        # reformatting, refinement and unrefinement of date_part_changed
+        part_reformatting = same_year & (((month1 == 1) & (day1 == 1) & (day2 == 0) & (month2 == 0)) | \
+                                         ((month1 > 0) & (month2 > 0) & (month1 == month2) & (day1 == 1) & (day2 == 0)) | \
+                                         ((month1 == 1) & (month2 == 0) & (day1 == 0) & (day2 == 0)))
+        month_refinement = same_year & (((month1 == 0) & (month2 > 0) & (day2 == 0)) | \
+                                        ((month1 == 1) & (day1 == 1) & (month2 > 1) & ((day2 > 1) | (day2 == 0))) | \
+                                        ((month1 == 0) & (month2 > 0) & (day1 == 0) & (day2 > 0)))
+        month_unrefinement = same_year & (month2 == 0) & (month1 > 0)
+        day_refinement = same_year & (((day1 == 0) & (day2 > 0)) | ((day1 == 1) & (day2 > 1) & (month1 == 1) & (month2 > 1)))
+        day_unrefinement = same_year & (day2 == 0) & (day1 > 0)
+
+        features['different_year'] = ~same_year
+        features['different_day'] = (day1 != day2) & ~part_reformatting & ~day_refinement & ~day_unrefinement
+        features['different_month'] = (month1 != month2) & ~part_reformatting & ~month_refinement & ~month_unrefinement
+
+        result = FeatureCreation._to_feature_tuples([features[col] for col in TIME_ONLY_FEATURES_COLS_TYPES])
+
+        for i in np.flatnonzero(~dated):
+            result[i] = FeatureCreation.create_time_features(old_parsed[i], new_parsed[i])
+
+        return result
+
     ########################################################################################################################
     # Entity features
     ########################################################################################################################
@@ -808,7 +1252,11 @@ class FeatureCreation():
         old_value_label = row['old_value_label']
         new_value_label = row['new_value_label']
 
-        features_tuple = FeatureCreation.create_text_features('entity', old_value_label, new_value_label)
+        if 'text_features' in row:
+            # calculated for the whole batch (see create_all_features_entity)
+            features_tuple = row['text_features']
+        else:
+            features_tuple = FeatureCreation.create_text_features('entity', old_value_label, new_value_label)
         # ['token_overlap', 'old_in_new', 'new_in_old', 'edit_distance_ratio', 'complete_replacement', 'label_cosine_similarity', 'description_cosine_similarity', 'is_link_change', 
         # 'old_value_subclass_new_value', 'new_value_subclass_old_value', 'old_value_located_in_new_value', 'new_value_located_in_old_value', 'old_value_has_parts_new_value', 'new_value_has_parts_old_value', 'old_value_part_of_new_value', 'new_value_part_of_old_value']
 
@@ -1204,7 +1652,7 @@ class FeatureCreation():
     ####################################################################################################
     # Update of features that weren't calculated during parsinf of the file
     ####################################################################################################
-    def create_and_update_embedding_features(self, datatype, key_cols, select_cols, embedding_cols, table_prefix, batch_size=100000, max_batches=None):
+    def create_and_update_embedding_features(self, datatype, key_cols, select_cols, embedding_cols, table_prefix, batch_size=100000, max_batches=None, key_range=None):
         """
         Creates and updates embedding features for the given datatype. Processes in batches.
         
@@ -1214,6 +1662,7 @@ class FeatureCreation():
         :param table_prefix: can be _sa, _ao, _less or ''
         :param batch_size: number of rows to process in each batch
         :param max_batches: maximum number of batches to process (optional)
+        :param key_range: only the rows with revision_id in [start, end) (optional, see parallel_backfill.py)
         """
         print('Creating embedding features for datatype:', datatype, flush=True)
         main_start_time = time.time()
@@ -1222,31 +1671,35 @@ class FeatureCreation():
             print('No DB connection available', flush=True)
             return
 
-        base_query = """
-            SELECT {key_cols_str}, {select_cols_str}, {embedding_cols_str}
-                FROM features_{datatype}{table_prefix}
-                WHERE 
-                    (label IS NULL or label = '') AND 
-                    ({embedding_cols_str_filter}) AND 
-                    processed = FALSE
-                LIMIT {batch_size}
-        """
+        table = f'features_{datatype}{table_prefix}'
+        job = self.key_range_job(f'embedding_{datatype}{table_prefix}', key_range)
+        filter_str = f"(label IS NULL or label = '') AND ({' OR '.join([f'({col} IS NULL OR {col} = 0.0)' for col in embedding_cols])}) AND {self.key_range_filter(key_range)}"
         
         num_batches = 0
 
         embedding_cols_str = ', '.join(embedding_cols)
-        key_cols_str = ', '.join(key_cols)
+        key_cols_str = self.get_key_cols_str(key_cols)
         select_cols_str = ', '.join(select_cols)
         
-        key_cols_temp = ', '.join([f'{col} {col_type}' for col, col_type in BASE_KEY_TYPES.items()])
+        key_cols_temp = self.get_key_cols_temp()
 
         cursor = self.conn.cursor()
-        cursor.execute(f"CREATE TEMP TABLE temp_results_{datatype}{table_prefix} ({key_cols_temp}, {', '.join([f'{col} FLOAT' for col in embedding_cols])})")
+        last_key, num_rows = self.get_backfill_last_key(cursor, job)
+        if self.side_tables:
+            results_table = self.create_side_table(cursor, table, 'embedding_features', {col: 'FLOAT' for col in embedding_cols})
+            self.clear_side_table(cursor, results_table, key_range, last_key)
+        else:
+            results_table = f'temp_results_{datatype}{table_prefix}'
+            cursor.execute(f"CREATE TEMP TABLE {results_table} ({key_cols_temp}, {', '.join([f'{col} FLOAT' for col in embedding_cols])})")
         self.conn.commit()
 
+        if last_key is not None:
+            print(f'Continuing after {last_key} ({num_rows} rows already updated)', flush=True)
+
         # load model
-        model = SentenceTransformer('all-MiniLM-L6-v2')
+        model = self.get_encoder()
 
+        finished = False
         while True:
 
             if max_batches:
@@ -1258,50 +1711,50 @@ class FeatureCreation():
             
             if not os.path.exists(f'{DATA_PATH}/{datatype}{table_prefix}/chunk_{num_batches}.csv'):
 
-                query = base_query.format(
-                    key_cols_str = key_cols_str,
-                    select_cols_str=select_cols_str,
-                    embedding_cols_str=embedding_cols_str,
-                    embedding_cols_str_filter = f' OR '.join([f'({col} IS NULL OR {col} = 0.0)' for col in embedding_cols]),
-                    datatype=datatype,
-                    table_prefix=table_prefix,
-                    batch_size=batch_size
-                )
-            
-                df = query_to_df(self.conn, query)
+                rows, colnames = self.read_batch_after_key(table, f'{key_cols_str}, {select_cols_str}, {embedding_cols_str}', filter_str, last_key, batch_size)
                 
-                if len(df) == 0:
+                if len(rows) == 0:
+                    finished = True
                     break
 
+                df = pd.DataFrame(rows, columns=colnames)
+                last_key = list(rows[-1][:len(key_cols)])
+                num_rows += len(rows)
+                del rows
+
                 result = self.create_embedding_features(model, df, old_col='old_value', new_col='new_value')
                 result = result[[*key_cols, *embedding_cols]]
 
                 buffer = io.StringIO()
                 result.to_csv(buffer, index=False, header=False, sep=';', quoting=csv.QUOTE_ALL, escapechar='\\')
                 buffer.seek(0)
-                cursor.copy_expert(f"COPY temp_results_{datatype}{table_prefix} FROM STDIN (FORMAT CSV, DELIMITER ';', QUOTE '\"', ESCAPE '\\')", buffer)
+                cursor.copy_expert(f"COPY {results_table} FROM STDIN (FORMAT CSV, DELIMITER ';', QUOTE '\"', ESCAPE '\\')", buffer)
+
+                # saved with the update of the batch
+                self.save_backfill_last_key(cursor, job, last_key, num_rows)
 
             else:
                 batch_file = f'{DATA_PATH}/{datatype}{table_prefix}/chunk_{num_batches}.csv'
                 with open(batch_file, 'r') as f:
-                    cursor.copy_expert(f"COPY temp_results_{datatype}{table_prefix} FROM STDIN (FORMAT CSV, DELIMITER ';', QUOTE '\"', ESCAPE '\\')", f)
+                    cursor.copy_expert(f"COPY {results_table} FROM STDIN (FORMAT CSV, DELIMITER ';', QUOTE '\"', ESCAPE '\\')", f)
 
                 os.remove(batch_file)
 
-            print('Updating change table', flush=True)
+            if not self.side_tables:
+                print('Updating change table', flush=True)
 
-            # Update embedding features
-            query = f"""
-                UPDATE features_{datatype}{table_prefix} sf
-                SET {', '.join([f'{col} = tp.{col}' for col in embedding_cols])}, processed = TRUE
-                FROM temp_results_{datatype}{table_prefix} tp 
-                WHERE 
-                    (sf.label = '' OR sf.label IS NULL) AND
-                    {' AND '.join([f'sf.{col} = tp.{col}' if col != 'change_target' else f"COALESCE(sf.{col}, '') = COALESCE(tp.{col}, '')" for col in key_cols])}
-            """
-            cursor.execute(query)
+                # Update embedding features (change_target is part of the primary key, so it's never NULL and the join can use the index)
+                query = f"""
+                    UPDATE {table} sf
+                    SET {', '.join([f'{col} = tp.{col}' for col in embedding_cols])}
+                    FROM {results_table} tp 
+                    WHERE 
+                        (sf.label = '' OR sf.label IS NULL) AND
+                        {' AND '.join([f'sf.{col} = tp.{col}' for col in key_cols])}
+                """
+                cursor.execute(query)
 
-            cursor.execute(f"TRUNCATE TABLE temp_results_{datatype}{table_prefix}")
+                cursor.execute(f"TRUNCATE TABLE {results_table}")
 
             self.conn.commit()
 
@@ -1309,7 +1762,13 @@ class FeatureCreation():
 
         print(f'Created {num_batches} batches for embedding features update', flush=True)
 
-        cursor.execute(f"DROP TABLE temp_results_{datatype}{table_prefix}")
+        if finished:
+            self.finish_backfill(cursor, job)
+        if not self.side_tables:
+            cursor.execute(f"DROP TABLE {results_table}")
+        elif key_range is None:
+            # parallel_backfill.py creates the view when all the ranges are done
+            self.create_side_table_view(cursor, table)
         self.conn.commit()
 
         final_end_time = time.time() - main_start_time
@@ -1334,19 +1793,37 @@ class FeatureCreation():
             print(f'Updating {suffix}_value_label, {suffix}_value_description in the features_entity{table_suffix}', flush=True)
             start_time = time.time()
 
-            cursor.execute(f"""
-                UPDATE features_entity{table_suffix} fe
-                SET 
-                    {suffix}_value_label =
-                        CASE 
-                            WHEN elad.label IS NOT NULL AND elad.label <> '' THEN elad.label
-                            ELSE elad.alias 
-                        END
-                    ,
-                    {suffix}_value_description = elad.description
-                FROM entity_labels_alias_description elad
-                WHERE elad.qid::TEXT = fe.{suffix}_value->>0 AND (fe.{suffix}_value_label IS NULL OR fe.{suffix}_value_label = '')
-            """)
+            if self.typed_values:
+                # the numeric id of the item is in value_change, so the join can use the index on numeric_id
+                cursor.execute(f"""
+                    UPDATE features_entity{table_suffix} fe
+                    SET 
+                        {suffix}_value_label =
+                            CASE 
+                                WHEN elad.label IS NOT NULL AND elad.label <> '' THEN elad.label
+                                ELSE elad.alias 
+                            END
+                        ,
+                        {suffix}_value_description = elad.description
+                    FROM value_change{table_suffix} vc, entity_labels_alias_description elad
+                    WHERE vc.revision_id = fe.revision_id AND vc.property_id = fe.property_id 
+                        AND vc.value_id = fe.value_id AND vc.change_target = fe.change_target
+                        AND elad.numeric_id = vc.{suffix}_value_entity AND (fe.{suffix}_value_label IS NULL OR fe.{suffix}_value_label = '')
+                """)
+            else:
+                cursor.execute(f"""
+                    UPDATE features_entity{table_suffix} fe
+                    SET 
+                        {suffix}_value_label =
+                            CASE 
+                                WHEN elad.label IS NOT NULL AND elad.label <> '' THEN elad.label
+                                ELSE elad.alias 
+                            END
+                        ,
+                        {suffix}_value_description = elad.description
+                    FROM entity_labels_alias_description elad
+                    WHERE elad.qid::TEXT = fe.{suffix}_value->>0 AND (fe.{suffix}_value_label IS NULL OR fe.{suffix}_value_label = '')
+                """)
             
             self.conn.commit()
 
@@ -1356,10 +1833,11 @@ class FeatureCreation():
             print(f'Finished updating {suffix}_value_label and {suffix}_value_description in {final_time} {unit}', flush=True)
 
 
-    def create_all_features_entity(self, table_suffix, max_batches=None):
+    def create_all_features_entity(self, table_suffix, max_batches=None, key_range=None):
         
-        # transitive closure 
-        self.transitive_cache = TransitiveClosureCache()
+        # transitive closure (loaded once, parallel_backfill.py calls this for each range)
+        if getattr(self, 'transitive_cache', None) is None:
+            self.transitive_cache = TransitiveClosureCache()
 
         datatype = 'entity'
 
@@ -1373,47 +1851,59 @@ class FeatureCreation():
         feature_cols_str = ', '.join(ENTITY_ONLY_FEATURES_COLS)
 
         key_cols = ['revision_id', 'property_id', 'value_id', 'change_target']
-        key_cols_str = ', '.join(key_cols)
+        key_cols_str = self.get_key_cols_str(key_cols)
 
         batch_size = 100000
         num_batches = 0
 
         cursor = self.conn.cursor()
 
-        key_cols_temp = ', '.join([f'{col} {col_type}' for col, col_type in BASE_KEY_TYPES.items()])
-        cursor.execute(f"CREATE TEMP TABLE temp_results_{datatype}{table_suffix} ({key_cols_temp}, {', '.join([f'{col} {col_type}' for col, col_type in ENTITY_ONLY_FEATURES_COLS_TYPES.items()])})")
+        table = f'features_{datatype}{table_suffix}'
+        job = self.key_range_job(table, key_range)
+        last_key, num_rows = self.get_backfill_last_key(cursor, job)
+        if self.side_tables:
+            results_table = self.create_side_table(cursor, table, 'entity_features', ENTITY_ONLY_FEATURES_COLS_TYPES)
+            self.clear_side_table(cursor, results_table, key_range, last_key)
+        else:
+            results_table = f'temp_results_{datatype}{table_suffix}'
+            cursor.execute(f"CREATE TEMP TABLE {results_table} ({self.get_key_cols_temp()}, {', '.join([f'{col} {col_type}' for col, col_type in ENTITY_ONLY_FEATURES_COLS_TYPES.items()])})")
         self.conn.commit()
 
+        if last_key is not None:
+            print(f'Continuing after {last_key} ({num_rows} rows already updated)', flush=True)
+
         # load model for embedding features
-        model = SentenceTransformer('all-MiniLM-L6-v2')
+        model = self.get_encoder()
 
         start_time = time.time()
         
+        finished = False
         while True:
 
             if max_batches and num_batches >= max_batches:
                 print(f'Reached max_batches limit ({max_batches}), stopping', flush=True)
                 break
 
-            query = """
-                SELECT {key_cols_str}, {select_cols_str}, {feature_cols_str}
-                    FROM features_entity{table_suffix}
-                    WHERE 
-                        (label IS NULL or label = '') and processed = FALSE
-                    LIMIT {batch_size}
-            """.format(
-                key_cols_str=key_cols_str,
-                select_cols_str=select_cols_str,
-                feature_cols_str=feature_cols_str,
-                table_suffix=table_suffix,
-                batch_size=batch_size
+            rows, colnames = self.read_batch_after_key(
+                table,
+                f'{key_cols_str}, {select_cols_str}, {feature_cols_str}',
+                f"(label IS NULL or label = '') AND {self.key_range_filter(key_range)}",
+                last_key,
+                batch_size
             )
-            df = query_to_df(self.conn, query)
             
-            if len(df) == 0:
+            if len(rows) == 0:
+                finished = True
                 break
+
+            df = pd.DataFrame(rows, columns=colnames)
+            last_key = list(rows[-1][:len(key_cols)])
+            num_rows += len(rows)
+            num_batches += 1
+            del rows
             
             # --------------- create text features + transitive closure features ---------------
+            df['text_features'] = FeatureCreation.create_text_features_batch('entity', df['old_value_label'], df['new_value_label'])
             df[ENTITY_ONLY_FEATURES_COLS] = df.apply(
                 lambda row: self.create_entity_features_text_transitive(row, self.transitive_cache),
                 axis=1
@@ -1436,24 +1926,28 @@ class FeatureCreation():
             buffer = io.StringIO()
             result.to_csv(buffer, index=False, header=False, sep=';', quoting=csv.QUOTE_ALL, escapechar='\\')
             buffer.seek(0)
-            cursor.copy_expert(f"COPY temp_results_{datatype}{table_suffix} FROM STDIN (FORMAT CSV, DELIMITER ';', QUOTE '\"', ESCAPE '\\')", buffer)
+            cursor.copy_expert(f"COPY {results_table} FROM STDIN (FORMAT CSV, DELIMITER ';', QUOTE '\"', ESCAPE '\\')", buffer)
 
             del result
             del df
 
-            # --------------- Updating feature table ---------------
-            print('Updating feature table', flush=True)
+            if not self.side_tables:
+                # --------------- Updating feature table ---------------
+                print('Updating feature table', flush=True)
+
+                cursor.execute(f"""
+                    UPDATE {table} f
+                    SET {', '.join([f'{col} = tp.{col}' for col in ENTITY_ONLY_FEATURES_COLS])}
+                    FROM {results_table} tp
+                    WHERE 
+                        (f.label = '' OR f.label IS NULL) AND
+                        {' AND '.join([f'f.{col} = tp.{col}' for col in key_cols])}
+                """)
 
-            cursor.execute(f"""
-                UPDATE features_{datatype}{table_suffix} f
-                SET {', '.join([f'{col} = tp.{col}' for col in ENTITY_ONLY_FEATURES_COLS])}, processed = TRUE
-                FROM temp_results_{datatype}{table_suffix} tp
-                WHERE 
-                    (f.label = '' OR f.label IS NULL) AND
-                    {' AND '.join([f'f.{col} = tp.{col}' if col != 'change_target' else f"COALESCE(f.{col}, '') = COALESCE(tp.{col}, '')" for col in key_cols])}
-            """)
+                cursor.execute(f"TRUNCATE TABLE {results_table}")
 
-            cursor.execute(f"TRUNCATE TABLE temp_results_{datatype}{table_suffix}")
+            # saved with the update of the batch
+            self.save_backfill_last_key(cursor, job, last_key, num_rows)
 
             self.conn.commit()
             
@@ -1461,7 +1955,117 @@ class FeatureCreation():
         final_time, unit = get_time_unit(elapsed_time)
         print(f'Finished entity feature creation {final_time} {unit}', flush=True)    
 
-        cursor.execute(f"DROP TABLE temp_results_{datatype}{table_suffix}")
+        if finished:
+            self.finish_backfill(cursor, job)
+        if not self.side_tables:
+            cursor.execute(f"DROP TABLE {results_table}")
+        elif key_range is None:
+            self.create_side_table_view(cursor, table)
+
+        self.conn.commit()
+
+
+    def create_all_features_batch(self, datatype, table_suffix, max_batches=None, key_range=None):
+        """
+        (Re)calculates the text, quantity, time or globecoordinate features of features_{datatype}{table_suffix}
+        from old_value and new_value with the batch functions (of the rows with revision_id in key_range = [start, end) if it's given).
+        Only runs with feature_backfill.recompute_extracted_features, the features are calculated during change extraction
+        """
+        def create_text_features_batch(old_values, new_values):
+            # the text features are calculated from the serialized values (see PageParser.serialize_value)
+            return FeatureCreation.create_text_features_batch(
+                'text',
+                [json.dumps(value, ensure_ascii=False) if value is not None else None for value in old_values],
+                [json.dumps(value, ensure_ascii=False) if value is not None else None for value in new_values],
+            )
+
+        feature_cols_types, create_features_batch = {
+            'text': (TEXT_ONLY_FEATURES_COLS_TYPES, create_text_features_batch),
+            'quantity': (QUANTITY_ONLY_FEATURES_COLS_TYPES, FeatureCreation.create_quantity_features_batch),
+            'time': (TIME_ONLY_FEATURES_COLS_TYPES, FeatureCreation.create_time_features_batch),
+            'globecoordinate': (GLOBE_ONLY_FEATURES_COLS_TYPES, FeatureCreation.create_globe_coordinate_features_batch),
+        }[datatype]
+        feature_cols = list(feature_cols_types.keys())
+
+        key_cols = ['revision_id', 'property_id', 'value_id', 'change_target']
+        key_cols_str = self.get_key_cols_str(key_cols)
+
+        batch_size = 100000
+        num_batches = 0
+
+        cursor = self.conn.cursor()
+
+        table = f'features_{datatype}{table_suffix}'
+        job = self.key_range_job(f'{table}_batch', key_range)
+        last_key, num_rows = self.get_backfill_last_key(cursor, job)
+        if self.side_tables:
+            results_table = self.create_side_table(cursor, table, 'batch_features', feature_cols_types)
+            self.clear_side_table(cursor, results_table, key_range, last_key)
+        else:
+            results_table = f'temp_results_{datatype}{table_suffix}'
+            cursor.execute(f"CREATE TEMP TABLE {results_table} ({self.get_key_cols_temp()}, {', '.join([f'{col} {col_type}' for col, col_type in feature_cols_types.items()])})")
+        self.conn.commit()
+
+        if last_key is not None:
+            print(f'Continuing after {last_key} ({num_rows} rows already updated)', flush=True)
+
+        start_time = time.time()
+
+        finished = False
+        while True:
+
+            if max_batches and num_batches >= max_batches:
+                print(f'Reached max_batches limit ({max_batches}), stopping', flush=True)
+                break
+
+            rows, _ = self.read_batch_after_key(table, f'{key_cols_str}, old_value, new_value', self.key_range_filter(key_range), last_key, batch_size)
+            if len(rows) == 0:
+                finished = True
+                break
+            last_key = list(rows[-1][:len(key_cols)])
+            num_rows += len(rows)
+            num_batches += 1
+
+            # old_value and new_value are JSONB, psycopg2 returns the values as they were before being serialized
+            features = create_features_batch([row[4] for row in rows], [row[5] for row in rows])
+
+            result = pd.DataFrame([row[:4] + f for row, f in zip(rows, features)], columns=[*key_cols, *feature_cols])
+
+            buffer = io.StringIO()
+            result.to_csv(buffer, index=False, header=False, sep=';', quoting=csv.QUOTE_ALL, escapechar='\\')
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY {results_table} FROM STDIN (FORMAT CSV, DELIMITER ';', QUOTE '\"', ESCAPE '\\')", buffer)
+
+            del result
+
+            if not self.side_tables:
+                # --------------- Updating feature table ---------------
+                print(f'Updating feature table ({len(rows)} rows)', flush=True)
+
+                cursor.execute(f"""
+                    UPDATE {table} f
+                    SET {', '.join([f'{col} = tp.{col}' for col in feature_cols])}
+                    FROM {results_table} tp
+                    WHERE {' AND '.join([f'f.{col} = tp.{col}' for col in key_cols])}
+                """)
+
+                cursor.execute(f"TRUNCATE TABLE {results_table}")
+
+            # saved with the update of the batch
+            self.save_backfill_last_key(cursor, job, last_key, num_rows)
+
+            self.conn.commit()
+
+        elapsed_time = time.time() - start_time
+        final_time, unit = get_time_unit(elapsed_time)
+        print(f'Finished {datatype} feature creation {final_time} {unit}', flush=True)
+
+        if finished:
+            self.finish_backfill(cursor, job)
+        if not self.side_tables:
+            cursor.execute(f"DROP TABLE {results_table}")
+        elif key_range is None:
+            self.create_side_table_view(cursor, table)
 
         self.conn.commit()
 
@@ -1486,7 +2090,13 @@ class FeatureCreation():
 
         if datatype == 'entity':
             self.create_all_features_entity(table_suffix, max_batches=max_batches)
+        elif datatype in ['quantity', 'time', 'globecoordinate']:
+            if self.recompute_extracted_features:
+                self.create_all_features_batch(datatype, table_suffix, max_batches=max_batches)
         elif datatype == 'text':
+            if self.recompute_extracted_features:
+                self.create_all_features_batch(datatype, table_suffix, max_batches=max_batches)
+
             key_cols = ['revision_id', 'property_id', 'value_id', 'change_target']
             select_cols = ['old_value', 'new_value']
             embedding_cols = ['value_cosine_similarity']
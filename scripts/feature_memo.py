@@ -0,0 +1,139 @@
+from collections import OrderedDict
+from multiprocessing.managers import BaseManager
+
+"""
+    Feature memo (change_extraction_processing.feature_memo_size)
+
+    Bots make the same change in many items (e.g. the same calendar model fix or label swap), so the page workers
+    calculate the features of the same (old_value, new_value) pairs again and again.
+    FeatureMemo keeps the features of the last feature_memo_size pairs of each worker (LRU), keyed by
+    (datatype, old_value, new_value) with the serialized values, so a hit always has the features of the same values.
+    Values longer than feature_memo_max_value_length aren't memoized (long texts rarely repeat).
+
+    With feature_memo_shared, the pairs a worker doesn't have are looked up in a SharedFeatureMemo,
+    served by a manager process to all the page workers of a file. It's queried once per page and datatype (get_many / put_many).
+"""
+
+
+class SharedFeatureMemo():
+    """Features of (datatype, old_value, new_value) shared by the workers, the oldest pairs are removed when it's full"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.features = {}
+
+    def get_many(self, keys):
+        """{key: features} of the keys that are in the memo"""
+        return {key: self.features[key] for key in keys if key in self.features}
+
+    def put_many(self, items):
+        for key, features in items.items():
+            self.features[key] = features
+        # dicts keep the insertion order
+        while len(self.features) > self.max_entries:
+            del self.features[next(iter(self.features))]
+
+
+class FeatureMemoManager(BaseManager):
+    pass
+
+FeatureMemoManager.register('SharedFeatureMemo', SharedFeatureMemo)
+
+
+def create_shared_feature_memo(set_up):
+    """
+        Starts the manager process of the shared memo if feature_memo_shared is set.
+        Returns (manager, shared memo proxy) or (None, None)
+    """
+    processing = set_up.get('change_extraction_processing', {})
+    if not processing.get('feature_memo_shared', False) or processing.get('feature_memo_size', 50000) <= 0:
+        return None, None
+
+    manager = FeatureMemoManager()
+    manager.start()
+    return manager, manager.SharedFeatureMemo(processing.get('feature_memo_shared_size', 1000000))
+
+
+class FeatureMemo():
+    """
+        LRU memo of the features of a page worker, in front of a SharedFeatureMemo (optional).
+        Features are stored as the tuples returned by FeatureCreation.create_*_features.
+    """
+
+    def __init__(self, max_entries=50000, max_value_length=256, shared=None):
+        self.max_entries = max_entries
+        self.max_value_length = max_value_length
+        self.shared = shared
+        self.features = OrderedDict()
+
+        # STATS
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.skipped = 0 # values too long to be memoized
+
+    @staticmethod
+    def from_set_up(set_up, shared=None):
+        """FeatureMemo with the sizes of change_extraction_processing, None if feature_memo_size is 0"""
+        processing = set_up.get('change_extraction_processing', {})
+        max_entries = processing.get('feature_memo_size', 50000)
+        if max_entries <= 0:
+            return None
+        return FeatureMemo(max_entries, processing.get('feature_memo_max_value_length', 256), shared)
+
+    def memoizable(self, old_value, new_value):
+        return (old_value is None or len(old_value) <= self.max_value_length) and \
+            (new_value is None or len(new_value) <= self.max_value_length)
+
+    def get_many(self, datatype, pairs):
+        """
+            Features of the (old_value, new_value) pairs (None for the pairs that aren't memoized).
+            Pairs missing in the worker memo are looked up in the shared memo in one call.
+        """
+        results = [None] * len(pairs)
+        missing = {}
+        for i, (old_value, new_value) in enumerate(pairs):
+            if not self.memoizable(old_value, new_value):
+                self.skipped += 1
+                continue
+            key = (datatype, old_value, new_value)
+            features = self.features.get(key)
+            if features is not None:
+                self.features.move_to_end(key)
+                self.hits += 1
+                results[i] = features
+            else:
+                missing.setdefault(key, []).append(i)
+
+        if missing and self.shared is not None:
+            for key, features in self.shared.get_many(list(missing)).items():
+                self._put(key, features)
+                for i in missing.pop(key):
+                    results[i] = features
+                    self.shared_hits += 1
+
+        self.misses += sum(len(idx) for idx in missing.values())
+        return results
+
+    def put_many(self, datatype, pairs, features):
+        """Stores the features of the (old_value, new_value) pairs (calculated after a miss)"""
+        items = {}
+        for (old_value, new_value), f in zip(pairs, features):
+            if self.memoizable(old_value, new_value):
+                key = (datatype, old_value, new_value)
+                self._put(key, f)
+                items[key] = f
+        if items and self.shared is not None:
+            self.shared.put_many(items)
+
+    def _put(self, key, features):
+        self.features[key] = features
+        self.features.move_to_end(key)
+        if len(self.features) > self.max_entries:
+            self.features.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.shared_hits + self.misses
+        hit_rate = (self.hits + self.shared_hits) / lookups * 100 if lookups > 0 else 0
+        return (f"{lookups} lookups, {self.hits} hits, {self.shared_hits} shared hits, {self.misses} misses "
+                f"({hit_rate:.1f}% hit rate), {self.skipped} not memoized, {len(self.features)} entries")
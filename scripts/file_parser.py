@@ -1,5 +1,6 @@
 import sys
 import multiprocessing as mp
+import multiprocessing.queues
 import time
 import queue
 import bz2
@@ -16,13 +17,18 @@ import gc
 
 from scripts.page_parser import PageParser
 from scripts.const import *
-from scripts.db_writer import batch_insert
-from scripts.utils import print_exception_details
+from scripts.db_writer import AdaptiveBatchPolicy, BatchFlusher
+from scripts.sinks import create_sink, get_db_connection
+from scripts.transport import PipeResultsChannel, pack_results_batch, unpack_results_message, get_table_suffix, get_loaded_pages
+from scripts.load_manifest import LoadedPages
+from scripts.feature_memo import FeatureMemo, create_shared_feature_memo
+from scripts.utils import print_exception_details, extend_rows, EncodedRows
 
-def process_page_xml(page_elem_str, file_path, set_up, property_labels, astronomical_object_types, scholarly_article_types):
+def process_page_xml(page_elem_str, file_path, set_up, property_labels, astronomical_object_types, scholarly_article_types, feature_memo=None):
 
     parser = PageParser(file_path=file_path, page_elem_str=page_elem_str, set_up=set_up, property_labels=property_labels, 
-                        astronomical_object_types=astronomical_object_types, scholarly_article_types=scholarly_article_types)
+                        astronomical_object_types=astronomical_object_types, scholarly_article_types=scholarly_article_types,
+                        feature_memo=feature_memo)
     try:
         results = parser.process_page()
         return results
@@ -38,7 +44,22 @@ class FileParser():
         self.set_up = set_up
         self.file_path = file_path
         
-        self.batch_size = self.set_up.get('change_extraction_processing', {}).get('db_batch_size', 5000)
+        # results of several entities are sent to the db_writer in one message (1 = one message per entity)
+        self.worker_batch_max_entities = self.set_up.get('change_extraction_processing', {}).get('worker_batch_max_entities', 1)
+        self.worker_batch_max_rows = self.set_up.get('change_extraction_processing', {}).get('worker_batch_max_rows', 50000)
+        self.worker_batch_max_seconds = self.set_up.get('change_extraction_processing', {}).get('worker_batch_max_seconds', 5)
+        self.results_compression = self.set_up.get('change_extraction_processing', {}).get('results_compression', 'none')
+
+        # rows are encoded for COPY by the page workers, so the db_writer only streams them (only for the postgres and spool sinks,
+        # with compact_schema or binary_keys the db_writer needs the rows to convert their columns)
+        self.encode_results = (self.set_up.get('change_extraction_processing', {}).get('encode_results_in_workers', False)
+                               and self.set_up.get('change_extraction_processing', {}).get('output_sink', 'postgres') in ('postgres', 'spool')
+                               and not self.set_up.get('change_extraction_processing', {}).get('compact_schema', False)
+                               and not self.set_up.get('change_extraction_processing', {}).get('binary_keys', False))
+
+        # pages stored in the DB are recorded in load_manifest and skipped when the file is processed again (see load_manifest.py)
+        self.load_manifest = self.set_up.get('change_extraction_processing', {}).get('load_manifest', False)
+        self.pages_skipped = 0
 
         # STATS
         self.total_revisions = 0
@@ -70,7 +91,10 @@ class FileParser():
             self.owns_writer = False
         else:
             # Fallback for single-file mode
-            self.results_queue = mp.Queue()
+            if self.set_up.get('change_extraction_processing', {}).get('results_transport', 'queue') == 'pipe':
+                self.results_queue = PipeResultsChannel(max_in_flight=self.set_up.get('change_extraction_processing', {}).get('results_max_in_flight', 64))
+            else:
+                self.results_queue = mp.Queue()
             self.writer_process = mp.Process(target=self._db_writer)
             self.writer_process.start()
             self.owns_writer = True
@@ -87,6 +111,9 @@ class FileParser():
         df = pd.read_csv(PROPERTY_LABELS_PATH, names=['property_id', 'property_label'], header=None)
         self.PROPERTY_LABELS = dict(zip(df['property_id'], df['property_label']))
 
+        # memo of the features shared by the workers (feature_memo_shared, see feature_memo.py)
+        self.feature_memo_manager, self.shared_feature_memo = create_shared_feature_memo(self.set_up)
+
         # START WORKERS THAT PROCESS PAGES IN PARALLEL
         self.workers = []
         for i in range(self.num_workers):
@@ -125,25 +152,7 @@ class FileParser():
         print(f"[DB_WRITER] Starting - Num workers: {self.num_workers}")
         sys.stdout.flush()
 
-        script_dir = Path(__file__).parent
-        db_config_path = Path(self.set_up.get('database_config_path', 'config/db_config.json'))
-        try:
-            with open(script_dir.parent / db_config_path) as f:
-                db_config = json.load(f)
-        except Exception as e:
-            print(f"Error loading database config from {db_config_path}: {e}")
-            raise e
-        
-        conn = psycopg2.connect(
-            dbname=db_config["DB_NAME"],
-            user=db_config["DB_USER"],
-            password=db_config["DB_PASS"],
-            host=db_config["DB_HOST"],
-            port=db_config["DB_PORT"],
-            connect_timeout=30,
-            gssencmode='disable',
-            client_encoding='UTF8'
-        )
+        sink = create_sink(self.set_up)
 
         base_table_names = [
             'revision',
@@ -167,6 +176,38 @@ class FileParser():
             '_less': {table: [] for table in base_table_names}
         }
 
+        # rows and approximate bytes of each batch, used by the batch policy
+        batch_rows = {suffix: 0 for suffix in batches}
+        batch_bytes = {suffix: 0 for suffix in batches}
+        batch_policy = AdaptiveBatchPolicy(self.set_up)
+        flusher = BatchFlusher(sink, self.set_up, batch_policy, lambda msg: print(msg, flush=True))
+
+        # pages whose results are in the batches (load_manifest), {file_path: [page_index]}
+        loaded_pages = {}
+
+        def new_batch(table_suffix):
+            # the previous one might still be written by the flusher
+            batches[table_suffix] = {table: [] for table in batches[table_suffix]}
+            batch_rows[table_suffix] = 0
+            batch_bytes[table_suffix] = 0
+
+        def flush_batch(table_suffix):
+            flusher.flush(table_suffix, batches[table_suffix], batch_rows[table_suffix], batch_bytes[table_suffix])
+            new_batch(table_suffix)
+
+        def flush_all():
+            suffixes = [suffix for suffix, batch in batches.items() if any(len(v) > 0 for v in batch.values())]
+            if not flusher.load_manifest:
+                for suffix in suffixes:
+                    flush_batch(suffix)
+                return
+
+            if suffixes or loaded_pages:
+                flusher.flush_group([(suffix, batches[suffix], batch_rows[suffix], batch_bytes[suffix]) for suffix in suffixes], dict(loaded_pages))
+                for suffix in suffixes:
+                    new_batch(suffix)
+                loaded_pages.clear()
+
         workers_finished = 0
         last_write = time.time()
 
@@ -182,45 +223,34 @@ class FileParser():
                         sys.stdout.flush()
                         continue
 
-                    if result['is_scholarly_article']:
-                        table_suffix = '_sa'
-
-                    if result['is_astronomical_object']:
-                        table_suffix = '_ao'
-                    
-                    if not result['is_astronomical_object'] and not result['is_scholarly_article'] and result['has_less_revisions']:
-                        table_suffix = '_less'
-                    
-                    if not result['is_astronomical_object'] and not result['is_scholarly_article'] and not result['has_less_revisions']:
-                        table_suffix = ''
-                    
-                    for table_name in base_table_names:
-                        if table_name in batches[table_suffix]:
-                            batches[table_suffix][table_name].extend(result.get(table_name, []))
-                    
-                    current_batch_size = len(batches[table_suffix]['revision'])
-                    time_since_write = time.time() - last_write
-                    if len(batches[table_suffix]['revision']) >= self.batch_size or (time_since_write > 20 and current_batch_size > 0):
-                        batch_insert(conn, batches[table_suffix], self.set_up, table_suffix=table_suffix)
-
-                        # Clear this batch
-                        for table in batches[table_suffix]:
-                            batches[table_suffix][table] = []
+                    for file_path, page_indices in get_loaded_pages(result).items():
+                        loaded_pages.setdefault(file_path, []).extend(page_indices)
 
-                        last_write = time.time()
+                    for table_suffix, tables in unpack_results_message(result):
+                        for table_name in base_table_names:
+                            if table_name in batches[table_suffix]:
+                                batches[table_suffix][table_name] = extend_rows(batches[table_suffix][table_name], tables.get(table_name, []))
+                        
+                        num_rows, num_bytes = batch_policy.tables_size(tables, batches[table_suffix])
+                        batch_rows[table_suffix] += num_rows
+                        batch_bytes[table_suffix] += num_bytes
+
+                        time_since_write = time.time() - last_write
+                        if batch_policy.should_flush(batch_rows[table_suffix], batch_bytes[table_suffix], time_since_write):
+                            if flusher.load_manifest:
+                                # one transaction with all the pages received
+                                flush_all()
+                            else:
+                                flush_batch(table_suffix)
+                            last_write = time.time()
                     
                 except queue.Empty:
-                    for suffix, batch in batches.items():
-                        if any(len(v) > 0 for v in batch.values()):
-                            batch_insert(conn, batch, self.set_up, table_suffix=suffix)
-
-                            for table in batch:
-                                batch[table] = []
+                    flush_all()
         
-            for suffix, batch in batches.items():
-                if any(len(v) > 0 for v in batch.values()):
-                    batch_insert(conn, batch, self.set_up, table_suffix=suffix)
+            flush_all()
+            flusher.close()
             
+            print(f"[DB_WRITER] Batches: {batch_policy.stats()}")
             print(f"[DB_WRITER] Completed successfully!")
             sys.stdout.flush()
 
@@ -230,28 +260,84 @@ class FileParser():
             sys.stdout.flush()
             raise e
         finally:
-            print(f"[DB_WRITER] Closing connection")
+            print(f"[DB_WRITER] Closing sink")
             sys.stdout.flush()
-            conn.close()
+            try:
+                flusher.close()
+            except:
+                pass
+            sink.close()
+            if isinstance(self.results_queue, PipeResultsChannel):
+                self.results_queue.close()
             print(f"[DB_WRITER] Exiting")
             sys.stdout.flush()
     
+    def _add_to_worker_batch(self, worker_batches, results, page_index):
+        """Adds the results of an entity to the batch of its suffix. Returns the suffix"""
+        table_suffix = get_table_suffix(results)
+        if table_suffix not in worker_batches:
+            worker_batches[table_suffix] = {'tables': {}, 'num_entities': 0, 'num_rows': 0, 'page_indices': [], 'start_time': time.time()}
+        
+        worker_batch = worker_batches[table_suffix]
+        for table_name, rows in results.items():
+            if isinstance(rows, list) and len(rows) > 0:
+                worker_batch['tables'].setdefault(table_name, []).extend(rows)
+                worker_batch['num_rows'] += len(rows)
+        worker_batch['num_entities'] += 1
+        worker_batch['page_indices'].append(page_index)
+
+        return table_suffix
+
+    def _worker_batch_is_full(self, worker_batch):
+        return (worker_batch['num_entities'] >= self.worker_batch_max_entities 
+                or worker_batch['num_rows'] >= self.worker_batch_max_rows
+                or time.time() - worker_batch['start_time'] > self.worker_batch_max_seconds)
+
+    @staticmethod
+    def _encode_tables(tables):
+        """Encodes the rows of every table for COPY (see EncodedRows)"""
+        return {table_name: EncodedRows(rows) if isinstance(rows, list) and len(rows) > 0 else rows for table_name, rows in tables.items()}
+
+    def _add_loaded_pages(self, message, page_indices):
+        """
+            With load_manifest, the message has the indices of the pages whose results it has,
+            plus the pages without results processed since the last message
+        """
+        if self.load_manifest:
+            message['loaded_pages'] = {self.file_path: page_indices + self.pages_without_results}
+            self.pages_without_results = []
+        return message
+
+    def _flush_worker_batch(self, worker_batches, table_suffix):
+        worker_batch = worker_batches.pop(table_suffix)
+        tables = self._encode_tables(worker_batch['tables']) if self.encode_results else worker_batch['tables']
+        message = pack_results_batch(table_suffix, tables, worker_batch['num_entities'], self.results_compression)
+        self.results_queue.put(self._add_loaded_pages(message, worker_batch['page_indices']))
+
     def _worker(self, worker_id):
         """
             Process started in init
             Gets pages from queue and calls process_page_xml which processes the page (entity)
+            If worker_batch_max_entities > 1, the results of several entities are sent in one message per suffix.
         """
         
         pages_processed = 0
+        results_put_time = 0.0
+        worker_batches = {} # suffix -> results of the entities that haven't been sent to the writer
+        use_worker_batches = self.worker_batch_max_entities > 1
+        feature_memo = FeatureMemo.from_set_up(self.set_up, shared=self.shared_feature_memo) # features of repeated value pairs
+        self.pages_without_results = [] # load_manifest
 
         try:
         
             while not self.stop_event.is_set() or not self.page_queue.empty():
                 try:
-                    page_elem_str = self.page_queue.get(timeout=1) # get is atomic -  only one thread can remove an item at a time
+                    page = self.page_queue.get(timeout=1) # get is atomic -  only one thread can remove an item at a time
                     
-                    if page_elem_str is None:  # no more pages to process
+                    if page is None:  # no more pages to process
                         break
+
+                    page_index, page_elem_str = page
                     
                     results = process_page_xml(
                         page_elem_str, 
@@ -259,24 +345,38 @@ class FileParser():
                         self.set_up, 
                         self.PROPERTY_LABELS, 
                         self.ASTRONOMICAL_OBJECT_TYPES, 
-                        self.SCHOLARLY_ARTICLE_TYPES
+                        self.SCHOLARLY_ARTICLE_TYPES,
+                        feature_memo
                     )
                         
                     pages_processed += 1
 
                     if results is not None:
 
-                        self.results_queue.put(results)
+                        put_start = time.time()
+                        if use_worker_batches:
+                            self._add_to_worker_batch(worker_batches, results, page_index)
+                            for table_suffix in [suffix for suffix, batch in worker_batches.items() if self._worker_batch_is_full(batch)]:
+                                self._flush_worker_batch(worker_batches, table_suffix)
+                        else:
+                            message = self._encode_tables(results) if self.encode_results else results
+                            self.results_queue.put(self._add_loaded_pages(message, [page_index]))
+                        results_put_time += time.time() - put_start
                         
                         if len(results.get('revision', [])) > 200:
                             gc.collect()
                         
                         results = None
+                    elif self.load_manifest:
+                        self.pages_without_results.append(page_index)
 
                     if pages_processed % 50 == 0:  # Every 50 entities or with more than 200 revisions
                         gc.collect()
 
                 except queue.Empty:
+                    # don't hold results while waiting for pages
+                    for table_suffix in [suffix for suffix, batch in worker_batches.items() if self._worker_batch_is_full(batch)]:
+                        self._flush_worker_batch(worker_batches, table_suffix)
                     continue
         
         except MemoryError as e:
@@ -289,9 +389,28 @@ class FileParser():
             print(f"Error in worker {worker_id} in file {self.file_path}: {e}", flush=True)
             print(traceback.format_exc(), flush=True)
         finally:
+            try:
+                for table_suffix in list(worker_batches):
+                    self._flush_worker_batch(worker_batches, table_suffix)
+                if self.pages_without_results:
+                    self.results_queue.put(self._add_loaded_pages(pack_results_batch('', {}, 0), []))
+            except Exception as e:
+                print(f"Error sending the last results of worker {worker_id} in file {self.file_path}: {e}", flush=True)
+                print(traceback.format_exc(), flush=True)
+
             self.results_queue.put(None)
 
-            print(f"Worker {worker_id} FINAL: {pages_processed} pages")
+            if isinstance(self.results_queue, multiprocessing.queues.Queue):
+                # os._exit doesn't wait for the feeder thread of mp.Queue, so the last messages could be lost
+                self.results_queue.close()
+                self.results_queue.join_thread()
+
+            print(f"Worker {worker_id} FINAL: {pages_processed} pages, "
+                  f"avg results put time: {(results_put_time / pages_processed * 1000) if pages_processed > 0 else 0:.3f} ms/entity")
+            if isinstance(self.results_queue, PipeResultsChannel):
+                print(f"Worker {worker_id} results channel: {self.results_queue.stats()}")
+            if feature_memo is not None:
+                print(f"Worker {worker_id} feature memo: {feature_memo.stats()}")
             sys.stdout.flush()
 
             os._exit(0)
@@ -316,6 +435,17 @@ class FileParser():
                 
                 last_report = time.time()
                 start_time_reading = time.time()
+
+                # pages already stored in the DB (load_manifest)
+                loaded_pages = None
+                if self.load_manifest:
+                    conn = get_db_connection(self.set_up)
+                    try:
+                        loaded_pages = LoadedPages.from_db(conn, self.file_path)
+                    finally:
+                        conn.close()
+                    print(f"{loaded_pages.num_pages} pages of {self.file_path} are already stored, they will be skipped", flush=True)
+                page_index = -1
                 
                 for _, page_elem in context:
                     keep = False
@@ -328,6 +458,12 @@ class FileParser():
                         if entity_id.startswith("Q"):
                             keep = True
 
+                    if keep:
+                        page_index += 1
+                        if loaded_pages is not None and page_index in loaded_pages:
+                            keep = False
+                            self.pages_skipped += 1
+
                     if keep:
                         # Serialize the page element
                         page_elem_str = etree.tostring(page_elem, encoding="unicode")
@@ -335,7 +471,7 @@ class FileParser():
                         revision_count = page_elem_str.count('<revision>')
                         self.total_revisions += revision_count
 
-                        self.page_queue.put(page_elem_str)
+                        self.page_queue.put((page_index, page_elem_str))
                         self.num_entities += 1
 
                     # Periodic progress report
@@ -375,6 +511,9 @@ class FileParser():
 
         self.stop_event.set()
 
+        if self.feature_memo_manager is not None:
+            self.feature_memo_manager.shutdown()
+
         if self.owns_writer:
             print("Waiting for writer process to finish.")
             self.writer_process.join()
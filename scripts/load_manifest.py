@@ -0,0 +1,62 @@
+import bisect
+from psycopg2.extras import execute_values
+
+"""
+    Load manifest (change_extraction_processing.load_manifest, see sql/load_manifest_schema.sql)
+
+    Every page (entity) of a dump file has an index (the order in which FileParser reads the entity pages).
+    The db_writer stores the index ranges of the pages it writes in load_manifest, in the same transaction
+    as their rows. When a file is processed again (e.g. after a crash), the pages in load_manifest are skipped,
+    so every page is stored exactly once and the rows can be inserted with a plain COPY (no ON CONFLICT).
+"""
+
+LOAD_MANIFEST_TABLE = 'load_manifest'
+
+
+def merge_page_ranges(ranges):
+    """Merges overlapping or adjacent (start, end) ranges"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(page_range) for page_range in merged]
+
+
+def to_page_ranges(page_indices):
+    """[0, 1, 2, 5, 6] -> [(0, 2), (5, 6)]"""
+    return merge_page_ranges((page_index, page_index) for page_index in page_indices)
+
+
+def write_load_manifest(conn, loaded_pages):
+    """
+        Adds the pages to load_manifest, without committing.
+        loaded_pages is {file_path: [page_index]}
+    """
+    rows = [(file_path, start, end) for file_path, page_indices in loaded_pages.items() for start, end in to_page_ranges(page_indices)]
+    if not rows:
+        return 0
+    with conn.cursor() as cursor:
+        execute_values(cursor, f"INSERT INTO {LOAD_MANIFEST_TABLE} (file_path, page_start, page_end) VALUES %s", rows)
+    return len(rows)
+
+
+class LoadedPages():
+    """Page ranges of a file that are in load_manifest"""
+
+    def __init__(self, ranges):
+        self.ranges = merge_page_ranges(ranges)
+        self.starts = [start for start, _ in self.ranges]
+        self.num_pages = sum(end - start + 1 for start, end in self.ranges)
+
+    def __contains__(self, page_index):
+        i = bisect.bisect_right(self.starts, page_index) - 1
+        return i >= 0 and page_index <= self.ranges[i][1]
+
+    @classmethod
+    def from_db(cls, conn, file_path):
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT page_start, page_end FROM {LOAD_MANIFEST_TABLE} WHERE file_path = %s", (str(file_path),))
+            return cls(cursor.fetchall())
+
@@ -10,6 +10,7 @@ import gc
 
 from scripts.feature_creation import FeatureCreation
 from scripts.utils import get_time_feature, id_to_int
+from scripts.typed_values import typed_value, get_unit, flatten_typed_values
 from scripts.const import *
 
 class PageParser():
@@ -20,7 +21,8 @@ class PageParser():
             set_up, 
             property_labels, 
             astronomical_object_types, 
-            scholarly_article_types
+            scholarly_article_types,
+            feature_memo=None
         ):
         
         # Change storage
@@ -58,9 +60,17 @@ class PageParser():
             self.entity_features = []
             self.text_features = []
             self.globecoordinate_features = []
+            # (base_cols, old_value, new_value) of the changes whose features are calculated in batch
+            self.batch_feature_values = {'text': [], 'quantity': [], 'globecoordinate': [], 'time': []}
+
+        # features of repeated (old_value, new_value) pairs, kept by the worker between pages (see feature_memo.py)
+        self.feature_memo = feature_memo
 
         self.language = self.set_up.get('change_extraction_processing', {}).get('language', 'en')
 
+        # old_value/new_value are stored in typed columns instead of JSON (see typed_values.py)
+        self.typed_values = self.set_up.get('change_extraction_processing', {}).get('typed_values', False)
+
         self.current_revision_redirect = False
 
         self.revision_meta = {}
@@ -317,8 +327,12 @@ class PageParser():
             return UPDATE_PROPERTY_VALUE
 
     
-    def calculate_features(self, revision_id, property_id, property_label, value_id, old_value, new_value, old_datatype, new_datatype, change_target, action):
-        
+    def calculate_features(self, revision_id, property_id, property_label, value_id, old_value, new_value, old_datatype, new_datatype, change_target, action, old_value_raw=None, new_value_raw=None):
+        """
+            old_value and new_value are the serialized values (stored in the feature tables),
+            old_value_raw and new_value_raw the values as they were read from the revision, 
+            which are used for the quantity, globecoordinate and time features
+        """
         base_cols = (
             revision_id,
             property_id,
@@ -332,28 +346,13 @@ class PageParser():
             new_value,
         )
 
-        if  new_datatype == 'quantity':
-            features = self.feature_creation.create_quantity_features(old_value, new_value)
-            self.quantity_features.append(
-                base_cols + features
-            ) 
-        if new_datatype == 'globecoordinate':
-            features = self.feature_creation.create_globe_coordinate_features(old_value, new_value)
-            self.globecoordinate_features.append(
-                base_cols + features
-            )
-
-        if new_datatype == 'time':
-            features = self.feature_creation.create_time_features(old_value, new_value)
-            self.time_features.append(
-                base_cols + features
-            )
+        if new_datatype in self.batch_feature_values:
+            # calculated for all the changes of the page with the batch functions (see calculate_batch_features)
+            self.batch_feature_values[new_datatype].append((base_cols, old_value_raw, new_value_raw))
         
         if new_datatype in WD_STRING_TYPES:
-            features = self.feature_creation.create_text_features('text', old_value, new_value)
-            self.text_features.append(
-                base_cols + features
-            )
+            # the text features are calculated from the serialized values
+            self.batch_feature_values['text'].append((base_cols, old_value, new_value))
 
         if new_datatype in WD_ENTITY_TYPES:
             features  = self.feature_creation.create_entity_features()
@@ -361,6 +360,45 @@ class PageParser():
                 base_cols + features
             )
 
+    def calculate_batch_features(self):
+        """
+            Calculates the text, quantity, globecoordinate and time features of the changes of the page 
+            (collected by calculate_features) with the batch functions of FeatureCreation.
+            With the feature memo, only the (old_value, new_value) pairs that aren't memoized are calculated.
+        """
+        def create_text_features_batch(old_values, new_values):
+            return [self.feature_creation.create_text_features('text', old_value, new_value) for old_value, new_value in zip(old_values, new_values)]
+
+        batch_functions = [
+            ('text', create_text_features_batch, self.text_features),
+            ('quantity', FeatureCreation.create_quantity_features_batch, self.quantity_features),
+            ('globecoordinate', FeatureCreation.create_globe_coordinate_features_batch, self.globecoordinate_features),
+            ('time', FeatureCreation.create_time_features_batch, self.time_features),
+        ]
+        for datatype, create_features_batch, features in batch_functions:
+            values = self.batch_feature_values[datatype]
+            if len(values) == 0:
+                continue
+
+            base_cols, old_values, new_values = zip(*values)
+            # memo keys: serialized old_value and new_value (see base_cols in calculate_features)
+            pairs = [(cols[8], cols[9]) for cols in base_cols]
+            if self.feature_memo is not None:
+                results = self.feature_memo.get_many(datatype, pairs)
+            else:
+                results = [None] * len(values)
+
+            missing = [i for i, f in enumerate(results) if f is None]
+            if len(missing) > 0:
+                calculated = create_features_batch([old_values[i] for i in missing], [new_values[i] for i in missing])
+                for i, f in zip(missing, calculated):
+                    results[i] = f
+                if self.feature_memo is not None:
+                    self.feature_memo.put_many(datatype, [pairs[i] for i in missing], calculated)
+
+            features.extend(cols + f for cols, f in zip(base_cols, results))
+            values.clear()
+
     @staticmethod
     def serialize_value(value):
         if value is None:
@@ -368,12 +406,17 @@ class PageParser():
         return json.dumps(value, ensure_ascii=False)
 
 
-    def save_changes(self, property_id, value_id, old_value, new_value, old_datatype, new_datatype, change_target, change_type, old_hash=None, new_hash=None):
+    def save_changes(self, property_id, value_id, old_value, new_value, old_datatype, new_datatype, change_target, change_type, old_hash=None, new_hash=None, old_unit=None, new_unit=None):
         """
             Store value + datatype metadata (of property value) + rank changes
         """
-        old_value = PageParser.serialize_value(old_value) if old_value else '{}' # in the DB can't be NULL because null = null is NULL in postgresql
-        new_value = PageParser.serialize_value(new_value) if new_value else '{}'
+        old_value_raw, new_value_raw = old_value, new_value
+        if self.typed_values:
+            old_value = typed_value(old_value_raw, old_datatype, old_unit)
+            new_value = typed_value(new_value_raw, new_datatype, new_unit)
+        else:
+            old_value = PageParser.serialize_value(old_value) if old_value else '{}' # in the DB can't be NULL because null = null is NULL in postgresql
+            new_value = PageParser.serialize_value(new_value) if new_value else '{}'
 
         action, target = PageParser.get_target_action_from_change_type(change_type)
 
@@ -398,8 +441,12 @@ class PageParser():
 
         # Soft insertion + deletion 
         if self.set_up.get('re_interpretation', False) and change_target == 'rank' and action == 'UPDATE':
-            old_value_filt = old_value.replace('"', '') if old_value else ''
-            new_value_filt = new_value.replace('"', '') if new_value else ''
+            if self.typed_values:
+                old_value_filt = old_value_raw or ''
+                new_value_filt = new_value_raw or ''
+            else:
+                old_value_filt = old_value.replace('"', '') if old_value else ''
+                new_value_filt = new_value.replace('"', '') if new_value else ''
             if old_value_filt in ['normal', 'preferred'] and new_value_filt == 'deprecated':
                 label = 'soft_deletion'
 
@@ -413,8 +460,8 @@ class PageParser():
             'timestamp': timestamp,
             'old_hash': old_hash if old_hash else '',
             'new_hash': new_hash if new_hash else '',
-            'old_value': old_value,
-            'new_value': new_value,
+            'old_value': old_value if old_value_raw or not self.typed_values else '{}', # '{}' = no value (reverted edit tagging)
+            'new_value': new_value if new_value_raw or not self.typed_values else '{}',
             'comment': self.revision_meta['comment'],
             'change_target': change_target,
             'revision_id': revision_id,
@@ -425,17 +472,25 @@ class PageParser():
 
         if self.extract_features and change_target == '' and action == 'UPDATE' and new_datatype == old_datatype:
             t0 = time.time()
+            if self.typed_values:
+                # the feature tables keep the serialized values
+                old_value_features = PageParser.serialize_value(old_value_raw) if old_value_raw else '{}'
+                new_value_features = PageParser.serialize_value(new_value_raw) if new_value_raw else '{}'
+            else:
+                old_value_features, new_value_features = old_value, new_value
             self.calculate_features(
                 revision_id,
                 property_id,
                 property_label,
                 value_id,
-                old_value,
-                new_value,
+                old_value_features,
+                new_value_features,
                 old_datatype,
                 new_datatype,
                 change_target,
-                action
+                action,
+                old_value_raw=old_value_raw,
+                new_value_raw=new_value_raw
             )
             t1 = time.time()
             self.total_feature_creation_sec += (t1 - t0)
@@ -531,8 +586,12 @@ class PageParser():
         """
             Store reference/qualifier changes
         """
-        old_value = PageParser.serialize_value(old_value) if old_value else '{}'
-        new_value = PageParser.serialize_value(new_value) if new_value else '{}'
+        if self.typed_values:
+            old_value = typed_value(old_value, old_datatype)
+            new_value = typed_value(new_value, new_datatype)
+        else:
+            old_value = PageParser.serialize_value(old_value) if old_value else '{}'
+            new_value = PageParser.serialize_value(new_value) if new_value else '{}'
 
         action, target = PageParser.get_target_action_from_change_type(change_type)
         timestamp = self.revision_meta['timestamp']
@@ -578,8 +637,12 @@ class PageParser():
         """
             Store reference changes
         """
-        old_value = PageParser.serialize_value(old_value) if old_value else '{}'
-        new_value = PageParser.serialize_value(new_value) if new_value else '{}'
+        if self.typed_values:
+            old_value = typed_value(old_value, old_datatype)
+            new_value = typed_value(new_value, new_datatype)
+        else:
+            old_value = PageParser.serialize_value(old_value) if old_value else '{}'
+            new_value = PageParser.serialize_value(new_value) if new_value else '{}'
 
         action, target = PageParser.get_target_action_from_change_type(change_type) 
         timestamp = self.revision_meta['timestamp']
@@ -982,7 +1045,7 @@ class PageParser():
                 #         change_type=change_type
                 #     )
     
-    def _handle_value_changes(self, old_datatype, new_datatype, new_value, old_value, value_id, property_id, change_type, old_hash, new_hash):
+    def _handle_value_changes(self, old_datatype, new_datatype, new_value, old_value, value_id, property_id, change_type, old_hash, new_hash, old_datatype_metadata=None, new_datatype_metadata=None):
 
         self.save_changes(
             id_to_int(property_id), 
@@ -994,7 +1057,9 @@ class PageParser():
             change_target=None,
             change_type=change_type,
             old_hash=old_hash,
-            new_hash=new_hash
+            new_hash=new_hash,
+            old_unit=get_unit(old_datatype_metadata) if self.typed_values else None, # quantity units (typed_values)
+            new_unit=get_unit(new_datatype_metadata) if self.typed_values else None
         )
 
     @staticmethod
@@ -1620,7 +1685,7 @@ class PageParser():
                 if s:
                     new_hash = PageParser.generate_value_hash(s['mainsnak'])
 
-                self._handle_value_changes(None, new_datatype, new_value, None, value_id, new_pid, CREATE_PROPERTY_VALUE, old_hash, new_hash)
+                self._handle_value_changes(None, new_datatype, new_value, None, value_id, new_pid, CREATE_PROPERTY_VALUE, old_hash, new_hash, new_datatype_metadata=new_datatype_metadata)
 
                 if new_datatype_metadata and self.extract_datatype_metadata_changes:
                     self._handle_datatype_metadata_changes(None, new_datatype_metadata, value_id, None, new_datatype, new_pid, CREATE_PROPERTY_VALUE, old_hash, new_hash)
@@ -1673,7 +1738,7 @@ class PageParser():
                     # old_hash = PageParser._get_property_mainsnak(s, 'hash') if s else None
                     old_hash = PageParser.generate_value_hash(s['mainsnak'])
 
-                self._handle_value_changes(old_datatype, None, None, old_value, value_id, removed_pid, change_type, old_hash, new_hash)
+                self._handle_value_changes(old_datatype, None, None, old_value, value_id, removed_pid, change_type, old_hash, new_hash, old_datatype_metadata=old_datatype_metadata)
 
                 if old_datatype_metadata and self.extract_datatype_metadata_changes:
                     self._handle_datatype_metadata_changes(old_datatype_metadata, {}, value_id, old_datatype, None, removed_pid, change_type, old_hash, new_hash)
@@ -1823,7 +1888,7 @@ class PageParser():
                     if pid == 'P279':
                         self.entity_data['p279_types'].remove((sid, old_value))
 
-                    self._handle_value_changes(old_datatype, new_datatype, new_value, old_value, sid, pid, DELETE_PROPERTY_VALUE, old_hash, new_hash)
+                    self._handle_value_changes(old_datatype, new_datatype, new_value, old_value, sid, pid, DELETE_PROPERTY_VALUE, old_hash, new_hash, old_datatype_metadata, new_datatype_metadata)
 
                     if old_datatype_metadata and self.extract_datatype_metadata_changes:
                         # Add change record for the datatype_metadata fields
@@ -1839,7 +1904,7 @@ class PageParser():
                     if pid == 'P279':
                         self.entity_data['p279_types'].add((sid, new_value))
 
-                    self._handle_value_changes(old_datatype, new_datatype, new_value, old_value, sid, pid, CREATE_PROPERTY_VALUE, old_hash, new_hash)
+                    self._handle_value_changes(old_datatype, new_datatype, new_value, old_value, sid, pid, CREATE_PROPERTY_VALUE, old_hash, new_hash, old_datatype_metadata, new_datatype_metadata)
 
                     if new_datatype_metadata and self.extract_datatype_metadata_changes:
                         # Add change record for the datatype_metadata fields
@@ -1857,9 +1922,9 @@ class PageParser():
                             old_value_cleaned = re.sub(r'^([+-])0+(?=\d{4}-)', r'\1', old_value)
                             new_value_cleaned = re.sub(r'^([+-])0+(?=\d{4}-)', r'\1', new_value)
                             if old_value_cleaned != new_value_cleaned:
-                                self._handle_value_changes(old_datatype, new_datatype, new_value_cleaned, old_value_cleaned, sid, pid, UPDATE_PROPERTY_VALUE, old_hash, new_hash)
+                                self._handle_value_changes(old_datatype, new_datatype, new_value_cleaned, old_value_cleaned, sid, pid, UPDATE_PROPERTY_VALUE, old_hash, new_hash, old_datatype_metadata, new_datatype_metadata)
                         else:
-                            self._handle_value_changes(old_datatype, new_datatype, new_value, old_value, sid, pid, UPDATE_PROPERTY_VALUE, old_hash, new_hash)
+                            self._handle_value_changes(old_datatype, new_datatype, new_value, old_value, sid, pid, UPDATE_PROPERTY_VALUE, old_hash, new_hash, old_datatype_metadata, new_datatype_metadata)
 
                         if pid == 'P31':
                             self.entity_data['p31_types'].remove((sid, old_value))
@@ -2150,19 +2215,27 @@ class PageParser():
             final_revision.append(r + (self.entity_data['label'],))
         self.revision = final_revision
 
+        # with typed_values, the old and new values are tuples of typed columns (see typed_values.py),
+        # they are expanded here since tag_reverted_edits reads the change tuples by position
         final_changes = []
         for i, c in enumerate(self.changes):
+            if self.typed_values:
+                c = flatten_typed_values(c, 4)
             final_changes.append(c + (self.entity_data['label'],))
         self.changes = final_changes
 
         final_reference_changes = []
         for i, c in enumerate(self.reference_changes):
+            if self.typed_values:
+                c = flatten_typed_values(c, 8)
             final_reference_changes.append(c + (self.entity_data['label'],))
 
         self.reference_changes = final_reference_changes
 
         final_qualifier_changes = []
         for i, c in enumerate(self.qualifier_changes):
+            if self.typed_values:
+                c = flatten_typed_values(c, 7)
             final_qualifier_changes.append(c + (self.entity_data['label'],))
         self.qualifier_changes = final_qualifier_changes
 
@@ -2176,6 +2249,10 @@ class PageParser():
         # Add entity label, description and types to feature tables
         ## -------------------------------------------------- ##
         if self.extract_features:
+            t0 = time.time()
+            self.calculate_batch_features()
+            self.total_feature_creation_sec += (time.time() - t0)
+
             final_entity_features = []
             if len(self.entity_features) > 0:
                 for i, f in enumerate(self.entity_features):
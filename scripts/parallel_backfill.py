@@ -0,0 +1,183 @@
+import time
+import traceback
+import multiprocessing as mp
+import concurrent.futures
+import psycopg2
+
+from scripts.feature_creation import FeatureCreation
+from scripts.sinks import connect_db
+from scripts.utils import get_time_unit
+
+"""
+    Parallel backfill of compute_remaining_features.py (feature_backfill.num_processes > 1)
+
+    The feature tables of a table suffix are split into disjoint ranges of revision_id (the first column of their primary key),
+    and the backfills of the ranges run in a pool of processes:
+        - features_text: embedding features (create_and_update_embedding_features), after the text features with
+          feature_backfill.recompute_extracted_features (create_all_features_batch), in the same task
+        - features_entity: text, transitive closure and embedding features (create_all_features_entity)
+        - with feature_backfill.recompute_extracted_features, the features of features_quantity, features_time
+          and features_globecoordinate are calculated again (create_all_features_batch)
+    Each process has its own connection (and temp tables) and keeps its FeatureCreation, so the transitive closure cache
+    and the encoder are loaded once per process (the processes of a SentenceEncoder are stopped when the process exits).
+    The ranges of each backfill are planned in the first run and stored in the ledger backfill_ranges, with the time they were finished.
+    A run that stops continues with the ranges that weren't finished (the keyset backfills continue after the last key of the range,
+    see FeatureCreation.get_backfill_last_key). Rows added after the ranges were planned (bigger revision_id) aren't in any range,
+    compute_remaining_features.py --restart deletes the ranges (restart_ranges) so they are planned again.
+"""
+
+# connection and FeatureCreation of each process of the pool
+_feature_creator = None
+_db_config = None
+
+
+def backfills(table_suffix, recompute_extracted_features=False):
+    """(ledger job, feature table, datatype, method) of the backfills of a table suffix"""
+    jobs = [
+        (f'features_entity{table_suffix}', f'features_entity{table_suffix}', 'entity', 'entity'),
+        (f'features_text{table_suffix}', f'features_text{table_suffix}', 'text', 'text'),
+    ]
+    if recompute_extracted_features:
+        jobs += [
+            (f'features_quantity{table_suffix}_batch', f'features_quantity{table_suffix}', 'quantity', 'batch'),
+            (f'features_time{table_suffix}_batch', f'features_time{table_suffix}', 'time', 'batch'),
+            (f'features_globecoordinate{table_suffix}_batch', f'features_globecoordinate{table_suffix}', 'globecoordinate', 'batch'),
+        ]
+    return jobs
+
+
+def restart_ranges(conn, table_suffix):
+    """Deletes the ranges of the backfills of table_suffix from backfill_ranges, so the next run plans them again"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT to_regclass('backfill_ranges') IS NOT NULL")
+    if cursor.fetchone()[0]:
+        cursor.execute("DELETE FROM backfill_ranges WHERE job = ANY(%s)", ([job for job, _, _, _ in backfills(table_suffix, True)],))
+    conn.commit()
+
+
+def _init_process(set_up, db_config):
+    global _feature_creator, _db_config
+    _db_config = db_config
+    _feature_creator = FeatureCreation(set_up=set_up, conn=connect_db(db_config))
+
+
+def _clean_up(datatype, table_suffix):
+    """Rolls back the backfill of a range that failed and drops its temp table, so the next ranges of the process can run"""
+    conn = _feature_creator.conn
+    try:
+        # also closes the server side cursors of read_batch_after_key
+        conn.rollback()
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS temp_results_{datatype}{table_suffix}")
+        conn.commit()
+    except psycopg2.Error:
+        # the connection was lost
+        conn.close()
+        _feature_creator.conn = connect_db(_db_config)
+
+
+def _run_range(job, datatype, method, table_suffix, key_range):
+    """Backfill of a range in a process of the pool, the range is marked as finished in the same connection"""
+    try:
+        if method == 'entity':
+            _feature_creator.create_all_features_entity(table_suffix, key_range=key_range)
+        elif method == 'batch':
+            _feature_creator.create_all_features_batch(datatype, table_suffix, key_range=key_range)
+        else:
+            # the text features and the embedding features update the same rows, so they run one after the other
+            if _feature_creator.recompute_extracted_features:
+                _feature_creator.create_all_features_batch(datatype, table_suffix, key_range=key_range)
+            _feature_creator.create_and_update_embedding_features(
+                datatype, ['revision_id', 'property_id', 'value_id', 'change_target'], ['old_value', 'new_value'], ['value_cosine_similarity'], table_suffix,
+                key_range=key_range
+            )
+    except Exception:
+        _clean_up(datatype, table_suffix)
+        raise
+
+    conn = _feature_creator.conn
+    with conn.cursor() as cursor:
+        cursor.execute("UPDATE backfill_ranges SET finished_at = now() WHERE job = %s AND range_start = %s", (job, key_range[0]))
+    conn.commit()
+    return job, key_range
+
+
+class ParallelBackfill():
+
+    def __init__(self, set_up, db_config, conn):
+        self.set_up = set_up
+        self.db_config = db_config
+        self.conn = conn
+
+        config = set_up.get('feature_backfill', {})
+        self.num_processes = config.get('num_processes', 1)
+        self.ranges_per_process = config.get('ranges_per_process', 4)
+
+    def plan_ranges(self, job, table):
+        """
+            Unfinished ranges [start, end) of job. The first time, the revision ids of table are split into
+            num_processes * ranges_per_process ranges of the same width (min and max are read from the primary key index)
+        """
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS backfill_ranges (
+                job TEXT NOT NULL,
+                range_start BIGINT NOT NULL,
+                range_end BIGINT NOT NULL,
+                finished_at TIMESTAMP,
+                PRIMARY KEY (job, range_start)
+            )
+        """)
+
+        cursor.execute("SELECT count(*) FROM backfill_ranges WHERE job = %s", (job,))
+        if cursor.fetchone()[0] == 0:
+            cursor.execute(f"SELECT min(revision_id), max(revision_id) FROM {table}")
+            min_id, max_id = cursor.fetchone()
+            if min_id is not None:
+                num_ranges = max(1, self.num_processes * self.ranges_per_process)
+                width = (max_id - min_id) // num_ranges + 1
+                for start in range(min_id, max_id + 1, width):
+                    cursor.execute("INSERT INTO backfill_ranges (job, range_start, range_end) VALUES (%s, %s, %s)", (job, start, min(start + width, max_id + 1)))
+
+        cursor.execute("SELECT range_start, range_end FROM backfill_ranges WHERE job = %s AND finished_at IS NULL ORDER BY range_start", (job,))
+        ranges = cursor.fetchall()
+        self.conn.commit()
+        return ranges
+
+    def run(self, table_suffix):
+        """Runs the backfills of the feature tables of table_suffix (see the docstring of the module)"""
+        start_time = time.time()
+        feature_creator = FeatureCreation(set_up=self.set_up, conn=self.conn)
+
+        tasks = []
+        for job, table, datatype, method in backfills(table_suffix, feature_creator.recompute_extracted_features):
+            ranges = self.plan_ranges(job, table)
+            print(f'{job}: {len(ranges)} ranges to process', flush=True)
+            tasks.extend((job, datatype, method, table_suffix, tuple(key_range)) for key_range in ranges)
+
+        failed = 0
+        # spawn: the processes don't inherit the connection, and they can start the processes of the encoder (not daemonic)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.num_processes, mp_context=mp.get_context('spawn'),
+                                                    initializer=_init_process, initargs=(self.set_up, self.db_config)) as executor:
+            futures = {executor.submit(_run_range, *task): task for task in tasks}
+            for future in concurrent.futures.as_completed(futures):
+                job, _, _, _, key_range = futures[future]
+                try:
+                    future.result()
+                    print(f'Finished {job} range {key_range}', flush=True)
+                except Exception as e:
+                    failed += 1
+                    print(f'Error in {job} range {key_range}: {e}', flush=True)
+                    print(traceback.format_exc(), flush=True)
+
+        if failed > 0:
+            print(f'{failed} ranges failed, run the script again to process them', flush=True)
+        elif feature_creator.side_tables:
+            # the views are created when all the ranges are done
+            cursor = self.conn.cursor()
+            for table in dict.fromkeys(table for _, table, _, _ in backfills(table_suffix, feature_creator.recompute_extracted_features)):
+                feature_creator.create_side_table_view(cursor, table)
+            self.conn.commit()
+
+        final_time, unit = get_time_unit(time.time() - start_time)
+        print(f'Finished parallel backfill of {table_suffix or "rest"} in {final_time} {unit}', flush=True)
@@ -0,0 +1,501 @@
+import os
+import re
+import json
+import uuid
+import bisect
+import concurrent.futures
+import psycopg2
+from pathlib import Path
+
+from scripts.utils import insert_rows_copy, copy_rows, sort_rows_by_key, encode_copy_rows, EncodedRows
+from scripts.load_manifest import write_load_manifest
+from scripts.dimensions import DimensionEncoder, compact_table_name
+from scripts.binary_keys import encode_binary_keys
+from scripts.typed_values import TYPED_VALUE_TABLES, typed_value_column_types
+
+"""
+    Output sinks used by the db_writer.
+    A sink receives the batched rows of one table at a time (see batch_insert in db_writer.py)
+    and stores them. PostgresSink is the default, ParquetSink writes local Parquet files and
+    SpoolSink writes COPY files that are loaded into PostgreSQL by spool_loader.py.
+"""
+
+SQL_SCHEMA_FILES = ['change_schema.sql', 'features_schema.sql', 'datatype_metadata_schema.sql']
+
+
+def get_db_connection(set_up, connect_timeout=30):
+    """Opens a connection to the DB configured in database_config_path"""
+    script_dir = Path(__file__).parent
+    db_config_path = Path(set_up.get('database_config_path', 'config/db_config.json'))
+    try:
+        with open(script_dir.parent / db_config_path) as f:
+            db_config = json.load(f)
+    except Exception as e:
+        print(f"Error loading database config from {db_config_path}: {e}", flush=True)
+        raise e
+
+    return connect_db(db_config, connect_timeout=connect_timeout)
+
+
+def connect_db(db_config, connect_timeout=30):
+    """Opens a connection to the DB of db_config (the contents of the DB config file)"""
+    return psycopg2.connect(
+        dbname=db_config["DB_NAME"],
+        user=db_config["DB_USER"],
+        password=db_config["DB_PASS"],
+        host=db_config["DB_HOST"],
+        port=db_config["DB_PORT"],
+        connect_timeout=connect_timeout,
+        gssencmode='disable',
+        client_encoding='UTF8'
+    )
+
+
+class PostgresSink():
+    """
+        Inserts batches into PostgreSQL with COPY + INSERT ... ON CONFLICT (see insert_rows_copy).
+        With load_manifest, rows are copied straight into the tables and committed by commit_load
+        together with the pages they come from (see load_manifest.py).
+        With compact_schema, the rows of the change tables are dictionary encoded and written
+        to the compact tables (see dimensions.py). With binary_keys, value_id and the hashes
+        are converted to bytes (see binary_keys.py).
+    """
+
+    name = 'postgres'
+
+    def __init__(self, set_up):
+        self.set_up = set_up
+        self.conn = get_db_connection(set_up)
+        self.sort_by_pk = set_up.get('change_extraction_processing', {}).get('sort_batches_by_pk', False)
+        self.load_manifest = set_up.get('change_extraction_processing', {}).get('load_manifest', False)
+        self.binary_keys = set_up.get('change_extraction_processing', {}).get('binary_keys', False)
+
+        self.dimension_conn = None
+        self.dimensions = None
+        if set_up.get('change_extraction_processing', {}).get('compact_schema', False):
+            self.dimension_conn = get_db_connection(set_up)
+            self.dimension_conn.autocommit = True
+            self.dimensions = DimensionEncoder(self.dimension_conn)
+
+    def write(self, table_name, rows, columns, primary_key=None):
+        if (self.binary_keys or self.dimensions is not None) and isinstance(rows, EncodedRows):
+            raise ValueError('Rows encoded for COPY (encode_results_in_workers) can\'t be written with binary_keys or compact_schema')
+
+        if self.binary_keys:
+            rows = encode_binary_keys(rows, columns)
+
+        if self.dimensions is not None and compact_table_name(table_name):
+            rows, columns = self.dimensions.encode(rows, columns)
+            table_name = compact_table_name(table_name)
+
+        if self.load_manifest:
+            if self.sort_by_pk and not isinstance(rows, EncodedRows):
+                rows = sort_rows_by_key(rows, columns, primary_key)
+            return copy_rows(self.conn, table_name, rows, columns)
+        return insert_rows_copy(self.conn, table_name, rows, columns, primary_key, sort_by_key=self.sort_by_pk)
+
+    def commit_load(self, loaded_pages):
+        """Adds the pages to load_manifest and commits them with the rows written since the last commit"""
+        write_load_manifest(self.conn, loaded_pages)
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        for conn in (self.conn, self.dimension_conn):
+            try:
+                if conn is not None:
+                    conn.close()
+            except Exception:
+                pass
+
+
+def get_shard_set_ups(set_up):
+    """set_up of every shard of sharded_sink (only the database config path changes)"""
+    shard_config_paths = set_up.get('sharded_sink', {}).get('shards', [])
+    if not shard_config_paths:
+        raise ValueError("sharded_sink.shards must have the database config path of each shard")
+    return [dict(set_up, database_config_path=path, db_config_path=path) for path in shard_config_paths]
+
+
+class ShardedPostgresSink():
+    """
+        Partitions the rows of every table across several PostgreSQL DBs (shards) by entity_id,
+        with one PostgresSink (connection) per shard. Shards are written in parallel.
+            - hash: shard = entity_id % number of shards
+            - range: range_bounds are the upper bounds (exclusive) of the entity_id of each shard but the last one
+
+        The change and feature tables don't have the entity_id, their rows go to the shard of their revision.
+        batch_insert writes the revisions of a batch before the other tables, so the revision_id -> shard
+        of the last revision table written is used.
+    """
+
+    name = 'sharded_postgres'
+
+    def __init__(self, set_up):
+        self.set_up = set_up
+        shard_config = set_up.get('sharded_sink', {})
+        self.partitioning = shard_config.get('partitioning', 'hash')
+        self.range_bounds = shard_config.get('range_bounds', [])
+
+        self.shards = [PostgresSink(shard_set_up) for shard_set_up in get_shard_set_ups(set_up)]
+        if self.partitioning == 'range' and len(self.range_bounds) != len(self.shards) - 1:
+            raise ValueError(f"sharded_sink.range_bounds must have {len(self.shards) - 1} bounds for {len(self.shards)} shards")
+        if self.partitioning not in ('hash', 'range'):
+            raise ValueError(f"Unknown sharded_sink partitioning '{self.partitioning}'. Options are: hash, range")
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.shards))
+        self.revision_shards = {}
+
+    def get_shard(self, entity_id):
+        entity_id = int(entity_id)
+        if self.partitioning == 'range':
+            return bisect.bisect_right(self.range_bounds, entity_id)
+        return entity_id % len(self.shards)
+
+    def _split_rows(self, table_name, rows, columns):
+        """Returns {shard: rows}"""
+        shard_rows = {}
+        if 'entity_id' in columns:
+            entity_idx = columns.index('entity_id')
+            is_revision = table_name.startswith('revision')
+            if is_revision:
+                revision_idx = columns.index('revision_id')
+                self.revision_shards = {}
+            for row in rows:
+                shard = self.get_shard(row[entity_idx])
+                shard_rows.setdefault(shard, []).append(row)
+                if is_revision:
+                    self.revision_shards[int(row[revision_idx])] = shard
+        else:
+            revision_idx = columns.index('revision_id')
+            for row in rows:
+                shard = self.revision_shards.get(int(row[revision_idx]))
+                if shard is None:
+                    raise ValueError(f"Revision {row[revision_idx]} of {table_name} wasn't written before its changes, it can't be assigned to a shard")
+                shard_rows.setdefault(shard, []).append(row)
+        return shard_rows
+
+    def write(self, table_name, rows, columns, primary_key=None):
+        if not rows:
+            return 0
+
+        if isinstance(rows, EncodedRows):
+            raise ValueError('Rows encoded for COPY (encode_results_in_workers) can\'t be assigned to a shard')
+
+        futures = [self.executor.submit(self.shards[shard].write, table_name, shard_rows, columns, primary_key)
+                   for shard, shard_rows in self._split_rows(table_name, rows, columns).items()]
+        return sum(future.result() or 0 for future in futures)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for shard in self.shards:
+            shard.close()
+
+
+def get_sql_column_types():
+    """
+        Reads the column types of every table from the sql/ schema files, so the Parquet files
+        have the same types as the tables in the DB.
+        Returns {base_table_name: {column: sql_type}}
+    """
+    base_dir = Path(__file__).resolve().parent.parent
+    table_regex = re.compile(r'CREATE TABLE IF NOT EXISTS (\w+)\{suffix\}\s*\((.*?)\n\);', re.DOTALL)
+    column_regex = re.compile(r'^\s*(\w+)\s+([A-Za-z]+(?: WITH TIME ZONE)?)', re.IGNORECASE)
+
+    table_types = {}
+    for schema_file in SQL_SCHEMA_FILES:
+        with open(base_dir / 'sql' / schema_file, 'r', encoding='utf-8') as f:
+            schema = f.read()
+
+        for table_name, body in table_regex.findall(schema):
+            column_types = {}
+            for line in body.split('\n'):
+                line = line.split('--')[0]
+                match = column_regex.match(line)
+                if match and match.group(1).upper() not in ('PRIMARY', 'FOREIGN'):
+                    column_types[match.group(1)] = match.group(2).upper()
+            table_types[table_name] = column_types
+
+    # typed columns of old_value/new_value (change_extraction_processing.typed_values), e.g. DOUBLE PRECISION -> DOUBLE
+    for table_name in TYPED_VALUE_TABLES:
+        for name in (table_name, f'{table_name}_compact'):
+            if name in table_types:
+                table_types[name].update({column: sql_type.split()[0] for column, sql_type in typed_value_column_types().items()})
+
+    return table_types
+
+
+class ParquetSink():
+    """
+        Writes each table as zstd compressed Parquet files with PyArrow.
+        Files are stored in one directory per table (e.g. <output_directory>/value_change_sa/),
+        each writer process writes its own files, which are rotated after max_rows_per_file rows.
+        Every batch is written as one row group.
+
+        NOTE: rows are appended, there are no upserts. For entity_stats and feature tables
+        the last row written for a primary key is the current one.
+    """
+
+    name = 'parquet'
+
+    def __init__(self, set_up):
+        # imported here so pyarrow is only required when the parquet sink is used
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.pq = pq
+
+        self.set_up = set_up
+        parquet_config = set_up.get('parquet_sink', {})
+        self.output_directory = Path(parquet_config.get('output_directory', 'data/parquet'))
+        self.compression = parquet_config.get('compression', 'zstd')
+        self.compression_level = parquet_config.get('compression_level', 3)
+        self.max_rows_per_file = parquet_config.get('max_rows_per_file', 5000000)
+        # sorted row groups have tighter min/max statistics (better row group pruning)
+        self.sort_by_pk = set_up.get('change_extraction_processing', {}).get('sort_batches_by_pk', False)
+
+        self.output_directory.mkdir(parents=True, exist_ok=True)
+
+        self.sql_types = get_sql_column_types()
+        self.pid = os.getpid()
+
+        self.writers = {} # table_name -> (ParquetWriter, schema)
+        self.rows_in_file = {}
+        self.file_number = {}
+
+    def _arrow_type(self, sql_type):
+        pa = self.pa
+        if sql_type == 'BIGINT':
+            return pa.int64()
+        if sql_type in ('INT', 'INTEGER', 'SMALLINT'):
+            return pa.int32()
+        if sql_type in ('FLOAT', 'REAL', 'DOUBLE'):
+            return pa.float64()
+        if sql_type == 'BOOLEAN':
+            return pa.bool_()
+        if sql_type.startswith('TIMESTAMP'):
+            return pa.timestamp('us', tz='UTC')
+        # TEXT, VARCHAR, JSONB (stored as the json string)
+        return pa.string()
+
+    def _get_column_types(self, table_name):
+        # table names have the filter suffix (e.g. value_change_sa), match the longest base name
+        base_names = [name for name in self.sql_types if table_name.startswith(name)]
+        if not base_names:
+            return {}
+        return self.sql_types[max(base_names, key=len)]
+
+    @staticmethod
+    def _coerce_value(val, is_integer):
+        """Converts mixed python values (e.g. prev_revision_id '-1', booleans) to the column type"""
+        if val is None or val == '':
+            return None
+        if isinstance(val, bool):
+            return int(val)
+        if isinstance(val, str):
+            return int(val) if is_integer else float(val)
+        return val
+
+    def _to_array(self, values, arrow_type):
+        pa = self.pa
+
+        if pa.types.is_timestamp(arrow_type):
+            values = [v if v not in ('', None) else None for v in values]
+            return pa.array(values, type=pa.string()).cast(arrow_type)
+
+        if pa.types.is_string(arrow_type):
+            return pa.array([str(v) if v is not None and not isinstance(v, str) else v for v in values], type=arrow_type)
+
+        try:
+            return pa.array(values, type=arrow_type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+            is_integer = pa.types.is_integer(arrow_type)
+            return pa.array([self._coerce_value(v, is_integer) for v in values], type=arrow_type)
+
+    def _build_table(self, table_name, rows, columns):
+        pa = self.pa
+        column_types = self._get_column_types(table_name)
+
+        column_values = list(zip(*rows))
+        arrays = []
+        fields = []
+        for i, col in enumerate(columns):
+            arrow_type = self._arrow_type(column_types.get(col, 'TEXT'))
+            arrays.append(self._to_array(column_values[i], arrow_type))
+            fields.append(pa.field(col, arrow_type))
+
+        return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+    def _open_writer(self, table_name, schema):
+        table_dir = self.output_directory / table_name
+        table_dir.mkdir(parents=True, exist_ok=True)
+
+        file_number = self.file_number.get(table_name, 0)
+        file_path = table_dir / f'part-{self.pid}-{file_number:05d}.parquet'
+
+        writer = self.pq.ParquetWriter(
+            file_path,
+            schema,
+            compression=self.compression,
+            compression_level=self.compression_level
+        )
+
+        self.writers[table_name] = writer
+        self.rows_in_file[table_name] = 0
+        self.file_number[table_name] = file_number + 1
+        return writer
+
+    def write(self, table_name, rows, columns, primary_key=None):
+        if not rows:
+            return 0
+
+        if isinstance(rows, EncodedRows):
+            raise ValueError('Rows encoded for COPY (encode_results_in_workers) can only be written to postgres')
+
+        if self.sort_by_pk:
+            rows = sort_rows_by_key(rows, columns, primary_key)
+
+        table = self._build_table(table_name, rows, columns)
+
+        writer = self.writers.get(table_name)
+        if writer is not None and self.rows_in_file[table_name] >= self.max_rows_per_file:
+            writer.close()
+            writer = None
+
+        if writer is None:
+            writer = self._open_writer(table_name, table.schema)
+
+        # one row group per batch
+        writer.write_table(table, row_group_size=len(rows))
+        self.rows_in_file[table_name] += len(rows)
+
+        return len(rows)
+
+    def close(self):
+        for table_name, writer in self.writers.items():
+            try:
+                writer.close()
+            except Exception as e:
+                print(f'Error closing parquet file for {table_name}: {e}', flush=True)
+        self.writers = {}
+
+
+def compress_segment(payload, compression, compression_level=3):
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=compression_level).compress(payload)
+    if compression == 'gzip':
+        import gzip
+        return gzip.compress(payload, compresslevel=compression_level)
+    if compression == 'none':
+        return payload
+    raise ValueError(f"Unknown spool compression '{compression}'. Options are: zstd, gzip, none")
+
+
+def decompress_segment(payload, file_name):
+    if file_name.endswith('.zst'):
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(payload)
+    if file_name.endswith('.gz'):
+        import gzip
+        return gzip.decompress(payload)
+    return payload
+
+
+def open_segment(path):
+    """Opens a segment (or any COPY file) as a stream of the uncompressed payload"""
+    path = str(path)
+    if path.endswith('.zst'):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True)
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+SEGMENT_EXTENSIONS = {'zstd': '.copy.zst', 'gzip': '.copy.gz', 'none': '.copy'}
+
+
+class SpoolSink():
+    """
+        Writes every batch of a table as a compressed segment file in the COPY text format,
+        so the extraction doesn't wait for PostgreSQL. The segments are loaded by spool_loader.py.
+
+        Segments are stored in <directory>/<table_name>/seg-<pid>-<run id>-<n>.copy.zst, they are written
+        to a hidden temporary file and renamed when complete. The columns and primary key of
+        each table are stored in <directory>/<table_name>/_table.json.
+    """
+
+    name = 'spool'
+
+    def __init__(self, set_up):
+        self.set_up = set_up
+        spool_config = set_up.get('spool_sink', {})
+        self.directory = Path(spool_config.get('directory', 'data/spool'))
+        self.compression = spool_config.get('compression', 'zstd')
+        self.compression_level = spool_config.get('compression_level', 3)
+        if self.compression not in SEGMENT_EXTENSIONS:
+            raise ValueError(f"Unknown spool compression '{self.compression}'. Options are: {', '.join(SEGMENT_EXTENSIONS)}")
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.pid = os.getpid()
+        # pids are reused between runs (e.g. in containers), the run id keeps the names of the segments of each run unique
+        self.run_id = uuid.uuid4().hex
+        self.segment_number = {}
+        self.bytes_written = 0
+
+    def _write_table_info(self, table_dir, columns, primary_key):
+        info_path = table_dir / '_table.json'
+        if info_path.exists():
+            return
+        tmp_path = table_dir / f'._table.json.{self.pid}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'columns': list(columns), 'primary_key': primary_key}, f)
+        os.replace(tmp_path, info_path)
+
+    def write(self, table_name, rows, columns, primary_key=None):
+        if not rows:
+            return 0
+
+        table_dir = self.directory / table_name
+        if table_name not in self.segment_number:
+            table_dir.mkdir(parents=True, exist_ok=True)
+            self._write_table_info(table_dir, columns, primary_key)
+            self.segment_number[table_name] = 0
+
+        payload = rows.payload() if isinstance(rows, EncodedRows) else encode_copy_rows(rows)
+        payload = compress_segment(payload, self.compression, self.compression_level)
+
+        segment_name = f'seg-{self.pid}-{self.run_id}-{self.segment_number[table_name]:06d}{SEGMENT_EXTENSIONS[self.compression]}'
+        tmp_path = table_dir / f'.{segment_name}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, table_dir / segment_name)
+
+        self.segment_number[table_name] += 1
+        self.bytes_written += len(payload)
+        return len(rows)
+
+    def close(self):
+        pass
+
+
+SINKS = {
+    PostgresSink.name: PostgresSink,
+    ParquetSink.name: ParquetSink,
+    SpoolSink.name: SpoolSink,
+    ShardedPostgresSink.name: ShardedPostgresSink
+}
+
+
+def create_sink(set_up):
+    """Creates the sink set in change_extraction_processing.output_sink (postgres by default)"""
+    sink_name = set_up.get('change_extraction_processing', {}).get('output_sink', 'postgres')
+    if sink_name not in SINKS:
+        raise ValueError(f"Unknown output_sink '{sink_name}'. Options are: {', '.join(SINKS)}")
+    return SINKS[sink_name](set_up)
@@ -0,0 +1,204 @@
+import os
+import time
+import json
+import yaml
+import argparse
+import threading
+import traceback
+import concurrent.futures
+from pathlib import Path
+import psycopg2
+
+from scripts.const import SETUP_PATH
+from scripts.sinks import get_db_connection, decompress_segment
+from scripts.utils import insert_rows_copy, create_db_schema, EncodedRows
+
+"""
+    Loads the segments written by SpoolSink (output_sink: spool) into PostgreSQL, with parallel connections.
+    The extraction writes segments at its own speed and this process ingests them, so a slow DB
+    (autovacuum, checkpoints) doesn't stop the extraction.
+
+    Loaded segments are added to <spool directory>/loaded_segments.txt, so the loader can be stopped and restarted.
+    Only one loader should run per spool directory.
+
+    Usage:
+        python -m scripts.spool_loader               # loads the segments that are in the spool directory
+        python -m scripts.spool_loader --watch       # keeps loading new segments until it's stopped
+"""
+
+MANIFEST_FILE = 'loaded_segments.txt'
+
+
+def table_load_level(table_name):
+    """
+        Segments are loaded by level because of the foreign keys:
+        revisions (and entity_stats) first, then the changes and then the features (they reference value_change)
+    """
+    if table_name.startswith('revision') or table_name.startswith('entity_stats'):
+        return 0
+    if table_name.startswith('features_'):
+        return 2
+    return 1
+
+
+class SpoolLoader():
+
+    def __init__(self, set_up, num_workers=None, delete_loaded=None):
+        self.set_up = set_up
+        spool_config = set_up.get('spool_sink', {})
+        self.directory = Path(spool_config.get('directory', 'data/spool'))
+        self.num_workers = num_workers or spool_config.get('loader_workers', 4)
+        self.delete_loaded = spool_config.get('delete_loaded_segments', True) if delete_loaded is None else delete_loaded
+        self.max_retries = 3
+
+        self.manifest_path = self.directory / MANIFEST_FILE
+        self.manifest_lock = threading.Lock()
+        self.loaded = self._read_manifest()
+
+        self.table_info = {}
+        self.local = threading.local()
+        self.connections = []
+
+    def _read_manifest(self):
+        if not self.manifest_path.exists():
+            return set()
+        with open(self.manifest_path) as f:
+            return set(line.strip() for line in f if line.strip())
+
+    def _mark_loaded(self, segment_key, segment_path):
+        with self.manifest_lock:
+            with open(self.manifest_path, 'a') as f:
+                f.write(f"{segment_key}\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.loaded.add(segment_key)
+
+        if self.delete_loaded:
+            try:
+                os.remove(segment_path)
+            except FileNotFoundError:
+                pass
+
+    def _get_connection(self):
+        # one connection per loader thread
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = get_db_connection(self.set_up)
+            self.local.conn = conn
+            self.connections.append(conn)
+        return conn
+
+    def _get_table_info(self, table_name):
+        if table_name not in self.table_info:
+            with open(self.directory / table_name / '_table.json') as f:
+                self.table_info[table_name] = json.load(f)
+        return self.table_info[table_name]
+
+    def find_segments(self):
+        """
+            Returns {level: [(table_name, segment_key, segment_path)]} of the segments that haven't been loaded.
+            Tables are listed from the last level to the first, so a segment is never found
+            without the segments it references (they are written before it).
+        """
+        if not self.directory.exists():
+            return {}
+
+        table_dirs = [d for d in self.directory.iterdir() if d.is_dir() and (d / '_table.json').exists()]
+        table_dirs = sorted(table_dirs, key=lambda d: table_load_level(d.name), reverse=True)
+
+        segments = {}
+        for table_dir in table_dirs:
+            for segment_path in sorted(table_dir.iterdir()):
+                if not segment_path.name.startswith('seg-'):
+                    continue # _table.json and temporary files
+                segment_key = f'{table_dir.name}/{segment_path.name}'
+                if segment_key in self.loaded:
+                    continue
+                segments.setdefault(table_load_level(table_dir.name), []).append((table_dir.name, segment_key, segment_path))
+        return segments
+
+    def _load_segment(self, table_name, segment_key, segment_path):
+        table_info = self._get_table_info(table_name)
+        with open(segment_path, 'rb') as f:
+            rows = EncodedRows.from_payload(decompress_segment(f.read(), segment_path.name))
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                # sorted by primary key, so concurrent loads of the same table lock rows in the same order
+                insert_rows_copy(self._get_connection(), table_name, rows, table_info['columns'], table_info['primary_key'], sort_by_key=True)
+                break
+            except (psycopg2.errors.DeadlockDetected, psycopg2.errors.SerializationFailure):
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(1 + attempt)
+
+        self._mark_loaded(segment_key, segment_path)
+        return len(rows)
+
+    def load_pending(self, executor):
+        """Loads the segments that are in the spool directory. Returns (segments, rows)"""
+        segments = self.find_segments()
+        num_segments = 0
+        num_rows = 0
+        for level in sorted(segments):
+            futures = [executor.submit(self._load_segment, *segment) for segment in segments[level]]
+            for future in concurrent.futures.as_completed(futures):
+                num_rows += future.result()
+                num_segments += 1
+        return num_segments, num_rows
+
+    def run(self, watch=False, poll_seconds=10):
+        print(f"[SPOOL_LOADER] Loading segments from {self.directory} with {self.num_workers} connections, {len(self.loaded)} already loaded", flush=True)
+
+        total_segments = 0
+        total_rows = 0
+        start = time.time()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+                while True:
+                    pass_start = time.time()
+                    num_segments, num_rows = self.load_pending(executor)
+                    total_segments += num_segments
+                    total_rows += num_rows
+
+                    if num_segments > 0:
+                        pass_time = time.time() - pass_start
+                        print(f"[SPOOL_LOADER] Loaded {num_segments} segments, {num_rows} rows in {pass_time:.2f}s ({num_rows / pass_time:.0f} rows/s)", flush=True)
+
+                    if not watch:
+                        break
+                    if num_segments == 0:
+                        time.sleep(poll_seconds)
+        except KeyboardInterrupt:
+            print(f"[SPOOL_LOADER] Stopped", flush=True)
+        except Exception as e:
+            print(f"[SPOOL_LOADER] Error loading segments: {e}", flush=True)
+            print(traceback.format_exc(), flush=True)
+            raise e
+        finally:
+            for conn in self.connections:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+        print(f"[SPOOL_LOADER] Done: {total_segments} segments, {total_rows} rows in {time.time() - start:.2f}s", flush=True)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=None, help='Number of parallel connections (default spool_sink.loader_workers)')
+    parser.add_argument('--watch', action='store_true', help='Keep loading new segments until the process is stopped')
+    parser.add_argument('--poll_seconds', type=int, default=10, help='With --watch, seconds between checks for new segments')
+    parser.add_argument('--keep_segments', action='store_true', help="Don't delete the segments once they are loaded")
+    args = parser.parse_args()
+
+    script_dir = Path(__file__).parent
+    with open(script_dir.parent / Path(SETUP_PATH), 'r') as f:
+        set_up = yaml.safe_load(f)
+
+    create_db_schema(set_up)
+
+    loader = SpoolLoader(set_up, num_workers=args.workers, delete_loaded=False if args.keep_segments else None)
+    loader.run(watch=args.watch, poll_seconds=args.poll_seconds)
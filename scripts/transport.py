@@ -0,0 +1,280 @@
+import os
+import time
+import queue
+import pickle
+import tempfile
+import threading
+import uuid
+import multiprocessing as mp
+from multiprocessing.connection import Listener, Client, wait
+
+"""
+    Channels used to send the results of the page workers to the db_writer.
+    Both implement put(obj) (workers) and get(timeout) (writer, raises queue.Empty on timeout).
+"""
+
+class PipeResultsChannel():
+    """
+        Direct worker -> writer channel over a Unix socket (multiprocessing.connection).
+
+        Each worker process opens its own connection on the first put(), so a message is pickled once
+        and sent straight to the writer (mp.Manager().Queue() pickles it to the manager process and again to the writer).
+        The writer acknowledges every message. A worker blocks when it has max_in_flight messages
+        that haven't been acknowledged yet (back-pressure).
+
+        Only the address and authkey are pickled, so the channel can be passed to other processes.
+    """
+
+    def __init__(self, max_in_flight=64, connect_timeout=120):
+        self.address = os.path.join(tempfile.gettempdir(), f'wd_results_{uuid.uuid4().hex}.sock')
+        self.authkey = os.urandom(16)
+        self.max_in_flight = max_in_flight
+        self.connect_timeout = connect_timeout
+
+        self._init_process_state()
+
+    def _init_process_state(self):
+        # worker side
+        self._conn = None
+        self._conn_pid = None
+        self._in_flight = 0
+
+        # stats (worker side) to measure the overhead per message
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.send_time = 0.0
+
+        # writer side
+        self._listener = None
+        self._accept_thread = None
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._closed = False
+
+    def __getstate__(self):
+        return {
+            'address': self.address,
+            'authkey': self.authkey,
+            'max_in_flight': self.max_in_flight,
+            'connect_timeout': self.connect_timeout
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_process_state()
+
+    # ------------------------------------------------------------------
+    # Worker side
+    # ------------------------------------------------------------------
+    def _connect(self):
+        # the writer might not be listening yet
+        start = time.time()
+        while True:
+            try:
+                self._conn = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.time() - start > self.connect_timeout:
+                    raise
+                time.sleep(0.1)
+        self._conn_pid = os.getpid()
+        self._in_flight = 0
+
+    def _read_acks(self, block):
+        while self._in_flight > 0 and (block or self._conn.poll(0)):
+            self._in_flight -= self._conn.recv()
+            block = False
+
+    def put(self, obj):
+        start = time.time()
+
+        if self._conn is None or self._conn_pid != os.getpid():
+            # forked processes can't reuse the connection of the parent
+            self._connect()
+
+        self._read_acks(block=self._in_flight >= self.max_in_flight)
+
+        payload = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        self._conn.send_bytes(payload)
+        self._in_flight += 1
+
+        self.messages_sent += 1
+        self.bytes_sent += len(payload)
+        self.send_time += time.time() - start
+
+        if obj is None:
+            # the worker is done (see FileParser._worker), the writer closes its side
+            self._conn.close()
+            self._conn = None
+
+    def stats(self):
+        """Summary of the messages sent by this process"""
+        if self.messages_sent == 0:
+            return 'no messages sent'
+        return (f'{self.messages_sent} messages, avg {self.bytes_sent / self.messages_sent / 1024:.1f} KB/message, '
+                f'avg {self.send_time / self.messages_sent * 1000:.3f} ms/message')
+
+    # ------------------------------------------------------------------
+    # Writer side
+    # ------------------------------------------------------------------
+    def _start_listener(self):
+        self._listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey, backlog=512)
+        self._accept_thread = threading.Thread(target=self._accept_connections, daemon=True)
+        self._accept_thread.start()
+
+    def _accept_connections(self):
+        while not self._closed:
+            try:
+                conn = self._listener.accept()
+            except Exception:
+                if self._closed:
+                    break
+                continue
+            with self._connections_lock:
+                self._connections.append(conn)
+
+    def _remove_connection(self, conn):
+        with self._connections_lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def get(self, timeout=None):
+        if self._listener is None:
+            self._start_listener()
+
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self._connections_lock:
+                connections = list(self._connections)
+
+            # short waits so new connections from the accept thread are picked up
+            ready = wait(connections, timeout=0.5) if connections else []
+            if not connections:
+                time.sleep(0.05)
+
+            for conn in ready:
+                try:
+                    obj = pickle.loads(conn.recv_bytes())
+                except (EOFError, OSError):
+                    self._remove_connection(conn)
+                    continue
+
+                if obj is None:
+                    # last message of the worker
+                    self._remove_connection(conn)
+                else:
+                    # move it to the end so the next get() doesn't favour the same worker
+                    with self._connections_lock:
+                        if conn in self._connections:
+                            self._connections.remove(conn)
+                            self._connections.append(conn)
+                    try:
+                        conn.send(1)
+                    except OSError:
+                        # the worker already sent its last message and closed the connection
+                        pass
+                return obj
+
+            if deadline is not None and time.time() > deadline:
+                raise queue.Empty
+
+    def close(self):
+        self._closed = True
+        with self._connections_lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._connections = []
+        if self._listener is not None:
+            self._listener.close() # also removes the socket file
+            self._listener = None
+
+
+def get_table_suffix(result):
+    """Suffix of the tables where the results of an entity are stored"""
+    if result['is_astronomical_object']:
+        return '_ao'
+    if result['is_scholarly_article']:
+        return '_sa'
+    if result['has_less_revisions']:
+        return '_less'
+    return ''
+
+
+def compress_payload(payload, compression):
+    if compression == 'lz4':
+        import lz4.frame
+        return lz4.frame.compress(payload)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).compress(payload)
+    raise ValueError(f"Unknown results_compression '{compression}'. Options are: none, lz4, zstd")
+
+
+def decompress_payload(payload, compression):
+    if compression == 'lz4':
+        import lz4.frame
+        return lz4.frame.decompress(payload)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(payload)
+    raise ValueError(f"Unknown results_compression '{compression}'. Options are: none, lz4, zstd")
+
+
+def pack_results_batch(table_suffix, tables, num_entities, compression=None):
+    """
+        Message with the results of several entities of the same suffix (see FileParser._worker).
+        tables is {table_name: rows}. If compression is lz4 or zstd the tables are pickled and compressed.
+    """
+    message = {
+        'results_batch': True,
+        'table_suffix': table_suffix,
+        'num_entities': num_entities,
+        'compression': None,
+        'tables': tables
+    }
+    if compression and compression != 'none':
+        message['compression'] = compression
+        message['tables'] = compress_payload(pickle.dumps(tables, protocol=pickle.HIGHEST_PROTOCOL), compression)
+    return message
+
+
+def unpack_results_message(message):
+    """
+        Returns a list of (table_suffix, {table_name: rows}) from a message of a page worker,
+        which is either the results of one entity (PageParser.process_page) or a batch (pack_results_batch)
+    """
+    if not message.get('results_batch', False):
+        return [(get_table_suffix(message), message)]
+
+    tables = message['tables']
+    if message['compression']:
+        tables = pickle.loads(decompress_payload(tables, message['compression']))
+    return [(message['table_suffix'], tables)]
+
+
+def get_loaded_pages(message):
+    """{file_path: [page_index]} of the pages whose results are in the message (only with load_manifest)"""
+    return message.get('loaded_pages') or {}
+
+
+def create_results_channel(set_up):
+    """
+        Creates the channel between the page workers and the db_writer, set in change_extraction_processing.results_transport:
+            - queue (default): mp.Manager().Queue(maxsize=db_max_queue_size)
+            - pipe: PipeResultsChannel
+    """
+    processing = set_up.get('change_extraction_processing', {})
+    transport = processing.get('results_transport', 'queue')
+
+    if transport == 'pipe':
+        return PipeResultsChannel(max_in_flight=processing.get('results_max_in_flight', 64))
+    if transport == 'queue':
+        return mp.Manager().Queue(maxsize=processing.get('db_max_queue_size', 10000))
+    raise ValueError(f"Unknown results_transport '{transport}'. Options are: queue, pipe")
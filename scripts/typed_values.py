@@ -0,0 +1,152 @@
+import re
+import json
+
+"""
+    Typed values (change_extraction_processing.typed_values)
+
+    By default old_value and new_value are stored as JSONB (json.dumps of the parsed value, '{}' when there's no value).
+    With typed_values, the value, qualifier and reference change tables have one column per kind of value instead,
+    for old_ and new_ (e.g. old_value_entity, new_value_entity):
+        - value_text: strings, monolingual text, non-item entity ids (P31, L1-F1), novalue/somevalue, ranks
+        - value_entity: numeric id of items (Q42 -> 42)
+        - value_time_year/month/day: parts of time values (+2017-09-01T00:00:00Z)
+        - value_quantity + value_unit: amount and numeric id of the unit item (NULL if the quantity has no unit)
+        - value_latitude/value_longitude: globe coordinates
+        - value_json: any other value (e.g. numbers of datatype metadata changes in value_change)
+    The page workers build the columns without serializing the values, and values can be joined
+    (e.g. value_entity with entity_labels_alias_description.numeric_id) through normal indexes.
+    When the time or quantity parts don't give back the same string (e.g. years with leading zeros),
+    value_text also has the original string, so the original value can always be recovered (see to_value).
+"""
+
+TYPED_VALUE_TABLES = ['value_change', 'qualifier_change', 'reference_change']
+
+# (column, sql type)
+TYPED_VALUE_COLUMNS = [
+    ('value_text', 'TEXT'),
+    ('value_entity', 'INT'),
+    ('value_time_year', 'BIGINT'),
+    ('value_time_month', 'SMALLINT'),
+    ('value_time_day', 'SMALLINT'),
+    ('value_quantity', 'NUMERIC'),
+    ('value_unit', 'INT'),
+    ('value_latitude', 'DOUBLE PRECISION'),
+    ('value_longitude', 'DOUBLE PRECISION'),
+    ('value_json', 'JSONB'),
+]
+COMPRESSIBLE_TYPES = ('TEXT', 'JSONB')
+
+EMPTY_VALUE = (None,) * len(TYPED_VALUE_COLUMNS)
+
+ITEM_PATTERN = re.compile(r'^Q([1-9][0-9]*)$')
+TIME_PATTERN = re.compile(r'^([+-])([0-9]+)-([0-9]{2})-([0-9]{2})T00:00:00Z$')
+QUANTITY_PATTERN = re.compile(r'^[+-]?[0-9]+(\.[0-9]+)?$')
+UNIT_PATTERN = re.compile(r'^https?://www\.wikidata\.org/entity/Q([0-9]+)$')
+
+
+def typed_columns(side):
+    """Columns of old_value (side='old') or new_value (side='new')"""
+    return [f'{side}_{column}' for column, _ in TYPED_VALUE_COLUMNS]
+
+
+def typed_value_columns(columns):
+    """Columns of a change table with old_value and new_value replaced by the typed columns"""
+    typed = []
+    for column in columns:
+        if column == 'old_value':
+            typed.extend(typed_columns('old'))
+        elif column == 'new_value':
+            typed.extend(typed_columns('new'))
+        else:
+            typed.append(column)
+    return typed
+
+
+def typed_value_column_types():
+    """{column: sql type} of the typed columns"""
+    return {f'{side}_{column}': sql_type for side in ('old', 'new') for column, sql_type in TYPED_VALUE_COLUMNS}
+
+
+def typed_value_schema(query, compression=None):
+    """Replaces old_value/new_value (column definitions and c.old_value, c.new_value in the compact views) by the typed columns"""
+    def definitions(side):
+        return ',\n'.join(
+            f"    {side}_{column} {sql_type}" + (f" COMPRESSION {compression}" if compression and sql_type in COMPRESSIBLE_TYPES else '')
+            for column, sql_type in TYPED_VALUE_COLUMNS
+        )
+
+    query = re.sub(r'^\s*old_value JSONB,\n\s*new_value JSONB,', lambda _: definitions('old') + ',\n' + definitions('new') + ',', query, flags=re.MULTILINE)
+    return query.replace('c.old_value, c.new_value', ', '.join(f'c.{column}' for column in typed_columns('old') + typed_columns('new')))
+
+
+def get_unit(datatype_metadata):
+    """Numeric id of the unit of a quantity (None if it doesn't have one)"""
+    if not datatype_metadata:
+        return None
+    match = UNIT_PATTERN.match(str(datatype_metadata.get('unit', '')))
+    return int(match.group(1)) if match else None
+
+
+def typed_value(value, datatype, unit=None):
+    """Returns the typed columns of a value (see TYPED_VALUE_COLUMNS)"""
+    if not value:
+        return EMPTY_VALUE
+
+    if isinstance(value, str):
+        if datatype == 'wikibase-entityid':
+            match = ITEM_PATTERN.match(value)
+            if match:
+                return (None, int(match.group(1)), None, None, None, None, None, None, None, None)
+
+        elif datatype == 'time':
+            match = TIME_PATTERN.match(value)
+            if match:
+                sign, year, month, day = match.groups()
+                year = int(year) if sign == '+' else -int(year)
+                text = None if format_time(year, int(month), int(day)) == value else value
+                return (text, None, year, int(month), int(day), None, None, None, None, None)
+
+        elif datatype == 'quantity':
+            if QUANTITY_PATTERN.match(value):
+                amount = value.lstrip('+')
+                text = None if format_quantity(amount) == value else value
+                return (text, None, None, None, None, amount, unit, None, None, None)
+
+        return (value, None, None, None, None, None, None, None, None, None)
+
+    if datatype == 'globecoordinate' and isinstance(value, dict) and set(value) == {'latitude', 'longitude'} \
+            and all(isinstance(value[k], (int, float)) and not isinstance(value[k], bool) for k in value):
+        return (None, None, None, None, None, None, None, float(value['latitude']), float(value['longitude']), None)
+
+    return (None, None, None, None, None, None, None, None, None, json.dumps(value, ensure_ascii=False))
+
+
+def format_time(year, month, day):
+    return f"{'+' if year >= 0 else '-'}{abs(year):04d}-{month:02d}-{day:02d}T00:00:00Z"
+
+
+def format_quantity(amount):
+    return amount if amount.startswith('-') else '+' + amount
+
+
+def to_value(typed):
+    """Inverse of typed_value (the value as it was before being stored, None if there was no value)"""
+    text, entity, year, month, day, quantity, _, latitude, longitude, value_json = typed
+    if text is not None:
+        return text
+    if entity is not None:
+        return f'Q{entity}'
+    if year is not None:
+        return format_time(int(year), int(month), int(day))
+    if quantity is not None:
+        return format_quantity(str(quantity))
+    if latitude is not None:
+        return {'longitude': longitude, 'latitude': latitude}
+    if value_json is not None:
+        return json.loads(value_json) if isinstance(value_json, str) else value_json
+    return None
+
+
+def flatten_typed_values(change, value_idx):
+    """The change tuple has the typed old and new values (tuples) at value_idx and value_idx + 1"""
+    return change[:value_idx] + change[value_idx] + change[value_idx + 1] + change[value_idx + 2:]
@@ -10,7 +10,7 @@ import json
 import hashlib
 from urllib.parse import urljoin
 import sys
-from io import StringIO
+from io import StringIO, BytesIO
 from dateutil import parser
 from io import StringIO
 import os
@@ -19,6 +19,9 @@ import os
 import psutil
 
 from scripts.const import WIKIDATA_SERVICE_URL, DOWNLOAD_LINKS_FILE_PATH
+from scripts.dimensions import COMPACT_TABLES
+from scripts.binary_keys import binary_key_schema
+from scripts.typed_values import typed_value_schema
 
 def total_memory_usage():
     """Get total memory including all child processes in MB"""
@@ -148,19 +151,128 @@ def update_entity_label(conn, entity_id, entity_label):
         conn.rollback()
         print(f"Update of label ({entity_label}) for entity {entity_id} failed: {e}")
 
-def insert_rows_copy(conn, table_name, rows, columns, conflict_column=None):
+def encode_copy_value(val):
+    """Formats a value for COPY ... FROM STDIN (text format)"""
+    if val is None:
+        return '\\N'
+    elif val == '':
+        return ''
+    elif isinstance(val, (bytes, bytearray)):
+        # BYTEA (binary_keys), hex format
+        return '\\\\x' + val.hex()
+    else:
+        val_str = str(val)
+        val_str = val_str.replace('\\', '\\\\')
+        val_str = val_str.replace('"', '\\"')
+        val_str = val_str.replace('\t', '\\t')
+        val_str = val_str.replace('\n', '\\n')
+        val_str = val_str.replace('\r', '\\r')
+        return val_str
+
+def encode_copy_rows(rows):
+    """Encodes rows (list of tuples) as the utf-8 payload of COPY ... FROM STDIN (text format)"""
+    return ''.join('\t'.join([encode_copy_value(val) for val in row]) + '\n' for row in rows).encode('utf-8')
+
+class EncodedRows():
+    """
+        Rows of a table already encoded for COPY (see encode_copy_rows).
+        Page workers can encode their rows so the db_writer only concatenates and streams them.
+        len() is the number of rows, so it can be used like the list of rows in batch_insert.
+    """
+    def __init__(self, rows=None):
+        self.chunks = []
+        self.num_rows = 0
+        if rows:
+            self.add_rows(rows)
+
+    @classmethod
+    def from_payload(cls, payload):
+        """Rows that are already a COPY payload (e.g. a spool segment)"""
+        encoded = cls()
+        if payload:
+            encoded.chunks.append(payload)
+            # newlines inside values are escaped, so there is one per row
+            encoded.num_rows = payload.count(b'\n')
+        return encoded
+
+    def add_rows(self, rows):
+        self.chunks.append(encode_copy_rows(rows))
+        self.num_rows += len(rows)
+
+    def extend(self, other):
+        if isinstance(other, EncodedRows):
+            self.chunks.extend(other.chunks)
+            self.num_rows += other.num_rows
+        elif other:
+            self.add_rows(other)
+
+    def nbytes(self):
+        return sum(len(chunk) for chunk in self.chunks)
+
+    def payload(self):
+        return b''.join(self.chunks)
+
+    def __len__(self):
+        return self.num_rows
+
+def extend_rows(current_rows, rows):
+    """
+        Adds rows to current_rows and returns the result.
+        Both can be a list of tuples or EncodedRows, if one of them is encoded the result is encoded.
+    """
+    if isinstance(rows, EncodedRows) and not isinstance(current_rows, EncodedRows):
+        encoded = EncodedRows(current_rows)
+        encoded.extend(rows)
+        return encoded
+    current_rows.extend(rows)
+    return current_rows
+
+def estimate_rows_bytes(rows, sample_size=3):
+    """
+        Approximate size of rows once encoded for COPY.
+        Exact for EncodedRows, for a list of tuples it's estimated from a few rows (first, middle, last)
+    """
+    if isinstance(rows, EncodedRows):
+        return rows.nbytes()
+    if not rows:
+        return 0
+    step = max(1, len(rows) // sample_size)
+    sample = rows[::step][:sample_size]
+    sample_bytes = sum(len(str(val)) + 1 for row in sample for val in row)
+    return int(sample_bytes / len(sample) * len(rows))
+
+def sort_rows_by_key(rows, columns, key_columns):
+    """
+        Sorts rows (list of tuples) by the key columns (e.g. the primary key), so consecutive rows
+        go to the same index and heap pages. The sort is stable, so duplicated keys keep their order.
+    """
+    if not rows or not key_columns:
+        return rows
+    if isinstance(key_columns, str):
+        key_columns = [key_columns]
+    key_idx = [columns.index(col) for col in key_columns if col in columns]
+    if not key_idx:
+        return rows
+
+    try:
+        return sorted(rows, key=lambda row: tuple((row[i] is not None, row[i]) for i in key_idx))
+    except TypeError:
+        # a column with mixed types (e.g. int and str)
+        return sorted(rows, key=lambda row: tuple((row[i] is not None, str(row[i])) for i in key_idx))
+
+def insert_rows_copy(conn, table_name, rows, columns, conflict_column=None, sort_by_key=False):
     """
     Insert rows with conflict handling
     
     Args:
         conflict_column: Primary key column(s) for conflict detection
         update_columns: Columns to update on conflict (None = skip updates, DO NOTHING)
+        sort_by_key: rows are inserted ordered by conflict_column (better locality of the primary key index)
     """
     if not rows:
         return
     
     cursor = conn.cursor()
-    buffer = StringIO()
     try:
         temp_table = f"{table_name}_temp_{os.getpid()}"
         
@@ -172,24 +284,12 @@ def insert_rows_copy(conn, table_name, rows, columns, conflict_column=None):
         """)
         
         # COPY to temp table
-        for row in rows:
-            line_items = []
-            for i, val in enumerate(row):
-                if val is None:
-                    line_items.append('\\N')
-                elif val == '':
-                    line_items.append('')
-                else:
-                    val_str = str(val)
-                    val_str = val_str.replace('\\', '\\\\')
-                    val_str = val_str.replace('"', '\\"')
-                    val_str = val_str.replace('\t', '\\t')
-                    val_str = val_str.replace('\n', '\\n')
-                    val_str = val_str.replace('\r', '\\r')
-                    line_items.append(val_str)
-            buffer.write('\t'.join(line_items) + '\n')
+        if isinstance(rows, EncodedRows):
+            # already encoded by the page workers
+            buffer = BytesIO(rows.payload())
+        else:
+            buffer = BytesIO(encode_copy_rows(rows))
         
-        buffer.seek(0)
         column_names = ', '.join(columns)
         copy_query = f"COPY {temp_table} ({column_names}) FROM STDIN"
         cursor.copy_expert(copy_query, buffer)
@@ -201,6 +301,8 @@ def insert_rows_copy(conn, table_name, rows, columns, conflict_column=None):
             else:
                 conflict_cols = conflict_column
             
+            # the temp table is sorted by postgres, so it also works for rows encoded by the workers
+            order_by = f"ORDER BY {conflict_cols}" if sort_by_key else ""
             
             if 'entity_stat' not in table_name and 'feature' not in table_name:
                 # DO NOTHING on conflict
@@ -208,6 +310,7 @@ def insert_rows_copy(conn, table_name, rows, columns, conflict_column=None):
                 insert_query = f"""
                     INSERT INTO {table_name} ({column_names})
                     SELECT {column_names} FROM {temp_table}
+                    {order_by}
                     ON CONFLICT ({conflict_cols}) DO NOTHING
                 """
             else:
@@ -216,6 +319,7 @@ def insert_rows_copy(conn, table_name, rows, columns, conflict_column=None):
                 insert_query = f"""
                     INSERT INTO {table_name} ({column_names})
                     SELECT {column_names} FROM {temp_table}
+                    {order_by}
                     ON CONFLICT ({conflict_cols}) DO UPDATE SET         
                     {', '.join([f'{col} = EXCLUDED.{col}' for col in columns if col not in conflict_column])}
                 """
@@ -238,7 +342,28 @@ def insert_rows_copy(conn, table_name, rows, columns, conflict_column=None):
         raise
     finally:
         cursor.close()
-        buffer.close()
+
+
+def copy_rows(conn, table_name, rows, columns):
+    """
+    COPY rows straight into the table, without conflict handling and without committing
+    (used with the load manifest, where the caller commits the rows with the manifest)
+    """
+    if not rows:
+        return 0
+
+    if isinstance(rows, EncodedRows):
+        buffer = BytesIO(rows.payload())
+    else:
+        buffer = BytesIO(encode_copy_rows(rows))
+
+    with conn.cursor() as cursor:
+        try:
+            cursor.copy_expert(f"COPY {table_name} ({', '.join(columns)}) FROM STDIN", buffer)
+        except Exception as e:
+            print(f"COPY failed for {table_name}: {e}")
+            raise
+        return cursor.rowcount
 
     
 def insert_rows(conn, table_name, rows, columns):
@@ -281,8 +406,30 @@ def create_db_schema(set_up):
 
     with open(datatype_metadata_file_path, "r", encoding="utf-8") as f:
         datatype_metadata_schema_template = f.read()
+
+    compact_schema = set_up.get('change_extraction_processing', {}).get('compact_schema', False)
+    if compact_schema:
+        # the change tables are replaced by the compact tables + views with the same columns (see dimensions.py)
+        for table_name in COMPACT_TABLES:
+            change_schema_template = re.sub(rf"CREATE TABLE IF NOT EXISTS {table_name}\{{suffix\}} \(.*?\n\);\n", "", change_schema_template, flags=re.DOTALL)
+
+        with open(f"{base_dir}/sql/compact_change_schema.sql", "r", encoding="utf-8") as f:
+            change_schema_template += "\n" + f.read()
+
+        with open(f"{base_dir}/sql/compact_datatype_metadata_schema.sql", "r", encoding="utf-8") as f:
+            datatype_metadata_schema_template = f.read()
+
+        features_file_template = features_file_template.replace("REFERENCES value_change{suffix}(", "REFERENCES value_change_compact{suffix}(")
+
+    if set_up.get('change_extraction_processing', {}).get('typed_values', False):
+        # old_value/new_value of the value, qualifier and reference changes are stored in typed columns (see typed_values.py)
+        compression = set_up.get('change_extraction_processing', {}).get('typed_values_compression', 'none')
+        change_schema_template = typed_value_schema(change_schema_template, compression=None if compression == 'none' else compression)
     
     base_query = change_schema_template.replace("{suffix}", "")
+    if compact_schema:
+        with open(f"{base_dir}/sql/dimension_schema.sql", "r", encoding="utf-8") as f:
+            base_query = f.read() + "\n" + base_query
 
     filters_rest = change_extraction_filters.get('rest', {})
     if filters_rest.get('feature_extraction', False):
@@ -350,6 +497,16 @@ def create_db_schema(set_up):
             query_dm_less = datatype_metadata_schema_template.replace("{suffix}", "_less")
             base_query += "\n" + query_dm_less
 
+    if set_up.get('change_extraction_processing', {}).get('load_manifest', False):
+        with open(f"{base_dir}/sql/load_manifest_schema.sql", "r", encoding="utf-8") as f:
+            base_query += "\n" + f.read()
+
+    if set_up.get('change_extraction_processing', {}).get('binary_keys', False):
+        # value_id and the hashes are stored as BYTEA (see binary_keys.py)
+        base_query = binary_key_schema(base_query)
+        with open(f"{base_dir}/sql/binary_keys_functions.sql", "r", encoding="utf-8") as f:
+            base_query += "\n" + f.read()
+
     try:
         script_dir = Path(__file__).parent
         db_config_path = script_dir.parent / set_up.get("db_config_path", "config/db_config.json")
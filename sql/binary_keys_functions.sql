@@ -0,0 +1,38 @@
+--- #####################################################
+--      Binary keys (change_extraction_processing.binary_keys)
+--      value_id and the hashes (old_hash, new_hash, value_hash, ref_hash) are stored as BYTEA (see binary_keys.py).
+--      These functions convert them to and from the text form, e.g.
+--          SELECT value_id_to_text(value_id), hash_to_text(value_hash) FROM reference_change
+--          SELECT * FROM value_change WHERE value_id = value_id_from_text('Q42$...')
+--- #####################################################
+
+-- value_id: 1 byte tag + content
+--      0: text (e.g. 'label'), stored as utf-8
+--      1: statement GUID with lowercase hex (<entity id>$<uuid>), stored as the 16 bytes of the uuid + the entity id
+--      2: same as 1 with uppercase hex
+CREATE OR REPLACE FUNCTION value_id_to_text(value_id BYTEA) RETURNS TEXT AS $$
+    SELECT CASE get_byte(value_id, 0)
+        WHEN 1 THEN convert_from(substring(value_id FROM 18), 'UTF8') || '$' || encode(substring(value_id FROM 2 FOR 16), 'hex')::uuid::text
+        WHEN 2 THEN convert_from(substring(value_id FROM 18), 'UTF8') || '$' || upper(encode(substring(value_id FROM 2 FOR 16), 'hex')::uuid::text)
+        ELSE convert_from(substring(value_id FROM 2), 'UTF8')
+    END
+$$ LANGUAGE SQL IMMUTABLE STRICT PARALLEL SAFE;
+
+CREATE OR REPLACE FUNCTION value_id_from_text(value_id TEXT) RETURNS BYTEA AS $$
+    SELECT CASE
+        WHEN value_id ~ '^[A-Za-z][0-9]+\$[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$'
+            THEN '\x01'::bytea || decode(replace(split_part(value_id, '$', 2), '-', ''), 'hex') || convert_to(split_part(value_id, '$', 1), 'UTF8')
+        WHEN value_id ~ '^[A-Za-z][0-9]+\$[0-9A-F]{8}-[0-9A-F]{4}-[0-9A-F]{4}-[0-9A-F]{4}-[0-9A-F]{12}$'
+            THEN '\x02'::bytea || decode(replace(split_part(value_id, '$', 2), '-', ''), 'hex') || convert_to(split_part(value_id, '$', 1), 'UTF8')
+        ELSE '\x00'::bytea || convert_to(value_id, 'UTF8')
+    END
+$$ LANGUAGE SQL IMMUTABLE STRICT PARALLEL SAFE;
+
+-- hashes: the 20 bytes of the sha1 ('' is stored as an empty BYTEA)
+CREATE OR REPLACE FUNCTION hash_to_text(hash BYTEA) RETURNS TEXT AS $$
+    SELECT encode(hash, 'hex')
+$$ LANGUAGE SQL IMMUTABLE STRICT PARALLEL SAFE;
+
+CREATE OR REPLACE FUNCTION hash_from_text(hash TEXT) RETURNS BYTEA AS $$
+    SELECT decode(hash, 'hex')
+$$ LANGUAGE SQL IMMUTABLE STRICT PARALLEL SAFE;
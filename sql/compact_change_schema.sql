@@ -0,0 +1,114 @@
+--- #####################################################
+--      Compact change tables (change_extraction_processing.compact_schema)
+--      Same rows as the change tables in change_schema.sql, but the property/entity labels, datatypes,
+--      action + target and week/year_month/year are stored as keys to the tables in dimension_schema.sql.
+--      The views with the names of the change tables have the columns of change_schema.sql,
+--      so the analysis queries don't change.
+--- #####################################################
+CREATE TABLE IF NOT EXISTS value_change_compact{suffix} (
+    revision_id BIGINT,
+    property_id INT, -- dim_property
+    value_id TEXT,
+    old_value JSONB,
+    new_value JSONB,
+    old_datatype_key SMALLINT, -- dim_datatype
+    new_datatype_key SMALLINT, -- dim_datatype
+    change_target TEXT,
+    action_key SMALLINT, -- dim_action
+    old_hash TEXT,
+    new_hash TEXT,
+    timestamp TIMESTAMP WITH TIME ZONE,
+    time_bucket_key SMALLINT, -- dim_time_bucket
+    label TEXT,
+    entity_id INT, -- dim_entity
+    is_reverted INT,
+    reversion INT,
+    reversion_timestamp TIMESTAMP WITH TIME ZONE DEFAULT NULL,
+    revision_id_reversion BIGINT DEFAULT NULL,
+    PRIMARY KEY (revision_id, property_id, value_id, change_target),
+    FOREIGN KEY (revision_id) REFERENCES revision{suffix}(revision_id)
+);
+
+CREATE TABLE IF NOT EXISTS qualifier_change_compact{suffix} (
+    revision_id BIGINT,
+    property_id INT,
+    value_id TEXT,
+    qual_property_id INT, -- dim_property
+    value_hash TEXT,
+    old_value JSONB,
+    new_value JSONB,
+    old_datatype_key SMALLINT,
+    new_datatype_key SMALLINT,
+    change_target TEXT,
+    action_key SMALLINT,
+    timestamp TIMESTAMP WITH TIME ZONE,
+    time_bucket_key SMALLINT,
+    label TEXT,
+    entity_id INT,
+    PRIMARY KEY (revision_id, property_id, value_id, qual_property_id, value_hash, change_target),
+    FOREIGN KEY (revision_id) REFERENCES revision{suffix}(revision_id)
+);
+
+CREATE TABLE IF NOT EXISTS reference_change_compact{suffix} (
+    revision_id BIGINT,
+    property_id INT,
+    value_id TEXT,
+    ref_property_id INT, -- dim_property
+    ref_hash TEXT,
+    value_hash TEXT,
+    old_value JSONB,
+    new_value JSONB,
+    old_datatype_key SMALLINT,
+    new_datatype_key SMALLINT,
+    change_target TEXT,
+    action_key SMALLINT,
+    timestamp TIMESTAMP WITH TIME ZONE,
+    time_bucket_key SMALLINT,
+    label TEXT,
+    entity_id INT,
+    PRIMARY KEY (revision_id, property_id, value_id, ref_hash, ref_property_id, value_hash, change_target),
+    FOREIGN KEY (revision_id) REFERENCES revision{suffix}(revision_id)
+);
+
+-- LEFT JOINs to unique keys: PostgreSQL skips the joins of the columns a query doesn't use
+CREATE OR REPLACE VIEW value_change{suffix} AS
+SELECT
+    c.revision_id, c.property_id, p.property_label, c.value_id, c.old_value, c.new_value,
+    od.datatype AS old_datatype, nd.datatype AS new_datatype, c.change_target, a.action, a.target,
+    c.old_hash, c.new_hash, c.timestamp, t.week, t.year_month, t.year, c.label, c.entity_id,
+    c.is_reverted, c.reversion, c.reversion_timestamp, c.revision_id_reversion, e.entity_label
+FROM value_change_compact{suffix} c
+LEFT JOIN dim_property p ON p.property_id = c.property_id
+LEFT JOIN dim_datatype od ON od.datatype_key = c.old_datatype_key
+LEFT JOIN dim_datatype nd ON nd.datatype_key = c.new_datatype_key
+LEFT JOIN dim_action a ON a.action_key = c.action_key
+LEFT JOIN dim_time_bucket t ON t.time_bucket_key = c.time_bucket_key
+LEFT JOIN dim_entity e ON e.entity_id = c.entity_id;
+
+CREATE OR REPLACE VIEW qualifier_change{suffix} AS
+SELECT
+    c.revision_id, c.property_id, p.property_label, c.value_id, c.qual_property_id, qp.property_label AS qual_property_label,
+    c.value_hash, c.old_value, c.new_value, od.datatype AS old_datatype, nd.datatype AS new_datatype, c.change_target,
+    a.action, a.target, c.timestamp, t.week, t.year_month, t.year, c.label, c.entity_id, e.entity_label
+FROM qualifier_change_compact{suffix} c
+LEFT JOIN dim_property p ON p.property_id = c.property_id
+LEFT JOIN dim_property qp ON qp.property_id = c.qual_property_id
+LEFT JOIN dim_datatype od ON od.datatype_key = c.old_datatype_key
+LEFT JOIN dim_datatype nd ON nd.datatype_key = c.new_datatype_key
+LEFT JOIN dim_action a ON a.action_key = c.action_key
+LEFT JOIN dim_time_bucket t ON t.time_bucket_key = c.time_bucket_key
+LEFT JOIN dim_entity e ON e.entity_id = c.entity_id;
+
+CREATE OR REPLACE VIEW reference_change{suffix} AS
+SELECT
+    c.revision_id, c.property_id, p.property_label, c.value_id, c.ref_property_id, rp.property_label AS ref_property_label,
+    c.ref_hash, c.value_hash, c.old_value, c.new_value, od.datatype AS old_datatype, nd.datatype AS new_datatype, c.change_target,
+    a.action, a.target, c.timestamp, t.week, t.year_month, t.year, c.label, c.entity_id, e.entity_label
+FROM reference_change_compact{suffix} c
+LEFT JOIN dim_property p ON p.property_id = c.property_id
+LEFT JOIN dim_property rp ON rp.property_id = c.ref_property_id
+LEFT JOIN dim_datatype od ON od.datatype_key = c.old_datatype_key
+LEFT JOIN dim_datatype nd ON nd.datatype_key = c.new_datatype_key
+LEFT JOIN dim_action a ON a.action_key = c.action_key
+LEFT JOIN dim_time_bucket t ON t.time_bucket_key = c.time_bucket_key
+LEFT JOIN dim_entity e ON e.entity_id = c.entity_id;
@@ -0,0 +1,36 @@
+--- #####################################################
+--      Compact datatype metadata changes (change_extraction_processing.compact_schema)
+--      See compact_change_schema.sql
+--- #####################################################
+CREATE TABLE IF NOT EXISTS datatype_metadata_change_compact{suffix} (
+    revision_id BIGINT,
+    property_id INT, -- dim_property
+    value_id TEXT,
+    old_value JSONB,
+    new_value JSONB,
+    old_datatype_key SMALLINT, -- dim_datatype
+    new_datatype_key SMALLINT, -- dim_datatype
+    change_target TEXT, --name of datatype metadata (e.g. 'upperBound' for quantity)
+    action_key SMALLINT, -- dim_action
+    old_hash TEXT,
+    new_hash TEXT,
+    timestamp TIMESTAMP WITH TIME ZONE,
+    time_bucket_key SMALLINT, -- dim_time_bucket
+    label TEXT,
+    entity_id INT, -- dim_entity
+    PRIMARY KEY (revision_id, property_id, value_id, change_target),
+    FOREIGN KEY (revision_id) REFERENCES revision{suffix}(revision_id)
+);
+
+CREATE OR REPLACE VIEW datatype_metadata_change{suffix} AS
+SELECT
+    c.revision_id, c.property_id, p.property_label, c.value_id, c.old_value, c.new_value,
+    od.datatype AS old_datatype, nd.datatype AS new_datatype, c.change_target, a.action, a.target,
+    c.old_hash, c.new_hash, c.timestamp, t.week, t.year_month, t.year, c.label, c.entity_id, e.entity_label
+FROM datatype_metadata_change_compact{suffix} c
+LEFT JOIN dim_property p ON p.property_id = c.property_id
+LEFT JOIN dim_datatype od ON od.datatype_key = c.old_datatype_key
+LEFT JOIN dim_datatype nd ON nd.datatype_key = c.new_datatype_key
+LEFT JOIN dim_action a ON a.action_key = c.action_key
+LEFT JOIN dim_time_bucket t ON t.time_bucket_key = c.time_bucket_key
+LEFT JOIN dim_entity e ON e.entity_id = c.entity_id;
@@ -0,0 +1,34 @@
+--- #####################################################
+--      Dimension tables (change_extraction_processing.compact_schema)
+--      The compact change tables store keys to these tables instead of the repeated text columns.
+--      They are shared by all the table suffixes and filled by the writer (see dimensions.py).
+--- #####################################################
+CREATE TABLE IF NOT EXISTS dim_property (
+    property_id INT PRIMARY KEY,
+    property_label TEXT
+);
+
+CREATE TABLE IF NOT EXISTS dim_entity (
+    entity_id INT PRIMARY KEY,
+    entity_label TEXT -- label (or alias if label == '') of the entity in its last revision
+);
+
+CREATE TABLE IF NOT EXISTS dim_datatype (
+    datatype_key SMALLINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    datatype TEXT UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS dim_action (
+    action_key SMALLINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    action TEXT,
+    target TEXT,
+    UNIQUE (action, target)
+);
+
+CREATE TABLE IF NOT EXISTS dim_time_bucket (
+    time_bucket_key SMALLINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    week varchar(255),
+    year_month varchar(255),
+    year varchar(255),
+    UNIQUE (week, year_month, year)
+);
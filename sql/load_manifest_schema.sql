@@ -0,0 +1,12 @@
+--- #####################################################
+--      Load manifest (change_extraction_processing.load_manifest)
+--      Ranges of pages (entities) of each dump file whose results are stored in the DB.
+--      Written in the same transaction as the rows of the pages.
+--- #####################################################
+CREATE TABLE IF NOT EXISTS load_manifest (
+    file_path TEXT,
+    page_start INT, -- index of the page in the file (only entity pages are counted)
+    page_end INT, -- inclusive
+    loaded_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+    PRIMARY KEY (file_path, page_start)
+);